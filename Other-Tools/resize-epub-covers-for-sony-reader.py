@@ -1,13 +1,26 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # This simple script attempts to resize every EPUB file cover inside a
 # Sony Reader device to make it fit the screen without the need for resizing
 # (the default Sony Reader resizing looks ugly)
 #
+# The EPUBs are processed in parallel by a pool of processes; only the cover
+# is rewritten inside each EPUB, all the other members are copied as they
+# are, without extracting and recompressing the whole book. A manifest
+# (by default on the device itself) remembers the books that have already
+# been processed, so that a re-run only touches the new or changed ones.
+#
+# The sync command copies to the device the EPUBs recently imported in the
+# Calibre library (according to the import index of Calibre-Utils), with
+# their cover already resized: only the books that are new, or that have
+# changed since the last sync, are written.
+#
+#   resize-epub-covers-for-sony-reader.py sync --days 30
+#
 # KNOWN ISSUES:
-# 
-# - It ignores EPUBS that don't contain a content.opf file
-# - The resize on periodics doesn't bring great results: since they have a 
+#
+# - It ignores EPUBS that don't declare an OPF file (nor contain a content.opf)
+# - The resize on periodics doesn't bring great results: since they have a
 #   top and bottom bars that take away some pixels, their cover size should be
 #   slightly shorter, but the script isn't aware of this.
 #
@@ -19,39 +32,52 @@
 COVER_WIDTH = 590
 COVER_HEIGHT = 754
 
+MANIFEST_NAME = '.resize-epub-covers.json'
+SYNC_MANIFEST_NAME = '.sync-library.json'
+SYNC_DIR = 'database/media/books/Calibre-Utils'
+# USB mass storage is slow with concurrent writes and small chunks
+SYNC_WRITERS = 2
+WRITE_CHUNK = 4 * 1024 * 1024
+MOUNTINFO = '/proc/self/mountinfo'
+CONTAINER_XML = 'META-INF/container.xml'
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import io
+import json
 import os
+import posixpath
 import re
-import shutil
+import sqlite3
 import subprocess
 import sys
-import tempfile
-from xml.dom import minidom
+import threading
+import time
+from urllib.parse import unquote
+from xml.etree import ElementTree
 import zipfile
 
+from PIL import Image
 
-def run(cmd, show_output=True):
-    '''Runs The command cmd and returns its exit status. Depending on the
-    show_output parameters it shows the standard output or not.'''
-
-    if show_output:
-        p = subprocess.Popen(cmd, shell=True)
-    else:
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    sts = os.waitpid(p.pid, 0)[1]
-    return sts
+# zipwriter lives in the main Calibre-Utils directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from importindex import ImportIndex, metadata_db_path  # noqa: E402
+from zipwriter import ZipWriter, patch_archive  # noqa: E402
 
 
 def popen(cmd):
     '''Returns the standard output text caused by cmd's execution'''
 
     pipe = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout
-    return pipe.read().strip()
+    return pipe.read().decode('utf-8', 'replace').strip()
 
 
-def command_in_path(cmd):
-    '''Returns True if cmd is available in the system PATH, False otherwise.'''
+def unescape_mount_path(path):
+    '''Decodes the octal escapes (e.g. \\040 for spaces) of the paths in
+    /proc/self/mountinfo.'''
 
-    return run('which ' + cmd, show_output=False) == 0
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
 
 
 def mount():
@@ -59,6 +85,19 @@ def mount():
     The result is a list if tuples in the form of (device, directory)'''
 
     result = []
+    if os.path.exists(MOUNTINFO):
+        # Each line is something like
+        # '36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw'
+        with open(MOUNTINFO) as f:
+            for line in f:
+                fields, _, rest = line.partition(' - ')
+                fields = fields.split(' ')
+                rest = rest.split(' ')
+                if len(fields) >= 5 and len(rest) >= 2:
+                    result.append((unescape_mount_path(rest[1]),
+                                   unescape_mount_path(fields[4])))
+        return result
+
     # Each line is something like 'proc on /proc type proc (rw)'
     for line in popen('mount').split('\n'):
         try:
@@ -66,31 +105,38 @@ def mount():
             device = v[0]
             directory = v[1].split(' ')[0]
             result.append((device, directory))
-        except:
+        except IndexError:
             pass
 
     return result
 
 
 def find_file(base_path, matching_function):
-    '''Return a list of files inside base_path that match the matching function 
-    (including its subdirectories). matching_function can be a lamda 
-    expression.'''
+    '''Return a list of files inside base_path that match the matching function
+    (including its subdirectories). matching_function receives an os.DirEntry,
+    whose file type comes from the directory listing itself, so no stat is
+    needed for each entry.'''
 
     result = []
-    for f in [ os.path.join(base_path, x) for x in os.listdir(base_path) ]:
-        if matching_function(f):
-            result.append(f)
-        if os.path.isdir(f):
-            result.extend(find_file(f, matching_function))
-    return result
+    dirs = [base_path]
+    while dirs:
+        try:
+            entries = list(os.scandir(dirs.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif matching_function(entry):
+                result.append(entry.path)
+    return sorted(result)
 
 
 def find_sony_reader():
     '''Tries to find if a Sony ebook reader is currently mounted on the system.
     If there's one, it returns its mount directory, otherwise returns False.'''
 
-    mount_dirs = [ x[1] for x in mount() ]
+    mount_dirs = [x[1] for x in mount()]
     for d in mount_dirs:
         target_dir = os.path.join(d, 'database', 'media', 'books')
         if os.path.exists(target_dir):
@@ -98,29 +144,46 @@ def find_sony_reader():
     return False
 
 
-def resize_image(img_file, width, height, keep_proportions=False):
-    '''Resizes img_file to the specified new size. By default it doesn't
-    respect the previous img_file size proportion; this can be changed with the
-    keep_proportions parameter.'''
-
-    force = keep_proportions and '' or '!'
-    cmd = 'mogrify -resize %sx%s%s \'%s\'' % (width, height, force, img_file)
-    run(cmd)
+def resize_image(img_data, width, height, keep_proportions=False):
+    '''Resizes the img_data image to the specified new size and returns the
+    encoded result, in the same format of the original. By default it doesn't
+    respect the previous img_data size proportion; this can be changed with
+    the keep_proportions parameter. Returns None if the image has already the
+    requested size.'''
+
+    with Image.open(io.BytesIO(img_data)) as img:
+        if img.size == (width, height):
+            return None
+        img_format = img.format or 'JPEG'
+        if keep_proportions:
+            img.thumbnail((width, height), Image.Resampling.LANCZOS)
+            resized = img
+        else:
+            resized = img.resize((width, height), Image.Resampling.LANCZOS)
+        if img_format == 'JPEG' and resized.mode not in ('RGB', 'L'):
+            resized = resized.convert('RGB')
+        out = io.BytesIO()
+        resized.save(out, img_format, quality=90)
+        return out.getvalue()
 
 
 def is_image_file(file_name):
     '''Returns True if file_name is an image file name, False otherwise.'''
 
     f = file_name.lower()
-    return f.endswith('.jpg') or \
-            f.endswith('.jpeg') or \
-            f.endswith('.png') or \
-            f.endswith('.gif')
+    return f.endswith(('.jpg', '.jpeg', '.png', '.gif'))
+
+
+def local_name(tag):
+    '''Returns the tag name without its {namespace} prefix.'''
+
+    return tag.rsplit('}', 1)[-1]
 
 
 def find_epub_cover_file(content_opf):
     '''Returns the EPUB cover file name; it looks for it inside the content.opf
-    file. If no cover is found returns None.'''
+    file (a path or a file object), which is read as a stream. If no cover is
+    found returns None.'''
 
     # The process goes like this:
     # 1. See if there's any "meta" tag with "cover" as name
@@ -130,101 +193,355 @@ def find_epub_cover_file(content_opf):
     # 5. If there's no "meta" cover, try to find an "item" with "id" = cover
     # 6. If there's one, return its "href"
 
-    xml = minidom.parse(content_opf)
-    cover_elements = [ x for x in xml.getElementsByTagName('meta') \
-                        if x.getAttribute('name') == 'cover' ]
+    meta_cover = None
+    items = {}
+    for _, element in ElementTree.iterparse(content_opf, events=('end',)):
+        tag = local_name(element.tag)
+        if tag == 'meta' and element.get('name') == 'cover' and meta_cover is None:
+            meta_cover = element.get('content')
+        elif tag == 'item' and element.get('id'):
+            items[element.get('id')] = element.get('href')
+        # Only the attributes matter, the parsed elements can go
+        element.clear()
 
     # Is there any "meta-cover"?
-    if len(cover_elements) > 0: 
-        cover_element = cover_elements[0]
-        content = cover_element.getAttribute('content')
-
-        item_elements = xml.getElementsByTagName('item')
-        item_cover_elements = [ e for e in item_elements \
-                                   if e.getAttribute('id') == content ]
-        if len(item_cover_elements) > 0:
-            return item_cover_elements[0].getAttribute('href')
-
-        elif is_image_file(content): 
-            return content
+    if meta_cover is not None:
+        if meta_cover in items:
+            return items[meta_cover]
+        elif is_image_file(meta_cover):
+            return meta_cover
 
     # No "meta-cover"? Let's try for an "item-cover"
     else:
-        item_elements = xml.getElementsByTagName('item') 
-        item_cover_elements = [ e for e in item_elements \
-                                   if e.getAttribute('id') == 'cover' ]
-        if len(item_cover_elements) > 0:
-            return item_cover_elements[0].getAttribute('href')
+        return items.get('cover')
+
+
+def find_content_opf(zip_file):
+    '''Returns the name of the OPF member of zip_file, as declared by
+    META-INF/container.xml (or the first content.opf, for EPUBs without a
+    valid container), or None.'''
+
+    try:
+        with zip_file.open(CONTAINER_XML) as container:
+            for _, element in ElementTree.iterparse(container, events=('end',)):
+                if local_name(element.tag) == 'rootfile' and \
+                        element.get('full-path'):
+                    return element.get('full-path')
+    except (KeyError, ElementTree.ParseError):
+        pass
+
+    for name in zip_file.namelist():
+        if posixpath.basename(name) == 'content.opf':
+            return name
+    return None
+
+
+def load_manifest(manifest_file):
+    '''Returns the manifest of the already processed EPUBs, a dictionary
+    with the EPUB paths (relative to the device) as keys.'''
+
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('cover_size') != [COVER_WIDTH, COVER_HEIGHT]:
+        # Covers resized for another device must be processed again
+        return {}
+    return manifest.get('books', {})
+
+
+def save_manifest(manifest_file, books):
+    '''Saves the manifest, replacing the old one only when the new one has
+    been completely written.'''
+
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'cover_size': [COVER_WIDTH, COVER_HEIGHT], 'books': books},
+                  f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def is_unchanged(entry, epub_file):
+    '''Returns True if epub_file has the same size and modification time
+    recorded in its manifest entry.'''
+
+    if not entry:
+        return False
+    st = os.stat(epub_file)
+    return entry['size'] == st.st_size and entry['mtime'] == st.st_mtime
+
+
+def find_cover(epub):
+    '''Returns a tuple with the name of the cover member of the epub ZipFile
+    (or None) and, if there's none, the reason why.'''
+
+    content_opf = find_content_opf(epub)
+    if not content_opf or content_opf not in epub.NameToInfo:
+        return None, 'no content.opf'
+    with epub.open(content_opf) as opf:
+        cover_href = find_epub_cover_file(opf)
+    if not cover_href:
+        return None, 'no cover'
+    # The href is relative to content.opf
+    cover_name = posixpath.normpath(posixpath.join(
+        posixpath.dirname(content_opf), unquote(cover_href)))
+    if cover_name not in epub.NameToInfo:
+        return None, 'cover not found'
+    return cover_name, None
+
+
+def process_epub(epub_file, dry_run=False, known_cover_hash=None):
+    '''Resizes the cover of epub_file, rewriting only the cover member.
+    Returns a tuple with a short description of what has been done (or
+    would be done, with dry_run) and the hash of the resulting cover.'''
+
+    try:
+        with zipfile.ZipFile(epub_file) as epub:
+            cover_name, error = find_cover(epub)
+            if not cover_name:
+                return error, None
+            cover_data = epub.read(cover_name)
+        cover_hash = hashlib.sha1(cover_data).hexdigest()
+        if cover_hash == known_cover_hash:
+            # The book has been touched, but its cover is the one already
+            # resized in a previous run
+            return 'cover already resized', cover_hash
+        resized = resize_image(cover_data, COVER_WIDTH, COVER_HEIGHT)
+        if resized is None:
+            return 'cover already resized', cover_hash
+        if dry_run:
+            return 'cover would be resized', None
+        patch_archive(epub_file, {cover_name: resized})
+        return 'cover resized', hashlib.sha1(resized).hexdigest()
+    except (zipfile.BadZipFile, ElementTree.ParseError, OSError) as e:
+        return f'error: {e}', None
+
+
+def normalize_epub(epub_file):
+    '''Returns the content of epub_file with its cover resized for the
+    device. The new EPUB is built in memory, copying the compressed bytes
+    of every other member as they are, so that it can be written to the
+    device in a single sequential pass.'''
+
+    with zipfile.ZipFile(epub_file) as epub:
+        cover_name, _ = find_cover(epub)
+        resized = None
+        if cover_name:
+            resized = resize_image(epub.read(cover_name), COVER_WIDTH,
+                                   COVER_HEIGHT)
+        if resized is not None:
+            out = io.BytesIO()
+            with ZipWriter(out) as writer:
+                for info in epub.infolist():
+                    if info.filename == cover_name:
+                        writer.add(cover_name, resized)
+                    else:
+                        writer.copy_raw(epub, info)
+            return out.getvalue()
+    # The cover is already fine (or there's none)
+    with open(epub_file, 'rb') as f:
+        return f.read()
+
+
+def write_device_file(path, data, write_slots):
+    '''Writes data to path in big chunks, at most len(write_slots) files at
+    a time; the file replaces the old one only when it's completely on the
+    device.'''
+
+    tmp_file = path + '.tmp'
+    view = memoryview(data)
+    with write_slots:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_file, 'wb', buffering=0) as f:
+            for i in range(0, len(view), WRITE_CHUNK):
+                f.write(view[i:i + WRITE_CHUNK])
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+
+
+def device_name(title, book_id):
+    '''Returns the path of a book on the device, relative to its mount
+    directory; FAT doesn't allow some characters in the file names.'''
+
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', '_', title).strip(' .')[:80]
+    return f'{SYNC_DIR}/{name} - {book_id}.epub'
+
+
+def recent_library_books(library, since):
+    '''Returns a list of (book_id, title, epub_file) tuples with the EPUBs
+    imported in the Calibre library after the since timestamp, according
+    to the import index.'''
+
+    recent = {book.book_id: book for book in ImportIndex(library).recent(since)}
+    metadata_db = metadata_db_path(library)
+    if not recent or not metadata_db or not os.path.exists(metadata_db):
+        return []
+    library_dir = os.path.dirname(metadata_db)
+    ids = [int(x) for x in recent if x.isdigit()]
+    result = []
+    # Read-only, Calibre may be running
+    db = sqlite3.connect(f'file:{metadata_db}?mode=ro', uri=True)
+    try:
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = db.execute(
+                'SELECT books.id, books.title, books.path, data.name '
+                'FROM books JOIN data ON data.book = books.id '
+                "WHERE data.format = 'EPUB' AND books.id IN (%s)"
+                % ', '.join('?' * len(chunk)), chunk)
+            for book_id, title, path, name in rows:
+                epub_file = os.path.join(library_dir, path, name + '.epub')
+                result.append((str(book_id), title, epub_file))
+    finally:
+        db.close()
+    return result
 
 
-if __name__ == '__main__':
-    # Do I have ImageMagick?
-    if not command_in_path('mogrify'):
-        print 'Couldn\'t find the mogrify command.'
-        print 'You need to install the ImageMagick package.'
-        sys.exit(1)
+def sync_book(sony_dir, book, entry, dry_run, write_slots):
+    '''Copies a library book to the device, unless the manifest entry says
+    it's already there and unchanged. Returns a tuple with a short
+    description of what has been done and the new manifest entry.'''
+
+    book_id, title, epub_file = book
+    target = os.path.join(sony_dir, *device_name(title, book_id).split('/'))
+    try:
+        st = os.stat(epub_file)
+        if entry and entry['source_size'] == st.st_size and \
+                entry['source_mtime'] == st.st_mtime and \
+                os.path.exists(target) and \
+                os.path.getsize(target) == entry['size']:
+            return 'unchanged', entry
+        if dry_run:
+            return 'would be copied', None
+        data = normalize_epub(epub_file)
+        write_device_file(target, data, write_slots)
+    except (zipfile.BadZipFile, ElementTree.ParseError, OSError) as e:
+        return f'error: {e}', None
+    return 'copied', {'book_id': book_id, 'source_size': st.st_size,
+                      'source_mtime': st.st_mtime, 'size': len(data),
+                      'sha256': hashlib.sha256(data).hexdigest()}
+
+
+def sync_library(sony_dir, library, days, jobs, writers, manifest_file,
+                 dry_run=False):
+    '''Copies to the device the new or changed books imported in the last
+    days, and removes from it the older copies of the books that have been
+    renamed. Returns the number of books copied.'''
+
+    # Same format of the resize manifest, the cover size matters here too
+    books = load_manifest(manifest_file)
+    recent = recent_library_books(library, time.time() - days * 24 * 3600)
+    print('Syncing', len(recent), 'recently imported books\n')
+    # The books already on the device under another name (e.g. retitled)
+    old_paths = {v['book_id']: k for k, v in books.items()}
+    keys = [device_name(title, book_id) for book_id, title, _ in recent]
+    write_slots = threading.BoundedSemaphore(max(1, writers))
+    copied = 0
+    # Reading and resizing run in parallel, the writes are limited by
+    # write_slots
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = executor.map(
+            lambda book, key: sync_book(sony_dir, book, books.get(key),
+                                        dry_run, write_slots),
+            recent, keys)
+        for book, key, (result, entry) in zip(recent, keys, results):
+            print(os.path.basename(key) + ':', result)
+            if result in ('copied', 'would be copied'):
+                copied += 1
+            if not entry:
+                continue
+            books[key] = entry
+            old_key = old_paths.get(book[0])
+            if old_key and old_key != key:
+                try:
+                    os.remove(os.path.join(sony_dir, *old_key.split('/')))
+                except OSError:
+                    pass
+                books.pop(old_key, None)
+    if not dry_run:
+        save_manifest(manifest_file, books)
+    return copied
 
-    # Do I have zip?
-    if not command_in_path('zip'):
-        print 'Couldn\'t find the zip command.'
-        print 'You need to install the zip package.'
-        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Resize the EPUB covers on a mounted Sony Reader, or '
+        'sync the recently imported books to it')
+    parser.add_argument('command', nargs='?', choices=('resize', 'sync'),
+                        default='resize',
+                        help='resize the covers of the books on the device '
+                        '(default), or copy the new library books to it')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of EPUBs processed at the same time')
+    parser.add_argument('-m', '--manifest',
+                        help='manifest of the processed books (default: '
+                        f'{MANIFEST_NAME} or {SYNC_MANIFEST_NAME} on the '
+                        'device)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only report how many books would be touched')
+    parser.add_argument('--with-library', dest='library',
+                        help='sync: Calibre library path (default: the '
+                        'current one)')
+    parser.add_argument('--days', type=float, default=30,
+                        help='sync: books imported in the last DAYS days')
+    parser.add_argument('--writers', type=int, default=SYNC_WRITERS,
+                        help='sync: number of files written at the same time')
+    args = parser.parse_args()
 
     # Is there a mounted Sony Reader?
     sony_dir = find_sony_reader()
     if not sony_dir:
-        print 'Couldn\'t find a Sony Reader device mounted on the system.'
+        print('Couldn\'t find a Sony Reader device mounted on the system.')
         sys.exit(1)
 
+    if args.command == 'sync':
+        manifest_file = args.manifest or \
+            os.path.join(sony_dir, SYNC_MANIFEST_NAME)
+        copied = sync_library(sony_dir, args.library, args.days, args.jobs,
+                              args.writers, manifest_file, args.dry_run)
+        if args.dry_run:
+            print(f'\n{copied} books would be copied')
+        else:
+            print(f'\n{copied} books copied')
+        print('\nThat\'s all, folks!\n')
+        sys.exit(0)
+
     # Let's find the EPUB files!
-    epub_test = lambda x: os.path.isfile(x) and x.endswith('.epub')
+    epub_test = lambda x: x.name.endswith('.epub') and x.is_file()  # noqa: E731
     epubs = find_file(sony_dir, epub_test)
 
-    # The stage is set...
-    tmp_dir = tempfile.mkdtemp()
-    print 'Working inside', tmp_dir, '\n'
+    # Which ones have changed since the last run?
+    manifest_file = args.manifest or os.path.join(sony_dir, MANIFEST_NAME)
+    books = load_manifest(manifest_file)
+    keys = {epub_file: os.path.relpath(epub_file, sony_dir) for epub_file in epubs}
+    todo = [x for x in epubs if not is_unchanged(books.get(keys[x]), x)]
 
     # And now, let's resize!
-    print 'Processing', len(epubs), 'EPUB files\n'
-
-    for epub_file in epubs:
-        epub_name = os.path.basename(epub_file)
-        print 'Processing', epub_name
-        zip_name = epub_name[:-4] + 'zip' # Changes extension from epub to zip
-        zip_file = os.path.join(tmp_dir, zip_name)
-
-        # Moves the file to the temporary directory changing its extension to zip.
-        shutil.copyfile(epub_file, zip_file)
-
-        # Unzips the EPUB
-        zip_tmp_dir = os.path.join(tmp_dir, 'pippo')
-        os.mkdir(zip_tmp_dir)
-        with zipfile.ZipFile(zip_file) as myzip:
-            myzip.extractall(zip_tmp_dir)
-        os.unlink(zip_file)
-
-        # Is there a cover image?
-        cover_file = None
-        content_opf_test = lambda x: os.path.basename(x) == 'content.opf'
-        content_opfs = find_file(zip_tmp_dir, content_opf_test)
-        if len(content_opfs) > 0:
-            content_opf_file = os.path.join(zip_tmp_dir, content_opfs[0])
-            cover_file = find_epub_cover_file(content_opf_file)
-
-        # Resizes the cover, if any
-        if cover_file and os.path.isfile(cover_file):
-            print "Cover found!"
-            resize_image(cover_file, COVER_WIDTH, COVER_HEIGHT)
-            # Rebuilds the zip file with the new cover
-            rezip_cmd = 'cd \'%s\' && zip -r \'%s\' *' % (zip_tmp_dir, zip_file)
-            run(rezip_cmd, show_output=False)
-            # Puts the EPUB back in place
-            shutil.move(zip_file, epub_file)
-
-        # Removes the temporary directory anyway
-        shutil.rmtree(zip_tmp_dir)
-    
-    # Final clean-up
-    os.rmdir(tmp_dir)
-
-    print '\nThat\'s all, folks!\n'
+    print('Processing', len(todo), 'of', len(epubs), 'EPUB files\n')
+
+    touched = 0
+    hashes = [books.get(keys[x], {}).get('cover_hash') for x in todo]
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        results = executor.map(process_epub, todo, [args.dry_run] * len(todo),
+                               hashes)
+        for epub_file, (result, cover_hash) in zip(todo, results):
+            print(os.path.basename(epub_file) + ':', result)
+            if result in ('cover resized', 'cover would be resized'):
+                touched += 1
+            if args.dry_run or result.startswith('error'):
+                continue
+            st = os.stat(epub_file)
+            books[keys[epub_file]] = {'size': st.st_size, 'mtime': st.st_mtime,
+                                      'cover_hash': cover_hash}
+
+    if args.dry_run:
+        print(f'\n{touched} books would be touched')
+    else:
+        # Books that aren't on the device any more are forgotten
+        current = set(keys.values())
+        save_manifest(manifest_file,
+                      {k: v for k, v in books.items() if k in current})
+        print(f'\n{touched} books touched')
+
+    print('\nThat\'s all, folks!\n')
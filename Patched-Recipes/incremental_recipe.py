@@ -0,0 +1,184 @@
+#!/usr/bin/env  python
+__license__   = 'GPL v3'
+__author__    = 'Paolo Bernardi'
+__description__ = 'Incremental downloads for the patched recipes'
+
+'''
+Base class for the patched recipes that run every day on the same feeds:
+
+- the feeds are downloaded with conditional requests (ETag/Last-Modified),
+  an unchanged feed costs a 304;
+- each article, identified by get_article_url (id/guid), is downloaded only
+  the first time it's seen; its HTML is kept under
+  ~/.cache/calibre-utils/recipes and the next runs read it from there;
+- the number of simultaneous downloads can be set with the "downloads"
+  recipe option (ebook-convert --recipe-specific-option downloads:8).
+
+Only the raw page of each article is cached (with a <base> tag, so that
+its relative links still point to the site), not the processed article:
+every run still applies keep_only_tags, remove_tags and the other
+processing to the cached pages, and downloads their images again. The
+<base> tag is taken out of remove_tags, or the images of the cached pages
+couldn't be found.
+
+Calibre compiles recipes on their own, so this module must be on its
+Python path: CALIBRE_PYTHON_PATH=/path/to/Patched-Recipes
+'''
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import closing
+
+from calibre.ptempfile import PersistentTemporaryFile
+from calibre.web.feeds import Feed, feed_from_xml
+from calibre.web.feeds.news import BasicNewsRecipe
+
+HEAD_RE = re.compile(br'<head(\s[^>]*)?>', re.IGNORECASE)
+
+
+class IncrementalRecipe(BasicNewsRecipe):
+
+    articles_are_obfuscated = True
+    simultaneous_downloads = 5
+
+    recipe_specific_options = {
+        'downloads': {
+            'short': 'Number of simultaneous article downloads',
+            'default': str(simultaneous_downloads),
+        },
+    }
+
+    def __init__(self, *args, **kwargs):
+        BasicNewsRecipe.__init__(self, *args, **kwargs)
+        d = self.recipe_specific_options.get('downloads')
+        if d and isinstance(d, str) and self.delay <= 0:
+            self.simultaneous_downloads = max(1, int(d))
+        slug = re.sub(r'\W+', '-', self.title.lower()).strip('-')
+        self.cache_dir = os.path.join(os.path.expanduser('~'), '.cache',
+                                      'calibre-utils', 'recipes', slug)
+        self.cache_lock = threading.Lock()
+        for sub in ('articles', 'feeds'):
+            os.makedirs(os.path.join(self.cache_dir, sub), exist_ok=True)
+        self.remove_tags = [spec for spec in map(self.keep_base, self.remove_tags)
+                            if spec]
+
+    def keep_base(self, spec):
+        # The same remove_tags entry without <base>, None if it's only for it
+        name = spec.get('name')
+        if isinstance(name, (list, tuple)) and 'base' in name:
+            names = [n for n in name if n != 'base']
+            return dict(spec, name=names) if names else None
+        return None if name == 'base' else spec
+
+    def cache_path(self, kind, key, ext):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + ext
+        return os.path.join(self.cache_dir, kind, name)
+
+    def write_file(self, path, data):
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def prune_cache(self):
+        # The articles older than twice the download window won't be
+        # in the feeds anymore
+        limit = time.time() - 2 * max(self.oldest_article, 1) * 24 * 3600
+        dir_articles = os.path.join(self.cache_dir, 'articles')
+        for name in os.listdir(dir_articles):
+            path = os.path.join(dir_articles, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def fetch_feed(self, url):
+        # Conditional request, with the validators of the last download
+        import mechanize
+        feed_file = self.cache_path('feeds', url, '.xml')
+        meta_file = self.cache_path('feeds', url, '.json')
+        headers = {}
+        if os.path.exists(feed_file) and os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            request = mechanize.Request(url, headers=headers)
+            with closing(self.browser.open_novisit(request, timeout=self.timeout)) as f:
+                raw = f.read()
+                info = f.info()
+        except Exception as e:
+            if getattr(e, 'code', None) != 304:
+                raise
+            self.log('Feed not modified:', url)
+            with open(feed_file, 'rb') as f:
+                return f.read()
+        self.write_file(feed_file, raw)
+        meta = {'etag': info.get('ETag'), 'last_modified': info.get('Last-Modified')}
+        self.write_file(meta_file, json.dumps(meta).encode('utf-8'))
+        return raw
+
+    def parse_feeds(self):
+        # Same as BasicNewsRecipe.parse_feeds, with the conditional requests
+        self.prune_cache()
+        parsed_feeds = []
+        for obj in self.get_feeds():
+            if isinstance(obj, str):
+                title, url = None, obj
+            else:
+                title, url = obj
+            if url.startswith('feed://'):
+                url = 'http' + url[4:]
+            self.report_progress(0, 'Fetching feed %s...' % (title or url))
+            try:
+                parsed_feeds.append(feed_from_xml(
+                    self.fetch_feed(url), title=title, log=self.log,
+                    oldest_article=self.oldest_article,
+                    max_articles_per_feed=self.max_articles_per_feed,
+                    get_article_url=self.get_article_url))
+                if self.delay > 0:
+                    time.sleep(self.delay)
+            except Exception as err:
+                feed = Feed()
+                msg = 'Failed feed: %s' % (title or url)
+                feed.populate_from_preparsed_feed(msg, [])
+                feed.description = str(err)
+                parsed_feeds.append(feed)
+                self.log.exception(msg)
+        if self.remove_empty_feeds:
+            parsed_feeds = [f for f in parsed_feeds if len(f) > 0]
+        return parsed_feeds
+
+    def get_obfuscated_article(self, url):
+        # url is the article ID from get_article_url
+        article_file = self.cache_path('articles', url, '.html')
+        with self.cache_lock:
+            cached = os.path.exists(article_file)
+        if cached:
+            os.utime(article_file)
+            with open(article_file, 'rb') as f:
+                raw = f.read()
+        else:
+            br = self.get_browser()
+            with closing(br.open_novisit(url, timeout=self.timeout)) as f:
+                raw = f.read()
+            # The article is read from a local file, the relative links
+            # must still point to the site
+            base = ('<base href="%s"/>' % url).encode('utf-8')
+            match = HEAD_RE.search(raw)
+            raw = raw[:match.end()] + base + raw[match.end():] if match else base + raw
+            with self.cache_lock:
+                self.write_file(article_file, raw)
+        # Calibre may delete the returned file, the cache keeps its copy
+        tmp = PersistentTemporaryFile('.html')
+        tmp.write(raw)
+        tmp.close()
+        return tmp.name
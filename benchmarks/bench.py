@@ -0,0 +1,628 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for the conversion pipelines. Recorded Crypto-Gram, Wikipedia
+# (pages and API) and generic pages are served by a local HTTP server, and
+# each pipeline
+# runs on batches of pages (by default 1, 10 and 100) with either the real
+# Calibre tools or the fast stand-ins in benchmarks/stubs. Every batch runs
+# in its own process with an empty home directory (cold caches, throwaway
+# library), and reports the time spent in each stage, the throughput and
+# the peak RSS of the process and of its children. The EPUB files and ZIP
+# bundles left by a batch are checked too: a batch that writes a broken
+# archive or a malformed XHTML document fails.
+#
+#   python3 benchmarks/bench.py run --tools stub -o before.json
+#   python3 benchmarks/bench.py run --tools stub -o after.json
+#   python3 benchmarks/bench.py compare before.json after.json
+#
+# lxml, Pillow, requests (and Calibre with --tools real)
+#
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import datetime
+import functools
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from string import Template
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+import zipfile
+
+from lxml import etree, html
+from PIL import Image
+
+DIR_BENCH = os.path.dirname(os.path.abspath(__file__))
+DIR_FIXTURES = os.path.join(DIR_BENCH, "fixtures")
+DIR_STUBS = os.path.join(DIR_BENCH, "stubs")
+DIR_RESULTS = os.path.join(DIR_BENCH, "results")
+
+# The pipelines live in the main Calibre-Utils directory
+sys.path.insert(0, os.path.dirname(DIR_BENCH))
+
+PIPELINES = ["cryptogram", "wikipedia", "webpage", "anthology"]
+BATCHES = [1, 10, 100]
+FIRST_ISSUE = datetime.datetime(2015, 1, 15)
+CALIBRE_TOOLS = ["ebook-convert", "ebook-meta", "calibredb"]
+
+
+################################################################################
+##### Fixture site
+################################################################################
+
+
+def issue_dates(count: int) -> List[datetime.datetime]:
+    dates = []
+    date = FIRST_ISSUE
+    for _ in range(count):
+        dates.append(date)
+        date = date.replace(
+            year=date.year + date.month // 12, month=date.month % 12 + 1
+        )
+    return dates
+
+
+@functools.lru_cache(maxsize=None)
+def fixture(name: str) -> str:
+    with open(os.path.join(DIR_FIXTURES, name), encoding="utf-8") as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=None)
+def image(name: str) -> Tuple[bytes, str]:
+    # Photos like the ones found in articles, and a small PNG diagram
+    if name.endswith(".png"):
+        img = Image.new("RGB", (400, 300), (240, 240, 255))
+        img.paste((30, 60, 120), (50, 50, 350, 250))
+        out = io.BytesIO()
+        img.save(out, "PNG")
+        return out.getvalue(), "image/png"
+    seed = sum(name.encode("utf-8"))
+    img = Image.effect_mandelbrot((1200, 800), (-2 + seed % 3 * 0.1, -1, 1, 1), 100)
+    out = io.BytesIO()
+    img.convert("RGB").save(out, "JPEG", quality=85)
+    return out.getvalue(), "image/jpeg"
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 keeps the connections alive, as real sites do
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, content: bytes, content_type: str):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def page(self, name: str, title: str):
+        content = Template(fixture(name)).safe_substitute(title=title)
+        self.reply(content.encode("utf-8"), "text/html; charset=utf-8")
+
+    def api(self, params: Dict[str, List[str]]):
+        # The MediaWiki API calls of wikianthology.py
+        if params.get("list") == ["categorymembers"]:
+            limit = int(params.get("cmlimit", ["500"])[0])
+            members = [{"ns": 0, "title": f"Article {i}"} for i in range(limit)]
+            data: Dict[str, Any] = {"query": {"categorymembers": members}}
+        else:
+            title = params["page"][0]
+            page = Template(fixture("wikipedia.html")).safe_substitute(title=title)
+            content = html.document_fromstring(page).get_element_by_id("bodyContent")
+            data = {
+                "parse": {
+                    "title": title,
+                    "text": html.tostring(content, encoding="unicode"),
+                    "links": [
+                        {"ns": 0, "title": f"Topic {i}", "exists": True}
+                        for i in range(2)
+                    ],
+                }
+            }
+        self.reply(json.dumps(data).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path in ("/crypto-gram/", "/crypto-gram/archives/"):
+            dates = issue_dates(max(BATCHES))
+            site = "http://" + self.headers["Host"]
+            if path == "/crypto-gram/":
+                # The front page only links the latest issues
+                dates = dates[-12:]
+            links = "\n".join(
+                f'<li><a href="{site}/crypto-gram/archives/{d:%Y/%m}15.html">{d:%B %Y}</a></li>'
+                for d in reversed(dates)
+            )
+            content = f"<html><body><ul>\n{links}\n</ul></body></html>"
+            self.reply(content.encode("utf-8"), "text/html; charset=utf-8")
+        elif path.startswith("/crypto-gram/archives/"):
+            self.page("cryptogram.html", "Crypto-Gram " + path[22:29])
+        elif path == "/w/api.php":
+            self.api(parse_qs(urlsplit(self.path).query))
+        elif path.startswith("/w/index.php"):
+            title = self.path.split("title=")[-1].split("&")[0].replace("_", " ")
+            self.page("wikipedia.html", title)
+        elif path.startswith("/page/"):
+            self.page("webpage.html", "Web page " + path[6:].split(".")[0])
+        elif path == "/static/style.css":
+            self.reply(fixture("style.css").encode("utf-8"), "text/css")
+        elif path.startswith("/static/") and path.endswith((".jpg", ".png")):
+            self.reply(*image(path[8:]))
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+
+def start_fixture_site() -> Tuple[ThreadingHTTPServer, str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+################################################################################
+##### Stage timing
+################################################################################
+
+
+class StageTimes:
+
+    lock: threading.Lock
+    times: Dict[str, List[float]]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+
+    @contextlib.contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.times.setdefault(stage, []).append(elapsed)
+
+    def wrap(self, obj: Any, attr: str, stage: str):
+        # Replaces obj.attr with a version that records its duration
+        function = getattr(obj, attr)
+
+        @functools.wraps(function)
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            with self.timed(stage):
+                return function(*args, **kwargs)
+
+        setattr(obj, attr, timed)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for stage, times in self.times.items():
+            result[stage] = {
+                "count": len(times),
+                "total": sum(times),
+                "mean": sum(times) / len(times),
+                "max": max(times),
+            }
+        return result
+
+
+################################################################################
+##### Pipelines
+################################################################################
+
+
+def run_cryptogram(
+    base_url: str, count: int, jobs: int, library: str, stages: StageTimes
+):
+    from cryptogram2calibre import Cryptogram2Calibre, SchneierDotCom
+    from epub import EpubBuilder
+    from library import CalibreLibrary
+
+    app = Cryptogram2Calibre(jobs=jobs)
+    app.schneier_dot_com = SchneierDotCom(app.http_cache, base_url)
+    app.library = CalibreLibrary(library)
+    stages.wrap(app.fetcher, "fetch_page", "fetch")
+    stages.wrap(app.schneier_dot_com, "declutterize", "declutter")
+    stages.wrap(app.covers, "render", "cover")
+    stages.wrap(app.calibre, "zip_to_mobi", "mobi")
+    stages.wrap(EpubBuilder, "write", "epub")
+    stages.wrap(app.library, "flush", "import")
+    app.run(issue_dates(count))
+
+
+def run_wikipedia(
+    base_url: str, count: int, jobs: int, library: str, stages: StageTimes
+):
+    # Same steps as wikipedia2calibre, without zenity
+    from convertworker import ConversionPool
+    from covers import CoverRenderer
+    from fetcher import PageFetcher
+    from images import ImageOptimizer
+    from library import CalibreLibrary
+    from stagecache import StageCache
+    import transforms
+    from zipwriter import ZipWriter
+
+    covers = CoverRenderer()
+    fetcher = PageFetcher(image_optimizer=ImageOptimizer(cache=StageCache()))
+    calibre = CalibreLibrary(library)
+    stages.wrap(fetcher, "fetch_page", "fetch")
+    stages.wrap(covers, "render", "cover")
+    stages.wrap(transforms, "transform_archive", "transform")
+    stages.wrap(calibre, "flush", "import")
+
+    # Warm Calibre interpreters when calibre-debug is available (not with
+    # the stub tools), otherwise one ebook-convert process per call
+    pool = ConversionPool(jobs)
+
+    def ebook_convert(*args: str):
+        with stages.timed("ebook-convert"):
+            res = pool.run("ebook-convert", list(args), capture_output=True)
+            res.check_returncode()
+
+    def article(i: int):
+        title = f"Article {i}"
+        dir_work = os.path.join(os.path.expanduser("~"), "wikipedia", str(i))
+        os.makedirs(dir_work)
+
+        def path(name: str) -> str:
+            return os.path.join(dir_work, name)
+
+        covers.render("wikipedia", title, path("cover.jpg"), pointsize=24)
+        page = fetcher.fetch_page(
+            f"{base_url}/w/index.php?title=Article_{i}&printable=yes"
+        )
+        with ZipWriter(path("pippo-with-anchors.zip")) as writer:
+            writer.add_files(page.files, "html/")
+        transforms.transform_archive(
+            path("pippo-with-anchors.zip"),
+            ["unwrap-nontoc-links"],
+            [],
+            output=path("pippo.zip"),
+        )
+        cover = "--cover=" + path("cover.jpg")
+        ebook_convert(path("pippo.zip"), path("pippo.mobi"), cover)
+        ebook_convert(path("pippo.mobi"), path("pippo.epub"), cover)
+        transforms.transform_archive(path("pippo.epub"), [], ["remove-inline-toc"])
+        calibre.add(title, [path("pippo.epub"), path("pippo-with-anchors.zip")])
+
+    with pool, ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(article, range(count)))
+    calibre.flush()
+
+
+def run_webpage(base_url: str, count: int, jobs: int, library: str, stages: StageTimes):
+    # The workers of the ingest service, fed with count queued pages
+    from epub import EpubBuilder
+    from webpage2calibred import JobQueue, Webpage2Calibre
+
+    dir_base = os.path.join(os.path.expanduser("~"), ".webpage2calibre")
+    os.makedirs(dir_base)
+    queue = JobQueue(os.path.join(dir_base, "queue.sqlite"))
+    app = Webpage2Calibre(queue, dir_base, library)
+    stages.wrap(app.fetcher, "fetch_page", "fetch")
+    stages.wrap(app.covers, "render", "cover")
+    stages.wrap(EpubBuilder, "write", "epub")
+    stages.wrap(app.library, "flush", "import")
+    for i in range(count):
+        queue.submit(f"{base_url}/page/{i}.html", None, ["Temp"])
+
+    def worker():
+        while queue.counts().get("queued"):
+            app.process(queue.take())
+
+    threads = [threading.Thread(target=worker) for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    failed = queue.failures()
+    if failed:
+        raise RuntimeError(f"{len(failed)} pages failed: {failed[0]['error']}")
+
+
+def run_anthology(
+    base_url: str, count: int, jobs: int, library: str, stages: StageTimes
+):
+    # A single book with the count articles of a category
+    from covers import CoverRenderer
+    from epub import BookMetadata
+    from fetcher import PageFetcher
+    from images import ImageOptimizer
+    from library import CalibreLibrary
+    from stagecache import StageCache
+    from wikianthology import WikiAnthology, WikipediaApi
+
+    fetcher = PageFetcher(max_workers=jobs)
+    api = WikipediaApi(fetcher, site=base_url)
+    anthology = WikiAnthology(api, jobs, ImageOptimizer(cache=StageCache()))
+    covers = CoverRenderer()
+    calibre = CalibreLibrary(library)
+    stages.wrap(anthology, "collect", "fetch")
+    stages.wrap(covers, "render", "cover")
+    stages.wrap(anthology, "build", "epub")
+    stages.wrap(calibre, "flush", "import")
+    dir_work = os.path.join(os.path.expanduser("~"), "anthology")
+    os.makedirs(dir_work)
+    cover_file = os.path.join(dir_work, "cover.jpg")
+    epub_file = os.path.join(dir_work, "anthology.epub")
+    title = "Bench (Wikipedia en)"
+    try:
+        articles = anthology.collect(api.category_members("Bench", count), 0, count)
+        if len(articles) != count:
+            raise RuntimeError(f"{count - len(articles)} articles failed")
+        covers.render("wikipedia", title, cover_file, pointsize=24)
+        metadata = BookMetadata(title=title, authors=["Wikipedia"])
+        anthology.build(articles, metadata, cover_file, epub_file)
+        calibre.add(title, [epub_file])
+        calibre.flush()
+    finally:
+        anthology.close()
+        fetcher.executor.shutdown()
+
+
+RUNNERS: Dict[str, Callable[[str, int, int, str, StageTimes], None]] = {
+    "cryptogram": run_cryptogram,
+    "wikipedia": run_wikipedia,
+    "webpage": run_webpage,
+    "anthology": run_anthology,
+}
+
+
+def check_archive(path: str):
+    with zipfile.ZipFile(path) as zipf:
+        bad = zipf.testzip()
+        if bad:
+            raise RuntimeError(f"{path}: {bad} is corrupted")
+        if path.endswith(".epub"):
+            first = zipf.infolist()[0]
+            if (
+                first.filename != "mimetype"
+                or first.compress_type != zipfile.ZIP_STORED
+            ):
+                raise RuntimeError(f"{path}: the mimetype isn't the first stored entry")
+        for name in zipf.namelist():
+            if name.endswith((".xhtml", ".opf", ".ncx")):
+                try:
+                    etree.fromstring(zipf.read(name))
+                except etree.XMLSyntaxError as e:
+                    raise RuntimeError(f"{path}: {name} is malformed: {e}")
+
+
+def check_outputs(dir_home: str) -> int:
+    # Returns the number of checked archives (the caches aren't outputs)
+    checked = 0
+    for root, dirs, files in os.walk(dir_home):
+        if root == dir_home and ".cache" in dirs:
+            dirs.remove(".cache")
+        for name in files:
+            if name.endswith((".epub", ".zip")):
+                check_archive(os.path.join(root, name))
+                checked += 1
+    return checked
+
+
+def max_rss_kib(who: int) -> int:
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run_child(pipeline: str, count: int, base_url: str, jobs: int, result_file: str):
+    stages = StageTimes()
+    library = os.path.join(os.path.expanduser("~"), "library")
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    error = None
+    checked = 0
+    try:
+        RUNNERS[pipeline](base_url, count, jobs, library, stages)
+    except BaseException as e:
+        # Cryptogram2Calibre.run exits on failures
+        error = f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - start
+    if not error:
+        try:
+            checked = check_outputs(os.path.expanduser("~"))
+        except (OSError, RuntimeError, zipfile.BadZipFile) as e:
+            error = f"{type(e).__name__}: {e}"
+    result = {
+        "pipeline": pipeline,
+        "batch": count,
+        "jobs": jobs,
+        "wall": wall,
+        "cpu": time.process_time() - cpu_start,
+        "throughput_per_min": count * 60 / wall,
+        "peak_rss_kib": max_rss_kib(resource.RUSAGE_SELF),
+        "children_peak_rss_kib": max_rss_kib(resource.RUSAGE_CHILDREN),
+        "stages": stages.summary(),
+        "checked_outputs": checked,
+        "error": error,
+    }
+    with open(result_file, "w") as f:
+        json.dump(result, f)
+
+
+################################################################################
+##### Runs and comparisons
+################################################################################
+
+
+def git_version() -> str:
+    try:
+        res = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=DIR_BENCH,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return "unknown"
+    return res.stdout.strip() or "unknown"
+
+
+def run_batch(
+    pipeline: str, count: int, base_url: str, jobs: int, tools: str
+) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="calibre-utils-bench-") as dir_home:
+        env = dict(os.environ, HOME=dir_home)
+        if tools == "stub":
+            env["PATH"] = DIR_STUBS + os.pathsep + env.get("PATH", "")
+        result_file = os.path.join(dir_home, "result.json")
+        cmd = [sys.executable, os.path.abspath(__file__), "child"]
+        cmd += [pipeline, str(count), base_url, str(jobs), result_file]
+        # The working directory is empty, so nothing is published to
+        # the bernardi.cloud repository
+        with open(os.path.join(DIR_BENCH, "bench.log"), "ab") as log:
+            subprocess.run(cmd, cwd=dir_home, env=env, stdout=log, stderr=log)
+        with open(result_file) as f:
+            return json.load(f)
+
+
+def run(args: argparse.Namespace):
+    if args.tools == "real":
+        missing = [tool for tool in CALIBRE_TOOLS if not shutil.which(tool)]
+        if missing:
+            print("Missing Calibre tools: " + ", ".join(missing))
+            sys.exit(1)
+    server, base_url = start_fixture_site()
+    results = []
+    try:
+        for pipeline in args.pipelines:
+            for count in args.batches:
+                result = run_batch(pipeline, count, base_url, args.jobs, args.tools)
+                results.append(result)
+                status = result["error"] or "ok"
+                print(
+                    f"{pipeline:<11} {count:>4} items  {result['wall']:8.2f} s  "
+                    f"{result['throughput_per_min']:8.1f}/min  "
+                    f"{result['peak_rss_kib'] // 1024:5d} MiB  {status}"
+                )
+    finally:
+        server.shutdown()
+    report = {
+        "version": git_version(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "tools": args.tools,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        DIR_RESULTS, f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{report['version']}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"\nResults saved in {output}")
+
+
+def compare(args: argparse.Namespace):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{old['version']} ({old['tools']}) -> {new['version']} ({new['tools']})\n")
+    old_results = {(r["pipeline"], r["batch"]): r for r in old["results"]}
+    regressions = 0
+
+    def line(label: str, before: float, after: float, higher_is_better: bool = False):
+        nonlocal regressions
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        flag = ""
+        # Stages taking a few milliseconds are mostly noise
+        noise = label.endswith("(s)") and abs(after - before) < args.min_seconds
+        if worse > args.threshold and not noise:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"  {label:<24} {before:12.3f} {after:12.3f} {change:+8.1%}{flag}")
+
+    for result in new["results"]:
+        before = old_results.get((result["pipeline"], result["batch"]))
+        if not before:
+            continue
+        print(f"{result['pipeline']}, {result['batch']} items")
+        line("wall (s)", before["wall"], result["wall"])
+        line(
+            "throughput (/min)",
+            before["throughput_per_min"],
+            result["throughput_per_min"],
+            True,
+        )
+        line(
+            "peak RSS (MiB)",
+            before["peak_rss_kib"] / 1024,
+            result["peak_rss_kib"] / 1024,
+        )
+        for stage, times in result["stages"].items():
+            if stage in before["stages"]:
+                line(
+                    f"{stage} mean (s)", before["stages"][stage]["mean"], times["mean"]
+                )
+        print()
+    if regressions:
+        print(f"{regressions} regressions over {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the conversion pipelines")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "-p", "--pipelines", nargs="+", choices=PIPELINES, default=PIPELINES
+    )
+    run_parser.add_argument("-b", "--batches", nargs="+", type=int, default=BATCHES)
+    run_parser.add_argument(
+        "-t",
+        "--tools",
+        choices=["stub", "real"],
+        default="stub",
+        help="stand-ins or the installed Calibre tools",
+    )
+    run_parser.add_argument(
+        "-j", "--jobs", type=int, default=4, help="items processed at the same time"
+    )
+    run_parser.add_argument("-o", "--output", help="JSON results file")
+    compare_parser = subparsers.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="tolerated slowdown (0.1 = 10%%)"
+    )
+    compare_parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.02,
+        help="smallest slowdown in seconds that counts as a regression",
+    )
+    child_parser = subparsers.add_parser("child")
+    child_parser.add_argument("pipeline", choices=PIPELINES)
+    child_parser.add_argument("count", type=int)
+    child_parser.add_argument("base_url")
+    child_parser.add_argument("jobs", type=int)
+    child_parser.add_argument("result_file")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        compare(args)
+    else:
+        run_child(args.pipeline, args.count, args.base_url, args.jobs, args.result_file)
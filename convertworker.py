@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Warm conversion workers: each ebook-convert or ebook-meta call starts a new
+# Calibre interpreter, with seconds of imports. A worker is started once with
+# calibre-debug, loads Calibre's conversion and metadata code and runs the
+# commands it receives as JSON lines on its standard input, replying with
+# the exit code and the output of each one. ConversionPool keeps a few
+# workers for the batch runs, and falls back to the command line tools when
+# calibre-debug is missing.
+#
+# The shell scripts run their Calibre commands in a single worker:
+#
+#   python3 convertworker.py exec ebook-convert pippo.zip pippo.mobi ::: \
+#       ebook-meta pippo.mobi --title=Pippo
+#
+# Calibre
+#
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+from typing import Any, Callable, Dict, IO, List, Optional, Sequence, Tuple
+
+from tracing import NullTracer, Tracer
+
+COMMAND_SEPARATOR = ":::"
+TOOLS = ("ebook-convert", "ebook-meta")
+# Workers are replaced after this many jobs, in case Calibre leaks memory
+DEFAULT_MAX_JOBS = 50
+
+
+class WorkerError(Exception):
+    pass
+
+
+def load_tool(tool: str) -> Callable[[List[str]], Any]:
+    # Only importable inside calibre-debug
+    if tool == "ebook-convert":
+        from calibre.ebooks.conversion.cli import main
+    elif tool == "ebook-meta":
+        from calibre.ebooks.metadata.cli import main
+    else:
+        raise WorkerError(f"Unknown tool {tool}")
+    return main
+
+
+def run_tool(main: Callable[[List[str]], Any], tool: str, args: List[str]) -> int:
+    # The command line mains either return the exit code or call sys.exit()
+    try:
+        result = main([tool] + args)
+    except SystemExit as e:
+        result = e.code
+        if isinstance(result, str):
+            print(result)
+            result = 1
+    return result if isinstance(result, int) else 0
+
+
+def serve():
+    # The replies go to the original standard output; whatever Calibre
+    # prints while running a job is captured and sent back with the reply
+    replies = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    mains: Dict[str, Callable[[List[str]], Any]] = {}
+    for line in sys.stdin:
+        job = json.loads(line)
+        with tempfile.TemporaryFile() as capture:
+            sys.stdout.flush()
+            saved_stdout = os.dup(1)
+            os.dup2(capture.fileno(), 1)
+            cwd = os.getcwd()
+            try:
+                os.chdir(job["cwd"])
+                tool = job["tool"]
+                if tool not in mains:
+                    mains[tool] = load_tool(tool)
+                returncode = run_tool(mains[tool], tool, job["args"])
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                returncode = 1
+            finally:
+                sys.stdout.flush()
+                os.dup2(saved_stdout, 1)
+                os.close(saved_stdout)
+                os.chdir(cwd)
+            capture.seek(0)
+            output = capture.read().decode("utf-8", "replace")
+        replies.write(json.dumps({"returncode": returncode, "output": output}) + "\n")
+        replies.flush()
+
+
+class ConversionWorker:
+
+    proc: subprocess.Popen
+    jobs: int
+
+    def __init__(self, cmd_calibre_debug: str):
+        self.proc = subprocess.Popen(
+            [cmd_calibre_debug, "-e", os.path.abspath(__file__), "--", "serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+        )
+        self.jobs = 0
+
+    def run(self, tool: str, args: List[str]) -> Tuple[int, str]:
+        stdin: IO[str] = self.proc.stdin  # type: ignore
+        stdout: IO[str] = self.proc.stdout  # type: ignore
+        job = {"tool": tool, "args": args, "cwd": os.getcwd()}
+        try:
+            stdin.write(json.dumps(job) + "\n")
+            stdin.flush()
+            line = stdout.readline()
+        except OSError as e:
+            raise WorkerError(f"Conversion worker failed: {e}")
+        if not line:
+            raise WorkerError(f"Conversion worker exited with {self.proc.wait()}")
+        self.jobs += 1
+        try:
+            reply = json.loads(line)
+            return reply["returncode"], reply["output"]
+        except (KeyError, TypeError, ValueError):
+            # e.g. a warning printed by Calibre, or a truncated line
+            raise WorkerError(f"Unexpected reply from the conversion worker: {line!r}")
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def close(self):
+        if self.proc.stdin:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class ConversionPool:
+
+    cmd_calibre_debug: Optional[str]
+    max_jobs: int
+    tracer: Tracer
+    idle: List[ConversionWorker]
+    lock: threading.Lock
+    slots: threading.Semaphore
+
+    def __init__(
+        self,
+        size: int = 1,
+        tracer: Optional[Tracer] = None,
+        max_jobs: int = DEFAULT_MAX_JOBS,
+    ):
+        self.cmd_calibre_debug = shutil.which("calibre-debug")
+        self.max_jobs = max_jobs
+        self.tracer = tracer or NullTracer()
+        self.idle = []
+        self.lock = threading.Lock()
+        # At most size workers, started when first needed
+        self.slots = threading.Semaphore(size)
+
+    def acquire(self) -> ConversionWorker:
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        try:
+            return ConversionWorker(self.cmd_calibre_debug or "calibre-debug")
+        except OSError as e:
+            self.slots.release()
+            raise WorkerError(f"Cannot start calibre-debug: {e}")
+
+    def release(self, worker: ConversionWorker, broken: bool = False):
+        if broken or worker.jobs >= self.max_jobs or not worker.alive():
+            worker.close()
+        else:
+            with self.lock:
+                self.idle.append(worker)
+        self.slots.release()
+
+    def run(
+        self,
+        tool: str,
+        args: List[str],
+        label: str = "",
+        inputs: Sequence[str] = (),
+        outputs: Sequence[str] = (),
+        capture_output: bool = False,
+    ) -> subprocess.CompletedProcess:
+        # Same interface as Tracer.run(), with the tool name as the stage
+        if not self.cmd_calibre_debug:
+            return self.tracer.run(
+                [tool] + args, tool, label, inputs, outputs, capture_output
+            )
+        with self.tracer.stage(tool, label, inputs, outputs) as record:
+            worker = self.acquire()
+            try:
+                returncode, output = worker.run(tool, args)
+            except WorkerError:
+                self.release(worker, broken=True)
+                raise
+            self.release(worker)
+            if returncode != 0:
+                record.status = f"exit {returncode}"
+        if not capture_output:
+            print(output, end="")
+        return subprocess.CompletedProcess(
+            [tool] + args, returncode, output if capture_output else None
+        )
+
+    def close(self):
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.close()
+
+    def __enter__(self) -> "ConversionPool":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def split_commands(args: List[str]) -> List[List[str]]:
+    commands: List[List[str]] = [[]]
+    for arg in args:
+        if arg == COMMAND_SEPARATOR:
+            commands.append([])
+        else:
+            commands[-1].append(arg)
+    return [command for command in commands if command]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm Calibre conversion worker")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("serve", help="run jobs from stdin (under calibre-debug)")
+    exec_parser = subparsers.add_parser(
+        "exec", help=f"run commands separated by {COMMAND_SEPARATOR} in one worker"
+    )
+    exec_parser.add_argument("args", nargs=argparse.REMAINDER)
+    # calibre-debug may pass on the "--" that ends its own options
+    argv = sys.argv[1:]
+    args = parser.parse_args(argv[1:] if argv[:1] == ["--"] else argv)
+    if args.command == "serve":
+        serve()
+        sys.exit(0)
+    commands = split_commands(args.args)
+    if not commands:
+        parser.error("no command to run")
+    for command in commands:
+        if command[0] not in TOOLS:
+            parser.error(f"{command[0]} is not one of {', '.join(TOOLS)}")
+    with ConversionPool() as pool:
+        for command in commands:
+            try:
+                res = pool.run(command[0], command[1:])
+            except WorkerError as e:
+                print(e)
+                sys.exit(1)
+            if res.returncode != 0:
+                sys.exit(res.returncode)
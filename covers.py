@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Render e-book covers from the *-cover-template.jpg files: a framed
+# template with the title underneath, at the 590x754 geometry that fits
+# the e-reader screen. It's the same result of the old
+# "montage -label ... -frame 3" + "mogrify -resize 590x754!" pair, but
+# without spawning ImageMagick for every cover.
+#
+# Pillow
+#
+
+import argparse
+import functools
+import hashlib
+import os
+import threading
+from typing import Dict, Tuple, Union
+
+from PIL import Image, ImageDraw, ImageFont
+
+COVER_WIDTH = 590
+COVER_HEIGHT = 754
+
+FRAME = 3
+FRAME_COLOR = (189, 189, 189)
+FRAME_LIGHT = (231, 231, 231)
+FRAME_DARK = (120, 120, 120)
+
+FONT_CANDIDATES = [
+    "DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "LiberationSans-Regular.ttf",
+    "Arial.ttf",
+    "arial.ttf",
+    "Helvetica.ttc",
+]
+
+dir_script = os.path.dirname(os.path.abspath(__file__))
+
+
+def template_path(template: str) -> str:
+    # Either a path or the name of one of the bundled templates
+    if os.path.isfile(template):
+        return template
+    return os.path.join(dir_script, f"{template}-cover-template.jpg")
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(size: int) -> Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]:
+    for candidate in FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            pass
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow < 10.1 has no scalable default font
+        return ImageFont.load_default()
+
+
+class CoverRenderer:
+
+    dir_cache: str
+    bases: Dict[str, Tuple[Image.Image, int, int]]
+    lock: threading.Lock
+
+    def __init__(self, dir_cache: str = ""):
+        self.dir_cache = dir_cache or os.path.join(
+            os.path.expanduser("~"), ".cache", "calibre-utils", "covers"
+        )
+        self.bases = {}
+        self.lock = threading.Lock()
+
+    def frame_template(self, template: Image.Image, pointsize: int) -> Image.Image:
+        width, height = template.size
+        label_height = int(pointsize * 1.5)
+        canvas = Image.new(
+            "RGB", (width + 2 * FRAME, height + 2 * FRAME + label_height), "white"
+        )
+        canvas.paste(template, (FRAME, FRAME))
+        draw = ImageDraw.Draw(canvas)
+        right = width + 2 * FRAME - 1
+        bottom = height + 2 * FRAME - 1
+        for i in range(FRAME):
+            # Raised frame: light on the top/left sides, dark on the others
+            color = FRAME_LIGHT if i == 0 else FRAME_COLOR
+            draw.line([(i, bottom - i), (i, i), (right - i, i)], fill=color)
+            color = FRAME_DARK if i == 0 else FRAME_COLOR
+            draw.line(
+                [(i + 1, bottom - i), (right - i, bottom - i), (right - i, i + 1)],
+                fill=color,
+            )
+        return canvas
+
+    def get_base(
+        self, template: str, pointsize: int, width: int, height: int
+    ) -> Tuple[Image.Image, int, int]:
+        # The base is the framed template already resized to the final
+        # geometry, with an empty label area: it's decoded and resized only
+        # once per template, then kept in memory and on disk
+        path = template_path(template)
+        key = f"{path}-{pointsize}-{width}x{height}"
+        with self.lock:
+            if key in self.bases:
+                return self.bases[key]
+            with open(path, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            cache_file = os.path.join(
+                self.dir_cache, f"{digest}-{pointsize}-{width}x{height}.png"
+            )
+            base: Image.Image
+            with Image.open(path) as img:
+                template_height = img.height
+                if os.path.exists(cache_file):
+                    base = Image.open(cache_file)
+                    base.load()
+                else:
+                    framed = self.frame_template(img.convert("RGB"), pointsize)
+                    base = framed.resize((width, height), Image.Resampling.LANCZOS)
+                    os.makedirs(self.dir_cache, exist_ok=True)
+                    # Other processes may be reading the cache
+                    tmp = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    base.save(tmp, "PNG")
+                    os.replace(tmp, cache_file)
+            scale = height / (template_height + 2 * FRAME + int(pointsize * 1.5))
+            label_top = int((template_height + 2 * FRAME) * scale)
+            font_size = max(1, int(pointsize * scale))
+            self.bases[key] = (base, label_top, font_size)
+            return self.bases[key]
+
+    def render(
+        self,
+        template: str,
+        title: str,
+        outfile: str,
+        pointsize: int = 21,
+        width: int = COVER_WIDTH,
+        height: int = COVER_HEIGHT,
+    ):
+        base, label_top, font_size = self.get_base(template, pointsize, width, height)
+        cover = base.copy()
+        draw = ImageDraw.Draw(cover)
+        # Long titles are shrunk until they fit the cover width
+        while True:
+            font = load_font(font_size)
+            left, top, right, bottom = draw.textbbox((0, 0), title, font=font)
+            if right - left <= width - 2 * FRAME or font_size <= 6:
+                break
+            font_size -= 1
+        x = (width - (right - left)) // 2 - left
+        y = label_top + (height - label_top - (bottom - top)) // 2 - top
+        draw.text((x, y), title, fill="black", font=font)
+        cover.save(outfile, quality=90)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render an e-book cover")
+    parser.add_argument(
+        "-t",
+        "--template",
+        default="webpage",
+        help="template name (cryptogram, webpage, wikipedia) or image path",
+    )
+    parser.add_argument("-l", "--label", required=True, help="cover title")
+    parser.add_argument("-p", "--pointsize", type=int, default=24)
+    parser.add_argument("outfile")
+    args = parser.parse_args()
+    CoverRenderer().render(args.template, args.label, args.outfile, args.pointsize)
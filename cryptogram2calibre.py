@@ -3,360 +3,506 @@
 # Download the current month's Crypto-Gram issue, import it in my
 # Calibre library and publish it on my website.
 #
-# ImageMagick, Calibre
+# Calibre, Pillow
 #
 
-import codecs
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import glob
 import locale
 import os
-import re
-import shutil
-import subprocess
 import sys
+import threading
 from typing import List, Optional
-import zipfile
-
-from lxml import etree, html
-import requests
 
+from lxml import html
+
+from convertworker import ConversionPool, WorkerError
+from covers import CoverRenderer, template_path
+from epub import BookMetadata, EpubBuilder
+from external import ExternalCommand
+from extract import drop_unreferenced, extract_content
+from fetcher import PageFetcher
+from httpcache import HttpCache
+from images import ImageOptimizer
+from importindex import ImportIndex
+from library import CalibreLibrary, LibraryError
+from publisher import HugoPublisher, PublishError, PublishedIssue, find_site
+from stagecache import (
+    StageCache,
+    bytes_digest,
+    code_version,
+    file_digest,
+    files_digest,
+    tool_version,
+)
+from tracing import NullTracer, Tracer
+from transforms import DocumentPipeline, TransformContext, TransformError
+from zipwriter import ZipWriter
+
+
+def parse_month(value: str) -> datetime.datetime:
+    # Crypto-Gram issues are published on the 15th of each month
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m").replace(day=15)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a YYYY-MM month")
 
-# Since lately I'm more and more unable to keep up with
-# the monthly schedule I've decided to parametrize the
-# current date, so as to make late runs easier
-now = datetime.datetime.now()
-current_month = now.month
-month = int(input(f"Month (1-12, default {current_month}): ") or current_month)
-now = now.replace(month=month)
 
+def month_range(
+    first: datetime.datetime, last: datetime.datetime
+) -> List[datetime.datetime]:
+    months = []
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        months.append(datetime.datetime(year, month, 15))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
 
-def zipdir(path, ziph):
-    # Thanks to https://stackoverflow.com/a/1855118
-    for root, _, files in os.walk(path):
-        for file in files:
-            ziph.write(
-                os.path.join(root, file),
-                os.path.relpath(os.path.join(root, file), path),
-            )
 
+class ConversionError(Exception):
+    pass
 
-class ExternalCommand:
 
-    init_errors: List[str]
-
-    def __init__(self):
-        self.init_errors = []
+class Calibre(ExternalCommand):
 
-    def add_init_error(self, error: str):
-        self.init_errors.append(error)
+    cmd_ebook_convert: str
+    pool: ConversionPool
 
-    def get_init_errors(self) -> List[str]:
-        return self.init_errors
+    def __init__(self, tracer: Optional[Tracer] = None, workers: int = 1):
+        super().__init__(tracer)
+        self.cmd_ebook_convert = self.which("ebook-convert")
+        if self.get_init_errors():
+            self.add_init_error("Please install Calibre")
+        # Warm Calibre interpreters, instead of one per conversion
+        self.pool = ConversionPool(workers, self.tracer)
 
-    def which(self, exe: str, ignore_errors: bool = False):
-        res = shutil.which(exe)
-        if not res and not ignore_errors:
-            self.init_errors.append(f"{exe} not found")
-        return res
+    def zip_to_mobi(
+        self, zip_file: str, cover_file: str, mobi_file: str, metadata: BookMetadata
+    ):
+        # The metadata is set at conversion time, no ebook-meta needed
+        try:
+            res = self.pool.run(
+                "ebook-convert",
+                [
+                    zip_file,
+                    mobi_file,
+                    "--no-inline-toc",
+                    "--cover=" + cover_file,
+                    "--title=" + metadata.title,
+                    "--authors=" + " & ".join(metadata.authors),
+                    "--author-sort=" + metadata.author_sort,
+                    "--tags=" + ",".join(metadata.tags),
+                ],
+                metadata.title,
+                inputs=[zip_file, cover_file],
+                outputs=[mobi_file],
+            )
+        except WorkerError as e:
+            raise ConversionError(str(e))
+        if res.returncode != 0:
+            raise ConversionError(f"ebook-convert exited with {res.returncode}")
 
 
-class ImageMagick(ExternalCommand):
+class Issue:
 
-    cmd_montage: List[str]
-    cmd_mogrify: List[str]
+    date: datetime.datetime
+    title: str
+    dir_tmp: str
+    url: Optional[str]
+    content_hash: Optional[str]
 
-    def __init__(self):
-        super().__init__()
-        magick = self.which("magick", ignore_errors=True)
-        if magick:
-            self.cmd_montage = [magick, "montage"]
-            self.cmd_mogrify = [magick, "mogrify"]
-        else:
-            self.cmd_montage = [self.which("montage")]
-            self.cmd_mogrify = [self.which("mogrify")]
-        if self.get_init_errors():
-            self.add_init_error("Please install ImageMagick")
-
-    def create_cover(self, title: str, outfile: str):
-        dir_script = os.path.dirname(os.path.abspath(__file__))
-        cover_template = os.path.join(dir_script, "cryptogram-cover-template.jpg")
-        subprocess.run(
-            self.cmd_montage
-            + [
-                "-label",
-                title,
-                cover_template,
-                "-geometry",
-                "+0+0",
-                "-pointsize",
-                "21",
-                "-frame",
-                "3",
-                outfile,
-            ]
-        )
-        subprocess.run(self.cmd_mogrify + ["-resize", "590x754!", "outfile"])
+    def __init__(self, date: datetime.datetime, dir_work: str):
+        self.date = date
+        self.url = None
+        self.content_hash = None
+        date_str = date.strftime("%B %Y")
+        self.title = f"Crypto-Gram - {date_str} issue"
+        # Each issue gets its own work directory, so that several
+        # issues can be processed at the same time
+        self.dir_tmp = os.path.join(dir_work, date.strftime("%Y-%m"))
 
+    def __str__(self) -> str:
+        return self.date.strftime("%Y-%m")
 
-class Calibre(ExternalCommand):
+    def prepare(self):
+        # Every file in here is rewritten (or copied from the stage cache),
+        # so there's no need to wipe the results of a previous run
+        os.makedirs(self.dir_tmp, exist_ok=True)
 
-    cmd_calibredb: str
-    cmd_ebook_convert: str
-    cmd_ebook_meta: str
-    cmd_web2disk: str
-    dir_tmp: str
-    dir_html: str
-
-    def __init__(self):
-        super().__init__()
-        dir_home = os.path.expanduser("~")
-        self.dir_tmp = os.path.join(dir_home, ".cryptogram2calibre")
-        self.dir_html = os.path.join(self.dir_tmp, "html")
-        if os.path.exists(self.dir_tmp):
-            shutil.rmtree(self.dir_tmp)
-        os.makedirs(self.dir_html)
-        self.cmd_calibredb = self.which("calibredb")
-        self.cmd_ebook_convert = self.which("ebook-convert")
-        self.cmd_ebook_meta = self.which("ebook-meta")
-        self.cmd_web2disk = self.which("web2disk")
-        if self.get_init_errors():
-            self.add_init_error("Please install Calibre")
+    def path(self, file_name: str) -> str:
+        return os.path.join(self.dir_tmp, file_name)
 
-    def web2disk(self, url: str):
-        subprocess.run(
-            [self.cmd_web2disk, "-d", self.dir_html, "-r", "0", "--verbose", url]
-        )
 
-    def get_index_xhtml(self) -> Optional[str]:
-        candidates = glob.glob(os.path.join(self.dir_html, "*.xhtml"))
-        if not candidates:
-            return None
-        return candidates[0]
+class SchneierDotCom:
 
-    def zip_to_mobi_and_epub(
-        self, zip_file: str, cover_file: str, mobi_file: str, epub_file: str
-    ):
-        subprocess.run(
-            [
-                self.cmd_ebook_convert,
-                zip_file,
-                mobi_file,
-                "--no-inline-toc",
-                "--cover=" + cover_file,
-            ]
-        )
-        subprocess.run(
-            [
-                self.cmd_ebook_convert,
-                mobi_file,
-                epub_file,
-                "--preserve-cover-aspect-ratio",
-                "--dont-split-on-page-breaks",
-                "--cover=" + cover_file,
-            ]
-        )
+    http_cache: HttpCache
+    index_urls: List[str]
+    archive_urls: List[str]
+    archive_lock: threading.Lock
+    archive_pages_read: int
 
-    def set_ebook_meta(
-        self,
-        ebook_file: str,
-        cover_file: str,
-        title: str,
-        authors: str,
-        authors_sort: str,
-        tags: str,
+    def __init__(
+        self, http_cache: HttpCache, base_url: str = "https://www.schneier.com"
     ):
-        cmd = [
-            self.cmd_ebook_meta,
-            ebook_file,
-            f"--cover={cover_file}",
-            f"--authors={authors}",
-            f"--author-sort={authors_sort}",
-            f"--tags={tags}",
+        self.http_cache = http_cache
+        # The front page only lists the latest issues, the older
+        # ones are in the archive page
+        self.index_urls = [
+            f"{base_url}/crypto-gram/",
+            f"{base_url}/crypto-gram/archives/",
         ]
-        subprocess.run(cmd)
-
-    def get_calibre_id(self, title: str):
-        cmd = ["calibredb", "list", "--search", f"title:{title}"]
-        res = subprocess.run(cmd, capture_output=True)
-        output = res.stdout.decode("utf-8")
-        book_ids = re.findall(r"^\d+", output, re.MULTILINE)
-        if book_ids:
-            return book_ids[0]
-        else:
-            return None
-
-    def add_to_calibre(self, book_id: Optional[str], ebook_file: str):
-        cmd = [self.cmd_calibredb]
-        if book_id:
-            cmd += ["add_format", book_id]
-        else:
-            cmd.append("add")
-        cmd.append(ebook_file)
-        subprocess.run(cmd)
+        self.archive_urls = []
+        self.archive_lock = threading.Lock()
+        self.archive_pages_read = 0
 
-
-class SchneierDotCom:
-    def get_latest_issue_url(self) -> Optional[str]:
-        page = requests.get("https://www.schneier.com/crypto-gram/")
-        tree = html.fromstring(page.content)
-        archive_as = tree.xpath(
-            "//a[contains(@href, 'https://www.schneier.com/crypto-gram/archives/')]"
-        )
-        if not archive_as:
-            return None
-        archive_url = archive_as[(current_month - month) * 2].attrib["href"]
-        print("   DEBUG: ---------> ARCHIVE_URL", archive_url)
-        print("\n".join(["   DEBUG: " + a.attrib["href"] for a in archive_as]))
-        return archive_url
-
-    def declutterize(self, title: str, index_xhtml: str) -> bool:
-        with codecs.open(index_xhtml, "r", "utf-8") as f:
-            content = f.read()
-        tree = html.fromstring(content)
-        article_list = tree.xpath("//article")
-        if not article_list:
+    def read_next_index_page(self) -> bool:
+        if self.archive_pages_read >= len(self.index_urls):
             return False
-        article = article_list[0]
-        article_str = etree.tostring(article).decode("utf-8")
-        content_str = f"""<html>
-<head>
-<title>{title}</title>
-</head>
-<body>
-<h1>Crypto-Gram</h1>
-{article_str}
-</body>
-</html>"""
-        with codecs.open(index_xhtml, "w", "utf-8") as f:
-            f.write(content_str)
+        page = self.http_cache.get(self.index_urls[self.archive_pages_read])
+        self.archive_pages_read += 1
+        tree = html.fromstring(page.content)
+        for a in tree.xpath("//a[contains(@href, '/crypto-gram/archives/')]"):
+            self.archive_urls.append(a.attrib["href"])
         return True
 
+    def get_issue_url(self, date: datetime.datetime) -> Optional[str]:
+        # Issue URLs are like https://www.schneier.com/crypto-gram/archives/2020/0515.html
+        issue_path = "/crypto-gram/archives/" + date.strftime("%Y/%m")
+        with self.archive_lock:
+            while True:
+                for url in self.archive_urls:
+                    if issue_path in url:
+                        return url
+                if not self.read_next_index_page():
+                    return None
+
+    def declutterize(self, title: str, url: str, content: bytes) -> Optional[bytes]:
+        # The schneier.com site rule keeps the <article>
+        context = TransformContext(title=title, heading="Crypto-Gram", url=url)
+        try:
+            return DocumentPipeline(["extract-article"], context).apply(content)
+        except TransformError:
+            return None
+
 
 class BernardiDotCloud:
-    def publish_crypto_gram(self, epub_file: str, mobi_file: str):
+    def publish_crypto_grams(self, issues: List[PublishedIssue]):
         print("\n\n")
-        # I assume that Calibre-Utils is in the github directory,
-        # which is on the same level as the bernardi.cloud repo
-        dir_base = os.path.join("..", "bernardi.cloud")
-        if not os.path.exists(dir_base):
-            print(
-                f"The directory {dir_base} doesn't exist..."
-            )
-            dir_base = os.path.join("..", "..", "bernardi.cloud")
-            if not os.path.exists(dir_base):
-                print(
-                    f"The directory {dir_base} doesn't exist, I will not updated the bernardi.cloud website"
-                )
-                return
-        # Generate the Hugo post template
-        yyyy = now.strftime("%Y")
-        mm = now.strftime("%m")
-        dd = now.strftime("%d")
-        month = now.strftime("%B")
-        month_lower = month.lower()
-        dir_script = os.path.dirname(os.path.abspath(__file__))
-        path_template = os.path.join(dir_script, "hugo-template.md")
-        with codecs.open(path_template, "r", "utf-8") as f:
-            template = f.read()
-        template = template.replace("_YYYY_", yyyy)
-        template = template.replace("_MM_", mm)
-        template = template.replace("_DD_", dd)
-        template = template.replace("_MONTH_", month)
-        template = template.replace("_month_", month_lower)
-        dir_article = os.path.join(dir_base, "content", "crypto-gram-for-e-readers")
-        file_article = f"{yyyy}-{mm}-{dd}-crypto-gram-{month_lower}-{yyyy}-in-epub-and-mobi-format.md"
-        path_article = os.path.join(dir_article, file_article)
-        with codecs.open(path_article, "w", "utf-8") as f:
-            f.write(template)
-        # Copy the EPUB and MOBI files to the website repository
-        dir_static = os.path.join(dir_base, "static", "cryptogram")
-        shutil.copyfile(epub_file, os.path.join(dir_static, "cryptogram-last.epub"))
-        shutil.copyfile(mobi_file, os.path.join(dir_static, "cryptogram-last.mobi"))
-        shutil.copyfile(
-            epub_file, os.path.join(dir_static, f"cryptogram-{yyyy}-{mm}.epub")
-        )
-        shutil.copyfile(
-            mobi_file, os.path.join(dir_static, f"cryptogram-{yyyy}-{mm}.mobi")
-        )
-        print(f"BERNARDI:CLOUD: new article created as {path_article}")
-        print("Remember to publish it!\n\n")
+        dir_base = find_site()
+        if not dir_base:
+            print("I will not update the bernardi.cloud website")
+            return
+        # Only the new or changed files and posts are written
+        try:
+            written = HugoPublisher(dir_base).publish(issues)
+        except (OSError, PublishError) as e:
+            print(f"BERNARDI:CLOUD: {e}")
+            return
+        for path in written:
+            print(f"BERNARDI:CLOUD: {path} written")
+        if written:
+            print("Remember to publish it!\n\n")
 
 
 class Cryptogram2Calibre:
 
     bernardi_dot_cloud: BernardiDotCloud
     calibre: Calibre
-    magick: ImageMagick
+    covers: CoverRenderer
+    fetcher: PageFetcher
+    http_cache: HttpCache
+    image_optimizer: ImageOptimizer
+    index: ImportIndex
+    library: CalibreLibrary
     schneier_dot_com: SchneierDotCom
-
-    def __init__(self):
+    stage_cache: StageCache
+    tracer: Tracer
+    jobs: int
+    force: bool
+    dir_work: str
+
+    def __init__(
+        self, jobs: int = 1, tracer: Optional[Tracer] = None, force: bool = False
+    ):
+        self.tracer = tracer or NullTracer()
         self.bernardi_dot_cloud = BernardiDotCloud()
-        self.calibre = Calibre()
-        self.magick = ImageMagick()
-        self.schneier_dot_com = SchneierDotCom()
-        init_errors = self.calibre.get_init_errors() + self.magick.get_init_errors()
+        self.calibre = Calibre(self.tracer, jobs)
+        self.covers = CoverRenderer()
+        self.index = ImportIndex()
+        self.library = CalibreLibrary(tracer=self.tracer, index=self.index)
+        self.http_cache = HttpCache()
+        self.stage_cache = StageCache()
+        # The images are scaled down to the Sony Reader screen, like the covers
+        self.image_optimizer = ImageOptimizer(cache=self.stage_cache)
+        self.fetcher = PageFetcher(
+            self.http_cache, image_optimizer=self.image_optimizer
+        )
+        self.schneier_dot_com = SchneierDotCom(self.http_cache)
+        init_errors = self.calibre.get_init_errors() + self.library.get_init_errors()
         if init_errors:
             print("\n".join(init_errors))
             sys.exit(1)
+        self.jobs = jobs
+        self.force = force
+        self.dir_work = os.path.join(os.path.expanduser("~"), ".cryptogram2calibre")
+
+    def convert(self, issue: Issue) -> bool:
+        # A failed issue doesn't stop the others of the batch
+        try:
+            return self.convert_issue(issue)
+        except Exception as e:
+            print(f"{issue}: conversion error: {e}")
+            return False
 
-    def run(self):
-        date_str = now.strftime("%B %Y")
-        title = f"Crypto-Gram - {date_str} issue"
-        # Get the URL of the latest Crypto-Gram issue
-        latest_issue_url = self.schneier_dot_com.get_latest_issue_url()
-        if not latest_issue_url:
-            print("Cannot find the URL of the latest Crypto-Gram issue")
-            sys.exit(1)
-        # Download the web page
-        self.calibre.web2disk(latest_issue_url)
+    def convert_issue(self, issue: Issue) -> bool:
+        issue.prepare()
+        # Get the URL of the Crypto-Gram issue
+        issue_url = self.schneier_dot_com.get_issue_url(issue.date)
+        if not issue_url:
+            print(f"{issue}: cannot find the URL of the Crypto-Gram issue")
+            return False
+        issue.url = issue_url
+        # Every artifact comes from the stage cache when its inputs, and the
+        # code or tool that makes it, haven't changed since a previous run
+        label = str(issue)
+        cache = self.stage_cache
+        # Download the web page: not from the stage cache, since the issue
+        # may have changed upstream, but through the HTTP cache, which
+        # revalidates it
+        try:
+            with self.tracer.stage("fetch", label) as record:
+                print(f"{issue}: downloading {issue_url}")
+                files = self.fetcher.fetch_page(issue_url).files
+                record.bytes_in = sum(len(c) for c in files.values())
+            issue.content_hash = bytes_digest(files["index.xhtml"])
+            page_digest = files_digest(files)
+        except Exception as e:
+            print(f"{issue}: Crypto-Gram issue download error: {e}")
+            return False
         # Clean the web page
-        index_xhtml = self.calibre.get_index_xhtml()
+        declutter_key = cache.key(
+            "declutter",
+            bytes_digest(files["index.xhtml"]),
+            issue.title,
+            issue_url,
+            code_version(SchneierDotCom, DocumentPipeline, extract_content),
+        )
+        with self.tracer.stage("declutter", label) as record:
+            record.bytes_in = len(files["index.xhtml"])
+            index_xhtml = cache.get_bytes(declutter_key)
+            if index_xhtml is None:
+                index_xhtml = self.schneier_dot_com.declutterize(
+                    issue.title, issue_url, files["index.xhtml"]
+                )
+                if index_xhtml:
+                    cache.put_bytes(declutter_key, index_xhtml)
+            record.bytes_out = len(index_xhtml or b"")
         if not index_xhtml:
-            print("Crypto-Gram current issue download error")
-            sys.exit(1)
-        if not self.schneier_dot_com.declutterize(title, index_xhtml):
-            print(f'Could not find <div id="content"> in {index_xhtml}')
-            sys.exit(1)
-        # Create a ZIP bundle with the HTML page and its dependencies
-        pippo_zip = os.path.join(self.calibre.dir_tmp, "pippo.zip")
-        with zipfile.ZipFile(pippo_zip, "w", zipfile.ZIP_DEFLATED) as zipf:
-            zipdir(self.calibre.dir_html, zipf)
+            print(f"{issue}: could not find the content of {issue_url}")
+            return False
+        files["index.xhtml"] = index_xhtml
+        # The site's logos, icons and stylesheets aren't used anymore
+        drop_unreferenced(files)
+        # Create a ZIP bundle with the HTML page and its dependencies,
+        # straight from the downloaded buffers
+        pippo_zip = issue.path("pippo.zip")
+        zip_key = cache.key(
+            "zip",
+            page_digest,
+            declutter_key,
+            code_version(ZipWriter, drop_unreferenced),
+        )
+
+        def write_zip():
+            with ZipWriter(pippo_zip) as writer:
+                writer.add_files(files)
+
+        with self.tracer.stage("zip", label, outputs=[pippo_zip]):
+            cache.file_stage(zip_key, pippo_zip, write_zip)
         # Create the MOBI and EPUB versions of the newsletter
-        pippo_mobi = os.path.join(self.calibre.dir_tmp, "pippo.mobi")
-        pippo_epub = os.path.join(self.calibre.dir_tmp, "pippo.epub")
-        cover_file = os.path.join(self.calibre.dir_tmp, "cover.jpg")
-        self.magick.create_cover(title, cover_file)
-        self.calibre.zip_to_mobi_and_epub(pippo_zip, cover_file, pippo_mobi, pippo_epub)
-        self.calibre.set_ebook_meta(
-            pippo_epub,
-            cover_file,
-            title,
-            "Bruce Schneier",
-            "Schneier, Bruce",
-            "Crypto-Gram",
+        pippo_mobi = issue.path("pippo.mobi")
+        pippo_epub = issue.path("pippo.epub")
+        cover_file = issue.path("cover.jpg")
+        cover_key = cache.key(
+            "cover",
+            file_digest(template_path("cryptogram")),
+            issue.title,
+            "21",
+            code_version(CoverRenderer),
         )
-        self.calibre.set_ebook_meta(
-            pippo_mobi,
-            cover_file,
-            title,
-            "Bruce Schneier",
-            "Schneier, Bruce",
-            "Crypto-Gram",
+        with self.tracer.stage("cover", label, outputs=[cover_file]):
+            cache.file_stage(
+                cover_key,
+                cover_file,
+                lambda: self.covers.render(
+                    "cryptogram", issue.title, cover_file, pointsize=21
+                ),
+            )
+        metadata = BookMetadata(
+            title=issue.title,
+            authors=["Bruce Schneier"],
+            author_sort="Schneier, Bruce",
+            tags=["Crypto-Gram"],
+            source_url=issue_url,
         )
-        # Add the MOBI and EPUB files to Calibre
-        self.calibre.add_to_calibre(None, pippo_epub)
-        book_id = self.calibre.get_calibre_id(title)
-        if not book_id:
-            print("Error while adding the EPUB newsletter to Calibre")
-        self.calibre.add_to_calibre(book_id, pippo_mobi)
-        # Try to updated the bernardi.cloud Hugo repository
-        self.bernardi_dot_cloud.publish_crypto_gram(pippo_epub, pippo_mobi)
+        book_parts = [zip_key, cover_key, metadata.title, metadata.author_sort]
+        book_parts += metadata.authors + metadata.tags
+        mobi_key = cache.key(
+            "mobi", *book_parts, tool_version(self.calibre.cmd_ebook_convert)
+        )
+        epub_key = cache.key("epub", *book_parts, code_version(EpubBuilder))
+
+        def write_epub():
+            epub = EpubBuilder(metadata)
+            epub.add_files(files)
+            epub.set_cover(cover_file)
+            epub.write(pippo_epub)
+
+        # Only the Kindle format needs ebook-convert: the EPUB is
+        # packaged in-process while the MOBI conversion runs
+        try:
+            with self.tracer.stage(
+                "convert", label, outputs=[pippo_epub, pippo_mobi]
+            ), ThreadPoolExecutor(max_workers=1) as executor:
+                mobi = executor.submit(
+                    cache.file_stage,
+                    mobi_key,
+                    pippo_mobi,
+                    lambda: self.calibre.zip_to_mobi(
+                        pippo_zip, cover_file, pippo_mobi, metadata
+                    ),
+                )
+                with self.tracer.stage("epub", label, outputs=[pippo_epub]):
+                    cache.file_stage(epub_key, pippo_epub, write_epub)
+                mobi.result()
+        except ConversionError as e:
+            print(f"{issue}: MOBI conversion error: {e}")
+            return False
+        return True
+
+    def run(self, dates: List[datetime.datetime]):
+        issues = []
+        for date in dates:
+            issue = Issue(date, self.dir_work)
+            # The titles are known in advance, so the issues already in the
+            # library are skipped without any download
+            imported = None if self.force else self.index.find(title=issue.title)
+            if imported:
+                print(f"{issue}: already in the library as book {imported.book_id}")
+            else:
+                issues.append(issue)
+        # Download, declutter and conversion are independent for each issue
+        # and mostly spent waiting on the network and ebook-convert, so they are
+        # run in a bounded worker pool
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(self.convert, issues))
+        finally:
+            self.calibre.pool.close()
+        converted = [issue for issue, ok in zip(issues, results) if ok]
+        failed = [str(issue) for issue, ok in zip(issues, results) if not ok]
+        # Add the MOBI and EPUB files of all the issues to Calibre at once
+        for issue in converted:
+            self.library.add(
+                issue.title,
+                [issue.path("pippo.epub"), issue.path("pippo.mobi")],
+                source_url=issue.url,
+                content_hash=issue.content_hash,
+            )
+        try:
+            with self.tracer.stage("import"):
+                books = self.library.flush()
+            for book in books:
+                if not book.book_id:
+                    print(f"Error while adding {book.title} to Calibre")
+        except LibraryError as e:
+            print(e)
+            sys.exit(1)
+        # Try to updated the bernardi.cloud Hugo repository with the whole batch
+        with self.tracer.stage("publish"):
+            if converted:
+                self.bernardi_dot_cloud.publish_crypto_grams(
+                    [
+                        PublishedIssue(
+                            issue.date,
+                            {
+                                "epub": issue.path("pippo.epub"),
+                                "mobi": issue.path("pippo.mobi"),
+                            },
+                        )
+                        for issue in converted
+                    ]
+                )
+        # Only now the artifacts of this run aren't needed anymore (and gc
+        # keeps them anyway)
+        self.stage_cache.gc()
+        if failed:
+            print("Failed issues: " + ", ".join(failed))
+            sys.exit(1)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Import Crypto-Gram issues into Calibre"
+    )
+    parser.add_argument(
+        "--from",
+        dest="first",
+        type=parse_month,
+        metavar="YYYY-MM",
+        help="first issue of a non-interactive backfill",
+    )
+    parser.add_argument(
+        "--to",
+        dest="last",
+        type=parse_month,
+        metavar="YYYY-MM",
+        help="last issue of the backfill (default: current month)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of issues processed at the same time",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="append a JSON lines trace of every stage to FILE and print a summary",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="import the issues even if the import index has them already",
+    )
+    args = parser.parse_args()
+    if args.last and not args.first:
+        parser.error("--to requires --from")
+    return args
 
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
         locale.setlocale(category=locale.LC_ALL, locale="English")
     except:
         locale.setlocale(category=locale.LC_ALL, locale="en_US")
-    Cryptogram2Calibre().run()
+    now = datetime.datetime.now()
+    if args.first:
+        dates = month_range(args.first, args.last or now)
+    else:
+        # Since lately I'm more and more unable to keep up with
+        # the monthly schedule I've decided to parametrize the
+        # current date, so as to make late runs easier
+        current_month = now.month
+        month = int(input(f"Month (1-12, default {current_month}): ") or current_month)
+        dates = [now.replace(month=month)]
+    tracer = Tracer(args.trace) if args.trace else NullTracer()
+    try:
+        Cryptogram2Calibre(max(1, args.jobs), tracer, args.force).run(dates)
+    finally:
+        if args.trace:
+            print(tracer.summary())
+            tracer.close()
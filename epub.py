@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+#
+# Package (X)HTML documents and their resources straight into an EPUB,
+# with the OPF metadata and the cover written in-process, so that no
+# ebook-convert/ebook-meta round trip is needed for this format.
+#
+
+from dataclasses import dataclass, field
+import datetime
+import io
+import mimetypes
+import os
+import re
+from typing import IO, Dict, List, Mapping, Optional, Set, Tuple
+import uuid
+
+from lxml import etree, html
+
+from zipwriter import ZipWriter
+
+NS_OPF = "http://www.idpf.org/2007/opf"
+NS_DC = "http://purl.org/dc/elements/1.1/"
+NS_NCX = "http://www.daisy.org/z3986/2005/ncx/"
+NS_XHTML = "http://www.w3.org/1999/xhtml"
+NS_XML = "http://www.w3.org/XML/1998/namespace"
+
+XML_NAME_RE = re.compile(r"^[A-Za-z_][\w.-]*(:[A-Za-z_][\w.-]*)?$")
+
+DOCUMENT_EXTENSIONS = (".xhtml", ".html", ".htm")
+
+MEDIA_TYPES = {
+    ".xhtml": "application/xhtml+xml",
+    ".html": "application/xhtml+xml",
+    ".htm": "application/xhtml+xml",
+    ".css": "text/css",
+    ".ncx": "application/x-dtbncx+xml",
+    ".svg": "image/svg+xml",
+}
+
+CONTAINER_XML = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+"""
+
+TITLEPAGE_XHTML = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<title>Cover</title>
+<style type="text/css">
+@page {{ margin: 0; padding: 0; }}
+body {{ margin: 0; padding: 0; text-align: center; }}
+</style>
+</head>
+<body>
+<div>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" width="100%" height="100%" viewBox="0 0 {width} {height}" preserveAspectRatio="xMidYMid meet">
+<image width="{width}" height="{height}" xlink:href="{href}"/>
+</svg>
+</div>
+</body>
+</html>
+"""
+
+
+def media_type(file_name: str) -> str:
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext in MEDIA_TYPES:
+        return MEDIA_TYPES[ext]
+    guessed, _ = mimetypes.guess_type(file_name)
+    return guessed or "application/octet-stream"
+
+
+class XhtmlError(Exception):
+    pass
+
+
+def xhtml_root_attributes(
+    attrib: Mapping[str, str],
+) -> Tuple[Dict[str, str], Dict[Optional[str], str]]:
+    # The HTML parser keeps the namespace declarations of an XHTML page as
+    # plain attributes: they must go in the nsmap, or they'd be declared
+    # twice
+    nsmap: Dict[Optional[str], str] = {None: NS_XHTML}
+    root_attrib = {}
+    for name, value in attrib.items():
+        if name.startswith("xmlns:") and XML_NAME_RE.match(name[6:]):
+            nsmap[name[6:]] = value
+        elif name.startswith("xml:"):
+            root_attrib[f"{{{NS_XML}}}{name[4:]}"] = value
+        elif name != "xmlns" and ":" not in name:
+            root_attrib[name] = value
+    return root_attrib, nsmap
+
+
+def xml_attributes(attrib: Mapping[str, str], prefixes: Set[str]) -> Set[str]:
+    # Names of the attributes that are fine for the HTML parser but not in
+    # XML: invalid names and prefixes not declared on the element or on its
+    # ancestors (prefixes). The declarations of the element are added to
+    # prefixes.
+    prefixes.update(name[6:] for name in attrib if name.startswith("xmlns:"))
+    invalid = set()
+    for name in attrib:
+        if name.startswith("{"):
+            continue
+        prefix = name.split(":")[0] if ":" in name else None
+        if not XML_NAME_RE.match(name) or (prefix and prefix not in prefixes):
+            invalid.add(name)
+    return invalid
+
+
+def root_prefixes(nsmap: Mapping[Optional[str], str]) -> Set[str]:
+    return {"xml", "xmlns"} | {prefix for prefix in nsmap if prefix}
+
+
+def remove_invalid_attributes(element: etree._Element, prefixes: Set[str]):
+    # On the element and its descendants, prefixes are those declared by the
+    # ancestors of element
+    stack = [(element, prefixes)]
+    while stack:
+        element, prefixes = stack.pop()
+        if not isinstance(element.tag, str):
+            continue
+        prefixes = set(prefixes)
+        for name in xml_attributes(element.attrib, prefixes):
+            del element.attrib[name]
+        stack.extend((child, prefixes) for child in element)
+
+
+def is_xml_element_name(tag: str) -> bool:
+    # Names like o:p (MS Word), v:shape or fb:like have a prefix that the
+    # page never declares
+    return bool(XML_NAME_RE.match(tag)) and ":" not in tag
+
+
+def unwrap(element: etree._Element):
+    # Same as HtmlElement.drop_tag(), for any element: the content and the
+    # tail stay in the parent
+    parent = element.getparent()
+    previous = element.getprevious()
+
+    def append_text(text: Optional[str]):
+        if not text:
+            return
+        if previous is None:
+            parent.text = (parent.text or "") + text
+        else:
+            previous.tail = (previous.tail or "") + text
+
+    append_text(element.text)
+    if len(element):
+        last = element[-1]
+        last.tail = (last.tail or "") + (element.tail or "")
+    else:
+        append_text(element.tail)
+    index = parent.index(element)
+    parent[index : index + 1] = list(element)
+
+
+def unwrap_invalid_elements(element: etree._Element):
+    # The descendants with names that aren't valid in XML are unwrapped,
+    # their content is kept
+    for descendant in list(element.iterdescendants()):
+        if isinstance(descendant.tag, str) and not is_xml_element_name(descendant.tag):
+            unwrap(descendant)
+
+
+def to_xhtml(doc: etree._Element) -> etree._Element:
+    unwrap_invalid_elements(doc)
+    html.html_to_xhtml(doc)
+    attrib, nsmap = xhtml_root_attributes(doc.attrib)
+    # Moving the children under a root with XHTML as default namespace
+    # avoids the html: prefix on every element
+    root = etree.Element(doc.tag, attrib, nsmap=nsmap)
+    root.text = doc.text
+    root.extend(list(doc))
+    for child in root:
+        remove_invalid_attributes(child, root_prefixes(nsmap))
+    return root
+
+
+def check_xhtml(source: IO[bytes]):
+    # The whole document is parsed as XML, discarding the elements as they
+    # are read, so that big documents can be checked too
+    try:
+        for _, element in etree.iterparse(source, events=("end",)):
+            element.clear(keep_tail=True)
+    except etree.XMLSyntaxError as e:
+        raise XhtmlError(f"Not well-formed XHTML: {e}")
+
+
+def serialize_xhtml(doc: etree._Element) -> bytes:
+    xhtml = etree.tostring(doc, encoding="utf-8", xml_declaration=True, method="xml")
+    check_xhtml(io.BytesIO(xhtml))
+    return xhtml
+
+
+@dataclass
+class BookMetadata:
+    title: str
+    authors: List[str]
+    author_sort: str = ""
+    tags: List[str] = field(default_factory=list)
+    language: str = "en"
+    publisher: str = ""
+    comments: str = ""
+    # Becomes the book's "url" identifier in Calibre
+    source_url: str = ""
+    identifier: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+
+class EpubBuilder:
+
+    metadata: BookMetadata
+    documents: List[Tuple[str, bytes]]
+    resources: List[Tuple[str, bytes]]
+    toc: List[Tuple[int, str, str]]
+    cover: Optional[Tuple[str, bytes, int, int]]
+
+    def __init__(self, metadata: BookMetadata):
+        self.metadata = metadata
+        self.documents = []
+        self.resources = []
+        self.toc = []
+        self.cover = None
+
+    def add_document(self, name: str, content: bytes):
+        doc = to_xhtml(html.document_fromstring(content))
+        # The h1 and h2 headings make the table of contents, just like
+        # ebook-convert's default structure detection
+        for heading in doc.iter(f"{{{NS_XHTML}}}h1", f"{{{NS_XHTML}}}h2"):
+            text = " ".join("".join(heading.itertext()).split())
+            if not text:
+                continue
+            if not heading.get("id"):
+                heading.set("id", f"toc-{len(self.toc) + 1}")
+            level = 1 if heading.tag.endswith("h1") else 2
+            self.toc.append((level, text, f"{name}#{heading.get('id')}"))
+        self.documents.append((name, serialize_xhtml(doc)))
+
+    def add_resource(self, name: str, content: bytes):
+        self.resources.append((name, content))
+
+    def add_files(self, files: Dict[str, bytes]):
+        # index.xhtml, the page written by the fetcher, always comes first
+        for name in sorted(files, key=lambda n: (n != "index.xhtml", n)):
+            if name.lower().endswith(DOCUMENT_EXTENSIONS):
+                self.add_document(name, files[name])
+            else:
+                self.add_resource(name, files[name])
+
+    def add_tree(self, dir_html: str):
+        files = {}
+        for root, _, names in os.walk(dir_html):
+            for file in names:
+                path = os.path.join(root, file)
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, dir_html).replace(os.sep, "/")] = (
+                        f.read()
+                    )
+        self.add_files(files)
+
+    def set_cover(self, cover_file: str, width: int = 590, height: int = 754):
+        with open(cover_file, "rb") as f:
+            content = f.read()
+        ext = os.path.splitext(cover_file)[1].lower()
+        self.cover = ("cover" + ext, content, width, height)
+
+    def build_opf(self, items: List[Tuple[str, str, str]], spine: List[str]) -> bytes:
+        meta = self.metadata
+        package = etree.Element(
+            f"{{{NS_OPF}}}package",
+            nsmap={None: NS_OPF},
+            attrib={"version": "2.0", "unique-identifier": "uuid_id"},
+        )
+        metadata = etree.SubElement(
+            package,
+            f"{{{NS_OPF}}}metadata",
+            nsmap={None: NS_OPF, "dc": NS_DC, "opf": NS_OPF},
+        )
+
+        def dc(tag: str, text: str, **attrib: str) -> etree._Element:
+            element = etree.SubElement(metadata, f"{{{NS_DC}}}{tag}")
+            element.text = text
+            for key, value in attrib.items():
+                element.set(f"{{{NS_OPF}}}{key}", value)
+            return element
+
+        dc("title", meta.title)
+        for author in meta.authors:
+            creator = dc("creator", author, role="aut")
+            if meta.author_sort:
+                creator.set(f"{{{NS_OPF}}}file-as", meta.author_sort)
+        dc("language", meta.language)
+        dc("identifier", f"urn:uuid:{meta.identifier}", scheme="uuid").set(
+            "id", "uuid_id"
+        )
+        if meta.source_url:
+            dc("identifier", meta.source_url, scheme="url")
+        dc("date", datetime.datetime.now().strftime("%Y-%m-%d"))
+        if meta.publisher:
+            dc("publisher", meta.publisher)
+        if meta.comments:
+            dc("description", meta.comments)
+        for tag in meta.tags:
+            dc("subject", tag)
+        if self.cover:
+            etree.SubElement(
+                metadata, f"{{{NS_OPF}}}meta", name="cover", content="cover"
+            )
+        manifest = etree.SubElement(package, f"{{{NS_OPF}}}manifest")
+        for item_id, href, mtype in items:
+            etree.SubElement(
+                manifest,
+                f"{{{NS_OPF}}}item",
+                id=item_id,
+                href=href,
+                attrib={"media-type": mtype},
+            )
+        spine_element = etree.SubElement(package, f"{{{NS_OPF}}}spine", toc="ncx")
+        for item_id in spine:
+            etree.SubElement(spine_element, f"{{{NS_OPF}}}itemref", idref=item_id)
+        if self.cover:
+            guide = etree.SubElement(package, f"{{{NS_OPF}}}guide")
+            etree.SubElement(
+                guide,
+                f"{{{NS_OPF}}}reference",
+                type="cover",
+                title="Cover",
+                href="titlepage.xhtml",
+            )
+        return etree.tostring(
+            package, encoding="utf-8", xml_declaration=True, pretty_print=True
+        )
+
+    def build_ncx(self) -> bytes:
+        ncx = etree.Element(f"{{{NS_NCX}}}ncx", nsmap={None: NS_NCX}, version="2005-1")
+        head = etree.SubElement(ncx, f"{{{NS_NCX}}}head")
+        etree.SubElement(
+            head,
+            f"{{{NS_NCX}}}meta",
+            name="dtb:uid",
+            content=f"urn:uuid:{self.metadata.identifier}",
+        )
+        doc_title = etree.SubElement(ncx, f"{{{NS_NCX}}}docTitle")
+        etree.SubElement(doc_title, f"{{{NS_NCX}}}text").text = self.metadata.title
+        nav_map = etree.SubElement(ncx, f"{{{NS_NCX}}}navMap")
+        entries = self.toc or [(1, name, name) for name, _ in self.documents]
+        parent = nav_map
+        for order, (level, text, href) in enumerate(entries, start=1):
+            # h2 entries are nested in the preceding h1 entry, if any
+            container = nav_map if level == 1 else parent
+            nav_point = etree.SubElement(
+                container,
+                f"{{{NS_NCX}}}navPoint",
+                id=f"np-{order}",
+                playOrder=str(order),
+            )
+            nav_label = etree.SubElement(nav_point, f"{{{NS_NCX}}}navLabel")
+            etree.SubElement(nav_label, f"{{{NS_NCX}}}text").text = text
+            etree.SubElement(nav_point, f"{{{NS_NCX}}}content", src=href)
+            if level == 1:
+                parent = nav_point
+        return etree.tostring(
+            ncx, encoding="utf-8", xml_declaration=True, pretty_print=True
+        )
+
+    def write(self, epub_file: str):
+        items = []
+        spine = []
+        members: List[Tuple[str, bytes]] = []
+        if self.cover:
+            cover_name, cover_content, width, height = self.cover
+            titlepage = TITLEPAGE_XHTML.format(
+                width=width, height=height, href=cover_name
+            )
+            items.append(("cover", cover_name, media_type(cover_name)))
+            items.append(("titlepage", "titlepage.xhtml", MEDIA_TYPES[".xhtml"]))
+            spine.append("titlepage")
+            members.append((cover_name, cover_content))
+            members.append(("titlepage.xhtml", titlepage.encode("utf-8")))
+        ids: Dict[str, str] = {}
+        for name, content in self.documents + self.resources:
+            ids[name] = f"item{len(ids) + 1}"
+            items.append((ids[name], name, media_type(name)))
+            members.append((name, content))
+        spine += [ids[name] for name, _ in self.documents]
+        items.append(("ncx", "toc.ncx", MEDIA_TYPES[".ncx"]))
+        members.append(("toc.ncx", self.build_ncx()))
+        members.append(("content.opf", self.build_opf(items, spine)))
+        with ZipWriter(epub_file, epub=True) as writer:
+            writer.add("META-INF/container.xml", CONTAINER_XML)
+            for name, content in members:
+                writer.add(name, content)
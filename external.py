@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# Base class of the wrappers around external programs (Calibre's command
+# line tools): it collects the initialization errors, such as missing
+# executables, so that they can be reported all at once, and runs the
+# commands through the tracer.
+#
+
+import shutil
+from typing import List, Optional
+
+from tracing import NullTracer, Tracer
+
+
+class ExternalCommand:
+
+    init_errors: List[str]
+    tracer: Tracer
+
+    def __init__(self, tracer: Optional[Tracer] = None):
+        self.init_errors = []
+        self.tracer = tracer or NullTracer()
+
+    def add_init_error(self, error: str):
+        self.init_errors.append(error)
+
+    def get_init_errors(self) -> List[str]:
+        return self.init_errors
+
+    def which(self, exe: str, ignore_errors: bool = False):
+        res = shutil.which(exe)
+        if not res and not ignore_errors:
+            self.init_errors.append(f"{exe} not found")
+        return res
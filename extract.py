@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+#
+# Main content extraction for web pages, in the spirit of Readability: the
+# navigation, ads, comments and the rest of the boilerplate are dropped and
+# only the element with the text of the article is kept. Known sites have
+# their own rules (XPath expressions for the content and for what to remove
+# from it); the other pages are scored paragraph by paragraph. After the
+# extraction drop_unreferenced() removes the downloaded images and
+# stylesheets that the remaining content doesn't use anymore.
+#
+# lxml
+#
+
+from dataclasses import dataclass
+import posixpath
+import re
+from typing import Dict, List, Optional, Set
+from urllib.parse import unquote, urlsplit
+
+from lxml import etree, html
+
+DOCUMENT_EXTENSIONS = (".xhtml", ".html", ".htm")
+
+JUNK_XPATH = etree.XPath(
+    "//script | //style | //noscript | //iframe | //form | //object | //embed"
+    " | //button | //input | //select | //textarea | //nav | //aside | //footer"
+    " | //comment()"
+)
+CLASSED_XPATH = etree.XPath("//body//*[@class or @id]")
+PARAGRAPHS_XPATH = etree.XPath("//p | //pre | //td | //blockquote | //div")
+LINKS_XPATH = etree.XPath(".//a")
+IMAGES_XPATH = etree.XPath(".//img")
+BLOCKS_XPATH = etree.XPath(
+    "./*[self::p or self::div or self::table or self::pre or self::blockquote"
+    " or self::ul or self::ol or self::dl or self::h1 or self::h2 or self::h3]"
+)
+CLEANABLE_XPATH = etree.XPath(".//div | .//ul | .//ol | .//table | .//section")
+
+UNLIKELY_RE = re.compile(
+    r"-ad-|banner|breadcrumb|combx|comment|community|cookie|disqus|extra|footer"
+    r"|gdpr|header|legends|menu|modal|newsletter|pager|pagination|popup|related"
+    r"|remark|replies|rss|share|shoutbox|sidebar|skyscraper|social|sponsor"
+    r"|subscribe|supplemental|widget",
+    re.IGNORECASE,
+)
+MAYBE_RE = re.compile(r"and|article|body|column|content|main|post|story", re.I)
+POSITIVE_RE = re.compile(
+    r"article|body|content|entry|hentry|h-entry|main|page|post|story|text|blog",
+    re.IGNORECASE,
+)
+NEGATIVE_RE = re.compile(
+    r"-ad-|banner|combx|comment|contact|foot|footer|footnote|masthead|media"
+    r"|meta|promo|related|scroll|share|shoutbox|sidebar|skyscraper|social"
+    r"|sponsor|tags|tool|widget",
+    re.IGNORECASE,
+)
+TAG_SCORES = {
+    "div": 5,
+    "pre": 3,
+    "td": 3,
+    "blockquote": 3,
+    "address": -3,
+    "ol": -3,
+    "ul": -3,
+    "dl": -3,
+    "dd": -3,
+    "dt": -3,
+    "li": -3,
+    "form": -3,
+    "h1": -5,
+    "h2": -5,
+    "h3": -5,
+    "h4": -5,
+    "h5": -5,
+    "h6": -5,
+    "th": -5,
+}
+# Paragraphs shorter than this don't count
+MIN_PARAGRAPH_LENGTH = 25
+SIMPLE_XPATH_RE = re.compile(r"^//([a-z][a-z0-9]*)$")
+CSS_URL_RE = re.compile(
+    r"""url\(\s*['"]?([^'")]+)['"]?\s*\)|@import\s+['"]([^'"]+)['"]"""
+)
+
+
+@dataclass
+class SiteRule:
+    hosts: List[str]
+    content: etree.XPath
+    remove: Optional[etree.XPath] = None
+    # Tag of the content element, when the rule is just //tag: it can be
+    # found while the page is still being parsed
+    tag: str = ""
+
+
+SITE_RULES: List[SiteRule] = []
+
+
+def site_rule(hosts: List[str], content: str, remove: str = "") -> SiteRule:
+    # The rules match the given hosts and their subdomains
+    match = SIMPLE_XPATH_RE.match(content)
+    rule = SiteRule(
+        hosts,
+        etree.XPath(content),
+        etree.XPath(remove) if remove else None,
+        match.group(1) if match else "",
+    )
+    SITE_RULES.append(rule)
+    return rule
+
+
+site_rule(["schneier.com"], content="//article")
+
+
+def find_rule(url: str) -> Optional[SiteRule]:
+    host = (urlsplit(url).hostname or "").lower()
+    for rule in SITE_RULES:
+        if any(host == h or host.endswith("." + h) for h in rule.hosts):
+            return rule
+    return None
+
+
+def text_of(element: etree._Element) -> str:
+    return " ".join(element.text_content().split())
+
+
+def link_density(element: etree._Element, text: str) -> float:
+    if not text:
+        return 0.0
+    links = sum(len(text_of(a)) for a in LINKS_XPATH(element))
+    return links / len(text)
+
+
+def class_weight(element: etree._Element) -> int:
+    weight = 0
+    for attribute in ("class", "id"):
+        value = element.get(attribute)
+        if value:
+            if NEGATIVE_RE.search(value):
+                weight -= 25
+            if POSITIVE_RE.search(value):
+                weight += 25
+    return weight
+
+
+def drop(element: html.HtmlElement):
+    # drop_tree() keeps the tail, which is text of the parent
+    if element.getparent() is not None:
+        element.drop_tree()
+
+
+def remove_clutter(doc: etree._Element):
+    for element in JUNK_XPATH(doc):
+        drop(element)
+    for element in CLASSED_XPATH(doc):
+        if element.tag in ("article", "main") or element.getparent() is None:
+            continue
+        attributes = f"{element.get('class', '')} {element.get('id', '')}"
+        if UNLIKELY_RE.search(attributes) and not MAYBE_RE.search(attributes):
+            drop(element)
+
+
+def score_paragraphs(doc: etree._Element) -> Dict[etree._Element, float]:
+    scores: Dict[etree._Element, float] = {}
+    for paragraph in PARAGRAPHS_XPATH(doc):
+        # Only the <div>s without blocks inside are paragraphs
+        if paragraph.tag == "div" and BLOCKS_XPATH(paragraph):
+            continue
+        text = text_of(paragraph)
+        if len(text) < MIN_PARAGRAPH_LENGTH:
+            continue
+        score = 1 + text.count(",") + min(len(text) // 100, 3)
+        # The parent gets the whole score, the grandparent half of it
+        ancestor = paragraph.getparent()
+        for share in (1.0, 0.5):
+            if ancestor is None or not isinstance(ancestor.tag, str):
+                break
+            if ancestor not in scores:
+                scores[ancestor] = TAG_SCORES.get(ancestor.tag, 0) + class_weight(
+                    ancestor
+                )
+            scores[ancestor] += score * share
+            ancestor = ancestor.getparent()
+    # Lists of links (menus, tag clouds) score less
+    return {
+        element: score * (1 - link_density(element, text_of(element)))
+        for element, score in scores.items()
+    }
+
+
+def clean_content(content: etree._Element):
+    # Blocks that are mostly links and have little text: share bars,
+    # "related articles", tag lists
+    for element in reversed(CLEANABLE_XPATH(content)):
+        text = text_of(element)
+        if IMAGES_XPATH(element) and len(text) < MIN_PARAGRAPH_LENGTH:
+            continue
+        if len(text) < 200 and link_density(element, text) > 0.5:
+            drop(element)
+
+
+def score_content(doc: etree._Element) -> Optional[etree._Element]:
+    remove_clutter(doc)
+    scores = score_paragraphs(doc)
+    if not scores:
+        return None
+    best = max(scores, key=lambda element: scores[element])
+    content = html.Element("div")
+    parent = best.getparent()
+    if parent is None or best.tag == "body":
+        content.extend(list(best))
+    else:
+        # The siblings with a good score (or good paragraphs) belong to the
+        # article too, e.g. when it's split in several <div>s
+        threshold = max(10.0, scores[best] * 0.2)
+        for sibling in list(parent):
+            if not isinstance(sibling.tag, str):
+                continue
+            if sibling is best or scores.get(sibling, 0) >= threshold:
+                content.append(sibling)
+            elif sibling.tag == "p":
+                text = text_of(sibling)
+                if len(text) > 80 and link_density(sibling, text) < 0.25:
+                    content.append(sibling)
+    clean_content(content)
+    return content
+
+
+def extract_content(doc: etree._Element, url: str = "") -> Optional[etree._Element]:
+    # The site's own rule first, the scoring when there's none or when the
+    # page doesn't match it anymore
+    rule = find_rule(url)
+    if rule:
+        found = rule.content(doc)
+        if found:
+            content = found[0]
+            if rule.remove is not None:
+                for element in rule.remove(content):
+                    drop(element)
+            return content
+    return score_content(doc)
+
+
+def resolve(base: str, link: str) -> Optional[str]:
+    parts = urlsplit(link)
+    if parts.scheme or parts.netloc or not parts.path:
+        return None
+    return posixpath.normpath(
+        posixpath.join(posixpath.dirname(base), unquote(parts.path))
+    )
+
+
+def document_links(name: str, content: bytes) -> Set[str]:
+    # src, href, srcset, style attributes and <style> elements
+    try:
+        doc = html.document_fromstring(content)
+    except (etree.ParserError, ValueError):
+        return set()
+    links = set()
+    for _, _, link, _ in doc.iterlinks():
+        target = resolve(name, link)
+        if target:
+            links.add(target)
+    return links
+
+
+def css_links(name: str, content: bytes) -> Set[str]:
+    links = set()
+    for match in CSS_URL_RE.finditer(content.decode("utf-8", "replace")):
+        target = resolve(name, match.group(1) or match.group(2))
+        if target:
+            links.add(target)
+    return links
+
+
+def drop_unreferenced(files: Dict[str, bytes]) -> List[str]:
+    # The documents always stay, the other files only if a document, or a
+    # stylesheet used by one, refers to them; returns the removed names
+    documents = [n for n in files if n.lower().endswith(DOCUMENT_EXTENSIONS)]
+    used: Set[str] = set(documents)
+    pending: List[str] = list(documents)
+    while pending:
+        name = pending.pop()
+        if name.lower().endswith(DOCUMENT_EXTENSIONS):
+            links = document_links(name, files[name])
+        else:
+            links = css_links(name, files[name])
+        for link in links:
+            if link in files and link not in used:
+                used.add(link)
+                if link.lower().endswith(".css"):
+                    pending.append(link)
+    removed = [name for name in files if name not in used]
+    for name in removed:
+        del files[name]
+    return removed
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# Download a web page with its images and stylesheets, the same way
+# "web2disk -r 0" does: the page becomes html/index.xhtml, the images go
+# in html/images and the stylesheets in html/stylesheets, with the links
+# rewritten to the local copies (or everything goes straight into a ZIP
+# bundle, under html/). Assets are fetched concurrently over a
+# pooled keep-alive session (with a per-host connection limit) and through
+# the HTTP cache, instead of one by one in a Calibre process. The images
+# can be optimized for the e-reader screen on the way.
+#
+# lxml, requests
+#
+
+import argparse
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+import os
+import posixpath
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
+
+from epub import XhtmlError, serialize_xhtml, to_xhtml
+from httpcache import CachedResponse, HttpCache
+from images import ImageOptimizer, parse_size
+from stagecache import StageCache
+from zipwriter import ZipWriter
+
+# Media types of the images and stylesheets, and the extensions of their
+# local copies
+ASSET_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+    "image/bmp": ".bmp",
+    "text/css": ".css",
+}
+CSS_URL_RE = re.compile(r"""url\(\s*['"]?([^'")]+?)['"]?\s*\)""")
+
+
+class FetchError(Exception):
+    pass
+
+
+class FetchedPage:
+
+    url: str
+    files: Dict[str, bytes]
+
+    def __init__(self, url: str, files: Dict[str, bytes]):
+        self.url = url
+        # index.xhtml first, then its images and stylesheets
+        self.files = files
+
+    def save(self, dir_html: str) -> str:
+        for name, content in self.files.items():
+            path = os.path.join(dir_html, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content)
+        return os.path.join(dir_html, "index.xhtml")
+
+
+def asset_extension(url: str, content_type: str, default: str) -> str:
+    # The Content-Type first, since dynamic images (img.php?id=3) have
+    # meaningless suffixes; then the suffix, if it's a known one
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in ASSET_EXTENSIONS:
+        return ASSET_EXTENSIONS[media_type]
+    ext = posixpath.splitext(urlsplit(url).path)[1].lower()
+    if ext in ASSET_EXTENSIONS.values() or ext == ".jpeg":
+        return ext
+    return default
+
+
+def page_parser(content_type: str) -> Optional[html.HTMLParser]:
+    # The charset of the Content-Type header wins over the page's own; the
+    # names known to libxml2 and to Python differ (euc-jp, latin-1)
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip().lower() != "charset":
+            continue
+        charset = value.strip().strip("\"'")
+        try:
+            names = [charset, codecs.lookup(charset).name]
+        except LookupError:
+            return None
+        for encoding in names:
+            try:
+                return html.HTMLParser(encoding=encoding)
+            except LookupError:
+                pass
+    return None
+
+
+class PageFetcher:
+
+    http_cache: HttpCache
+    per_host: int
+    host_slots: Dict[str, threading.Semaphore]
+    host_lock: threading.Lock
+    executor: ThreadPoolExecutor
+    image_optimizer: Optional[ImageOptimizer]
+
+    def __init__(
+        self,
+        http_cache: Optional[HttpCache] = None,
+        max_workers: int = 8,
+        per_host: int = 4,
+        image_optimizer: Optional[ImageOptimizer] = None,
+    ):
+        self.http_cache = http_cache or HttpCache()
+        # Without an optimizer the images are kept as they are
+        self.image_optimizer = image_optimizer
+        # Keep-alive connections are reused across pages and assets
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.http_cache.session.mount("http://", adapter)
+        self.http_cache.session.mount("https://", adapter)
+        self.per_host = per_host
+        self.host_slots = {}
+        self.host_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get(self, url: str) -> CachedResponse:
+        host = urlsplit(url).netloc
+        with self.host_lock:
+            slot = self.host_slots.setdefault(host, threading.Semaphore(self.per_host))
+        with slot:
+            return self.http_cache.get(url)
+
+    def get_assets(self, urls: List[str]) -> Dict[str, Optional[CachedResponse]]:
+        def get_or_none(url: str) -> Optional[CachedResponse]:
+            try:
+                response = self.get(url)
+            except Exception as e:
+                print(f"   Cannot download {url}: {e}")
+                return None
+            return response if response.ok else None
+
+        return dict(zip(urls, self.executor.map(get_or_none, urls)))
+
+    def fetch(self, url: str, dir_html: str) -> str:
+        return self.fetch_page(url).save(dir_html)
+
+    def fetch_page(self, url: str) -> FetchedPage:
+        page = self.get(url)
+        if not page.ok:
+            raise FetchError(f"{url} returned HTTP {page.status_code}")
+        parser = page_parser(page.headers.get("Content-Type", ""))
+        doc = html.document_fromstring(page.content, parser=parser, base_url=url)
+        # The links are relative to <base href>, when the page has one
+        base_hrefs = doc.xpath("//base/@href")
+        base_url = urljoin(url, base_hrefs[0].strip()) if base_hrefs else url
+        for element in doc.xpath("//script|//noscript|//base"):
+            element.drop_tree()
+        # Plain links stay on the web, as with web2disk -r 0
+        doc.make_links_absolute(base_url, resolve_base_href=False)
+        images: List[Tuple[etree._Element, str]] = []
+        stylesheets: List[Tuple[etree._Element, str]] = []
+        for img in doc.xpath("//img[@src]"):
+            img.attrib.pop("srcset", None)
+            # Inline images stay in the page
+            if not img.get("src").startswith("data:"):
+                images.append((img, img.get("src")))
+        for link in doc.xpath("//link[@href]"):
+            if "stylesheet" in (link.get("rel") or "").lower().split():
+                stylesheets.append((link, link.get("href")))
+            else:
+                link.drop_tree()
+        for source in doc.xpath("//picture/source"):
+            source.drop_tree()
+
+        files: Dict[str, bytes] = {}
+        local: Dict[str, str] = {}
+        remote: Dict[str, str] = {}
+
+        def save(asset_url: str, response: CachedResponse, prefix: str, ext: str):
+            if asset_url in local:
+                return
+            content_type = response.headers.get("Content-Type", "")
+            name = f"{prefix}{len(local) + 1}{asset_extension(asset_url, content_type, ext)}"
+            local[asset_url] = name
+            remote[name] = asset_url
+            files[name] = response.content
+
+        fetched = self.get_assets(
+            list(dict.fromkeys(u for _, u in stylesheets + images))
+        )
+        css_urls: List[str] = []
+        for _, asset_url in stylesheets:
+            response = fetched.get(asset_url)
+            if response:
+                save(asset_url, response, "stylesheets/style", ".css")
+                css = response.content.decode("utf-8", "replace")
+                for ref in CSS_URL_RE.findall(css):
+                    if not ref.startswith("data:"):
+                        css_urls.append(urljoin(asset_url, ref))
+        for _, asset_url in images:
+            response = fetched.get(asset_url)
+            if response:
+                save(asset_url, response, "images/img", ".jpg")
+        # Second round: the images referenced by the stylesheets
+        css_urls = [u for u in dict.fromkeys(css_urls) if u not in local]
+        for asset_url, response in self.get_assets(css_urls).items():
+            if response:
+                save(asset_url, response, "images/img", ".png")
+
+        if self.image_optimizer:
+            # Images that change format change name too
+            renamed = self.image_optimizer.optimize_files(files)
+            for asset_url, name in local.items():
+                local[asset_url] = renamed.get(name, name)
+
+        for element, asset_url in images:
+            if asset_url in local:
+                element.set("src", local[asset_url])
+        for element, asset_url in stylesheets:
+            if asset_url in local:
+                element.set("href", local[asset_url])
+            else:
+                element.drop_tree()
+        for name in list(files):
+            if not name.startswith("stylesheets/"):
+                continue
+
+            def to_local(match: re.Match, base: str = remote[name]) -> str:
+                target = local.get(urljoin(base, match.group(1)))
+                # Stylesheets live in a sibling directory of the images
+                return f"url(../{target})" if target else match.group(0)
+
+            css = files[name].decode("utf-8", "replace")
+            files[name] = CSS_URL_RE.sub(to_local, css).encode("utf-8")
+
+        try:
+            index_xhtml = serialize_xhtml(to_xhtml(doc))
+        except XhtmlError as e:
+            raise FetchError(f"{url}: {e}")
+        return FetchedPage(url, {"index.xhtml": index_xhtml, **files})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Download a web page with its images and stylesheets"
+    )
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("-d", "--dir", help="output directory")
+    output.add_argument(
+        "-z", "--zip", help="output ZIP bundle, with the files in its html directory"
+    )
+    parser.add_argument(
+        "--images",
+        type=parse_size,
+        metavar="WIDTHxHEIGHT",
+        help="scale the images down to this screen size, in greyscale",
+    )
+    parser.add_argument("url")
+    args = parser.parse_args()
+    optimizer = None
+    if args.images:
+        width, height = args.images
+        optimizer = ImageOptimizer(width, height, cache=StageCache())
+    fetcher = PageFetcher(image_optimizer=optimizer)
+    try:
+        if args.zip:
+            with ZipWriter(args.zip) as writer:
+                writer.add_files(fetcher.fetch_page(args.url).files, "html/")
+            print(args.zip)
+        else:
+            print(fetcher.fetch(args.url, args.dir))
+    finally:
+        fetcher.executor.shutdown()
+        if optimizer:
+            optimizer.close()
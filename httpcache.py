@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Persistent HTTP cache keyed by URL. Cached entries are revalidated with
+# conditional requests (ETag/Last-Modified), so an unchanged page or asset
+# costs a 304 instead of a full download, and the cache directory is kept
+# under a size limit by evicting the least recently used entries.
+#
+# requests
+#
+
+from dataclasses import dataclass, field
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    status_code: int
+    content: bytes
+    headers: Dict[str, str] = field(default_factory=dict)
+    from_cache: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 400
+
+
+class HttpCache:
+
+    dir_cache: str
+    max_bytes: int
+    session: requests.Session
+    lock: threading.Lock
+    db: sqlite3.Connection
+
+    def __init__(
+        self,
+        dir_cache: str = "",
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        session: Optional[requests.Session] = None,
+    ):
+        self.dir_cache = dir_cache or os.path.join(
+            os.path.expanduser("~"), ".cache", "calibre-utils", "http"
+        )
+        self.max_bytes = max_bytes
+        self.session = session or requests.Session()
+        self.lock = threading.Lock()
+        os.makedirs(self.dir_cache, exist_ok=True)
+        self.db = sqlite3.connect(
+            os.path.join(self.dir_cache, "index.sqlite"), check_same_thread=False
+        )
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_type TEXT,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )""")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)"
+            )
+
+    def path(self, url: str) -> str:
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.dir_cache, digest[:2], digest)
+
+    def lookup(self, url: str) -> Optional[sqlite3.Row]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+        if row and not os.path.exists(self.path(url)):
+            return None
+        return row
+
+    def read_cached(self, url: str, entry: sqlite3.Row) -> Optional[CachedResponse]:
+        # None if the body has gone meanwhile (evicted by this or by another
+        # process): the entry is forgotten
+        try:
+            with open(self.path(url), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            with self.lock, self.db:
+                self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            return None
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE entries SET last_access = ? WHERE url = ?", (time.time(), url)
+            )
+        headers = {}
+        if entry["content_type"]:
+            headers["Content-Type"] = entry["content_type"]
+        return CachedResponse(url, 200, content, headers, from_cache=True)
+
+    def store(self, url: str, response: requests.Response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            # Nothing to revalidate with, it would be downloaded again anyway
+            return
+        if "no-store" in response.headers.get("Cache-Control", ""):
+            return
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(response.content)
+        os.replace(tmp, path)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    etag,
+                    last_modified,
+                    response.headers.get("Content-Type"),
+                    len(response.content),
+                    time.time(),
+                ),
+            )
+        self.evict()
+
+    def evict(self):
+        with self.lock, self.db:
+            total = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self.db.execute(
+                "SELECT url, size FROM entries ORDER BY last_access"
+            ).fetchall()
+            for url, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+                try:
+                    os.unlink(self.path(url))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def get(self, url: str, timeout: float = 60) -> CachedResponse:
+        entry = self.lookup(url)
+        headers = {}
+        if entry:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            response = self.session.get(url, headers=headers, timeout=timeout)
+        except requests.RequestException:
+            # A stale copy is better than nothing when the site is unreachable
+            cached = self.read_cached(url, entry) if entry else None
+            if cached:
+                return cached
+            raise
+        if response.status_code == 304 and entry:
+            cached = self.read_cached(url, entry)
+            if cached:
+                return cached
+            response = self.session.get(url, timeout=timeout)
+        if response.status_code == 200:
+            self.store(url, response)
+        return CachedResponse(
+            url, response.status_code, response.content, dict(response.headers)
+        )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# Image optimization for e-readers: the page images are scaled down to fit
+# the device screen (by default the 590x754 of the covers), turned to
+# greyscale, and photos are recompressed as JPEG, while line art with few
+# colors stays PNG. Images are processed in parallel and the results are
+# cached by the hash of the source image and of the settings.
+#
+#   python3 images.py --size 590x754 image.png ...   (optimized in place)
+#
+# Pillow
+#
+
+import argparse
+from concurrent.futures import Executor, ThreadPoolExecutor
+import io
+import os
+import posixpath
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, UnidentifiedImageError
+
+from stagecache import StageCache, bytes_digest, code_version
+
+DEFAULT_WIDTH = 590
+DEFAULT_HEIGHT = 754
+DEFAULT_QUALITY = 75
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp")
+JPEG_MAGIC = b"\xff\xd8"
+PNG_MAGIC = b"\x89PNG"
+# Images with up to this many colors are line art, better as PNG
+LINE_ART_COLORS = 64
+
+
+def parse_size(value: str) -> Tuple[int, int]:
+    try:
+        width, height = (int(x) for x in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a WIDTHxHEIGHT size")
+    return width, height
+
+
+def flatten(img: Image.Image) -> Image.Image:
+    # Transparent areas become white, as on the e-reader page
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        img = img.convert("RGBA")
+        background = Image.new("RGBA", img.size, (255, 255, 255, 255))
+        img = Image.alpha_composite(background, img)
+    return img
+
+
+class ImageOptimizer:
+
+    width: int
+    height: int
+    greyscale: bool
+    quality: int
+    cache: Optional[StageCache]
+    executor: Executor
+
+    def __init__(
+        self,
+        width: int = DEFAULT_WIDTH,
+        height: int = DEFAULT_HEIGHT,
+        greyscale: bool = True,
+        quality: int = DEFAULT_QUALITY,
+        cache: Optional[StageCache] = None,
+        max_workers: Optional[int] = None,
+    ):
+        self.width = width
+        self.height = height
+        self.greyscale = greyscale
+        self.quality = quality
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+
+    def version(self) -> str:
+        # Everything that changes the output, for the cache keys
+        mode = "L" if self.greyscale else "RGB"
+        settings = f"{self.width}x{self.height}:{mode}:{self.quality}"
+        return f"{settings}:{code_version(ImageOptimizer)}"
+
+    def optimize(self, content: bytes) -> bytes:
+        # Returns the original content when it can't be made smaller
+        try:
+            img: Image.Image = Image.open(io.BytesIO(content))
+        except (UnidentifiedImageError, OSError):
+            return content
+        if getattr(img, "is_animated", False):
+            return content
+        size = (self.width, self.height)
+        # JPEGs can be decoded straight at a reduced scale
+        img.draft("L" if self.greyscale else "RGB", size)
+        try:
+            img = flatten(img)
+            resized = img.width > self.width or img.height > self.height
+            img.thumbnail(size, Image.Resampling.LANCZOS)
+        except OSError:
+            return content
+        img = img.convert("L" if self.greyscale else "RGB")
+        out = io.BytesIO()
+        colors = img.getcolors(LINE_ART_COLORS)
+        if colors is not None and not content.startswith(JPEG_MAGIC):
+            img.save(out, "PNG", optimize=True)
+        else:
+            img.save(out, "JPEG", quality=self.quality, optimize=True)
+        result = out.getvalue()
+        if not resized and len(result) >= len(content):
+            return content
+        return result
+
+    def cached_optimize(self, content: bytes) -> bytes:
+        if not self.cache:
+            return self.optimize(content)
+        key = self.cache.key("image", bytes_digest(content), self.version())
+        result = self.cache.get_bytes(key)
+        if result is None:
+            result = self.optimize(content)
+            self.cache.put_bytes(key, result)
+        return result
+
+    def optimize_files(self, files: Dict[str, bytes]) -> Dict[str, str]:
+        # Optimizes the images in files (name -> content) in place; the
+        # images that have changed format get a new extension, and the old ->
+        # new name map is returned so that the references can be updated
+        names = [n for n in files if n.lower().endswith(IMAGE_EXTENSIONS)]
+        results = self.executor.map(self.cached_optimize, [files[n] for n in names])
+        renamed: Dict[str, str] = {}
+        for name, result in zip(names, results):
+            new_name = name
+            root, ext = posixpath.splitext(name)
+            if result.startswith(JPEG_MAGIC) and ext.lower() not in (".jpg", ".jpeg"):
+                new_name = root + ".jpg"
+            elif result.startswith(PNG_MAGIC) and ext.lower() != ".png":
+                new_name = root + ".png"
+            if new_name in files:
+                new_name = name
+            files[name] = result
+            if new_name != name:
+                renamed[name] = new_name
+        if renamed:
+            # Same order, new names
+            items = [(renamed.get(n, n), c) for n, c in files.items()]
+            files.clear()
+            files.update(items)
+        return renamed
+
+    def close(self):
+        self.executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimize images for e-readers")
+    parser.add_argument(
+        "--size",
+        type=parse_size,
+        default=(DEFAULT_WIDTH, DEFAULT_HEIGHT),
+        help=f"screen size (default: {DEFAULT_WIDTH}x{DEFAULT_HEIGHT})",
+    )
+    parser.add_argument("--color", action="store_true", help="don't turn to greyscale")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY)
+    parser.add_argument("images", nargs="+")
+    args = parser.parse_args()
+    width, height = args.size
+    optimizer = ImageOptimizer(
+        width, height, not args.color, args.quality, StageCache()
+    )
+    contents: List[bytes] = []
+    for path in args.images:
+        with open(path, "rb") as source:
+            contents.append(source.read())
+    try:
+        for path, before, after in zip(
+            args.images,
+            contents,
+            optimizer.executor.map(optimizer.cached_optimize, contents),
+        ):
+            if after != before:
+                # The name stays the same, image viewers look at the content
+                with open(path, "wb") as target:
+                    target.write(after)
+            print(f"{path}: {len(before)} -> {len(after)} bytes")
+    finally:
+        optimizer.close()
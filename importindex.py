@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+#
+# Local index of the books imported into Calibre: source URL, hash of the
+# downloaded content, title and Calibre book ID. The pipelines look up the
+# index before downloading anything, so that already imported issues,
+# articles and web pages are skipped without network or calibredb calls;
+# CalibreLibrary updates it after each import. The index can be rebuilt
+# from the library's metadata.db, using the "url" identifiers and the
+# "From <URL>" comments of the books.
+#
+#   python3 importindex.py rebuild
+#   python3 importindex.py find --url https://en.wikipedia.org/wiki/Perugia
+#
+# Calibre
+#
+
+import argparse
+from dataclasses import dataclass
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+COMMENTS_URL_RE = re.compile(r"\bFrom\s+(https?://[^\s<>\"']+)")
+URL_IDENTIFIERS = ("url", "uri")
+
+
+def default_db_file() -> str:
+    return os.path.join(
+        os.path.expanduser("~"), ".cache", "calibre-utils", "imports.sqlite"
+    )
+
+
+def calibre_config_dir() -> str:
+    if "CALIBRE_CONFIG_DIRECTORY" in os.environ:
+        return os.environ["CALIBRE_CONFIG_DIRECTORY"]
+    if sys.platform == "win32":
+        return os.path.join(os.environ.get("APPDATA", ""), "calibre")
+    if sys.platform == "darwin":
+        return os.path.expanduser("~/Library/Preferences/calibre")
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(config_home, "calibre")
+
+
+def metadata_db_path(library: Optional[str]) -> Optional[str]:
+    # The library directory, or the default one from Calibre's settings;
+    # None for a content server
+    if library and "://" in library:
+        return None
+    if not library:
+        try:
+            with open(os.path.join(calibre_config_dir(), "global.py.json")) as f:
+                library = json.load(f).get("library_path")
+        except (OSError, ValueError):
+            return None
+        if not library:
+            return None
+    return os.path.join(library, "metadata.db")
+
+
+@dataclass
+class IndexedBook:
+    book_id: str
+    title: str
+    source_url: Optional[str]
+    content_hash: Optional[str]
+    imported_at: float
+
+
+class ImportIndex:
+
+    db: sqlite3.Connection
+    library: str
+    lock: threading.Lock
+
+    def __init__(self, library: Optional[str] = None, db_file: str = ""):
+        # A single index file holds the books of all the libraries
+        db_file = db_file or default_db_file()
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.library = library or ""
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS imports (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    library TEXT NOT NULL,
+                    book_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    source_url TEXT,
+                    content_hash TEXT,
+                    imported_at REAL NOT NULL
+                )""")
+            for column in ("source_url", "content_hash", "title"):
+                self.db.execute(
+                    f"CREATE INDEX IF NOT EXISTS imports_{column} "
+                    f"ON imports (library, {column})"
+                )
+
+    def find(
+        self,
+        source_url: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        title: Optional[str] = None,
+    ) -> Optional[IndexedBook]:
+        # The first book matching any of the given keys
+        for column, value in (
+            ("source_url", source_url),
+            ("content_hash", content_hash),
+            ("title", title),
+        ):
+            if not value:
+                continue
+            with self.lock:
+                row = self.db.execute(
+                    f"SELECT * FROM imports WHERE library = ? AND {column} = ? "
+                    "ORDER BY imported_at DESC LIMIT 1",
+                    (self.library, value),
+                ).fetchone()
+            if row:
+                return IndexedBook(
+                    row["book_id"],
+                    row["title"],
+                    row["source_url"],
+                    row["content_hash"],
+                    row["imported_at"],
+                )
+        return None
+
+    def recent(self, since: float) -> List[IndexedBook]:
+        # The books imported after the since timestamp, newest first
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT * FROM imports WHERE library = ? AND imported_at >= ? "
+                "ORDER BY imported_at DESC",
+                (self.library, since),
+            ).fetchall()
+        return [
+            IndexedBook(
+                row["book_id"],
+                row["title"],
+                row["source_url"],
+                row["content_hash"],
+                row["imported_at"],
+            )
+            for row in rows
+        ]
+
+    def record(
+        self,
+        book_id: str,
+        title: str,
+        source_url: Optional[str] = None,
+        content_hash: Optional[str] = None,
+    ):
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM imports WHERE library = ? AND book_id = ?",
+                (self.library, book_id),
+            )
+            self.db.execute(
+                "INSERT INTO imports (library, book_id, title, source_url, "
+                "content_hash, imported_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.library, book_id, title, source_url, content_hash, time.time()),
+            )
+
+    def replace_all(self, books: Iterable[Tuple[str, str, Optional[str]]]):
+        # (book_id, title, source_url) of every book in the library; the
+        # content hashes of the books still there are kept
+        with self.lock, self.db:
+            hashes = {
+                row["book_id"]: row["content_hash"]
+                for row in self.db.execute(
+                    "SELECT book_id, content_hash FROM imports WHERE library = ?",
+                    (self.library,),
+                )
+            }
+            self.db.execute("DELETE FROM imports WHERE library = ?", (self.library,))
+            now = time.time()
+            self.db.executemany(
+                "INSERT INTO imports (library, book_id, title, source_url, "
+                "content_hash, imported_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (self.library, book_id, title, url, hashes.get(book_id), now)
+                    for book_id, title, url in books
+                ],
+            )
+
+    def rebuild(self, metadata_db: str) -> int:
+        # Read-only, Calibre may be running
+        source = sqlite3.connect(f"file:{metadata_db}?mode=ro", uri=True)
+        try:
+            urls: Dict[int, str] = {}
+            for book, text in source.execute("SELECT book, text FROM comments"):
+                match = COMMENTS_URL_RE.search(text or "")
+                if match:
+                    urls[book] = match.group(1)
+            # The url identifiers win over the comments
+            placeholders = ", ".join("?" for _ in URL_IDENTIFIERS)
+            for book, val in source.execute(
+                f"SELECT book, val FROM identifiers WHERE type IN ({placeholders})",
+                URL_IDENTIFIERS,
+            ):
+                urls[book] = val
+            books: List[Tuple[str, str, Optional[str]]] = [
+                (str(book_id), title, urls.get(book_id))
+                for book_id, title in source.execute("SELECT id, title FROM books")
+            ]
+        finally:
+            source.close()
+        self.replace_all(books)
+        return len(books)
+
+    def count(self) -> int:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(*) FROM imports WHERE library = ?", (self.library,)
+            ).fetchone()
+        return row[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index of the imported books")
+    parser.add_argument("--with-library", dest="library", help="library path or URL")
+    parser.add_argument("--db", default="", help="index file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser(
+        "rebuild", help="rebuild the index from Calibre's metadata.db"
+    )
+    rebuild_parser.add_argument(
+        "--metadata-db", help="metadata.db file (default: the library's)"
+    )
+    find_parser = subparsers.add_parser(
+        "find", help="print the book ID of an imported book, or exit with 1"
+    )
+    find_parser.add_argument("--url")
+    find_parser.add_argument("--hash", help="SHA-256 of the downloaded content")
+    find_parser.add_argument("--title")
+    args = parser.parse_args()
+    index = ImportIndex(args.library, args.db)
+    if args.command == "rebuild":
+        metadata_db = args.metadata_db or metadata_db_path(args.library)
+        if not metadata_db or not os.path.exists(metadata_db):
+            print("Cannot find the library's metadata.db, please use --metadata-db")
+            sys.exit(1)
+        try:
+            count = index.rebuild(metadata_db)
+        except sqlite3.Error as e:
+            print(f"Cannot read {metadata_db}: {e}")
+            sys.exit(1)
+        print(f"{count} books indexed")
+    else:
+        if not (args.url or args.hash or args.title):
+            find_parser.error("one of --url, --hash or --title is required")
+        book = index.find(args.url, args.hash, args.title)
+        if not book:
+            sys.exit(1)
+        print(book.book_id)
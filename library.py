@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# Batched imports into the Calibre library. Books are queued with all
+# their formats and the queue is flushed with a single "calibredb add"
+# invocation, one directory per book; the new book IDs are taken from
+# calibredb's output instead of searching the whole library by title.
+# The library can be a local directory or a running calibre content
+# server (e.g. http://localhost:8080#library). The imported books are
+# recorded in the import index, when one is given.
+#
+# Calibre
+#
+
+import argparse
+from dataclasses import dataclass
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from typing import List, Optional, Sequence
+
+from external import ExternalCommand
+from importindex import ImportIndex
+from tracing import Tracer
+
+ADDED_IDS_RE = re.compile(r":\s*(\d+(?:\s*,\s*\d+)*)\s*$", re.MULTILINE)
+
+
+class LibraryError(Exception):
+    pass
+
+
+@dataclass
+class QueuedBook:
+    title: str
+    formats: List[str]
+    book_id: Optional[str] = None
+    source_url: Optional[str] = None
+    content_hash: Optional[str] = None
+
+
+class CalibreLibrary(ExternalCommand):
+
+    cmd_calibredb: str
+    library: Optional[str]
+    index: Optional[ImportIndex]
+    queue: List[QueuedBook]
+    lock: threading.Lock
+
+    def __init__(
+        self,
+        library: Optional[str] = None,
+        tracer: Optional[Tracer] = None,
+        index: Optional[ImportIndex] = None,
+    ):
+        super().__init__(tracer)
+        self.cmd_calibredb = self.which("calibredb")
+        if self.get_init_errors():
+            self.add_init_error("Please install Calibre")
+        self.library = library
+        self.index = index
+        self.queue = []
+        self.lock = threading.Lock()
+
+    def calibredb(self, args: List[str], inputs: Sequence[str] = ()) -> str:
+        cmd = [self.cmd_calibredb] + args
+        if self.library:
+            cmd += ["--with-library", self.library]
+        res = self.tracer.run(cmd, "calibredb", inputs=inputs, capture_output=True)
+        output = res.stdout.decode("utf-8", "replace")
+        if res.returncode != 0:
+            error = res.stderr.decode("utf-8", "replace").strip()
+            raise LibraryError(f"calibredb {args[0]} failed: {error}")
+        return output
+
+    def add(
+        self,
+        title: str,
+        formats: List[str],
+        book_id: Optional[str] = None,
+        source_url: Optional[str] = None,
+        content_hash: Optional[str] = None,
+    ) -> QueuedBook:
+        # With a book_id the formats are added to that existing book
+        book = QueuedBook(title, list(formats), book_id, source_url, content_hash)
+        with self.lock:
+            self.queue.append(book)
+        return book
+
+    def find_ids(self, books: List[QueuedBook]):
+        # Fallback for when calibredb's output can't be matched with the
+        # queue (e.g. some books were skipped as duplicates): a single
+        # search for all the titles
+        search = " or ".join(
+            'title:"={}"'.format(book.title.replace('"', '\\"')) for book in books
+        )
+        output = self.calibredb(
+            ["list", "--fields", "title", "--for-machine", "--search", search]
+        )
+        ids = {entry["title"]: str(entry["id"]) for entry in json.loads(output or "[]")}
+        for book in books:
+            book.book_id = ids.get(book.title)
+
+    def flush(self) -> List[QueuedBook]:
+        with self.lock:
+            queue, self.queue = self.queue, []
+        new_books = [book for book in queue if not book.book_id]
+        if new_books:
+            with tempfile.TemporaryDirectory() as dir_tmp:
+                dirs = []
+                for i, book in enumerate(new_books):
+                    dir_book = os.path.join(dir_tmp, f"{i:05d}")
+                    os.mkdir(dir_book)
+                    for path in book.formats:
+                        target = os.path.join(dir_book, os.path.basename(path))
+                        try:
+                            os.link(path, target)
+                        except OSError:
+                            shutil.copyfile(path, target)
+                    dirs.append(dir_book)
+                # Each directory is a single book, its files are its formats
+                output = self.calibredb(
+                    ["add", "--one-book-per-directory"] + dirs,
+                    [path for book in new_books for path in book.formats],
+                )
+            match = ADDED_IDS_RE.search(output)
+            ids = re.split(r"\s*,\s*", match.group(1)) if match else []
+            if len(ids) == len(new_books):
+                for book, book_id in zip(new_books, ids):
+                    book.book_id = book_id
+            else:
+                self.find_ids(new_books)
+        for book in queue:
+            if book in new_books:
+                continue
+            for path in book.formats:
+                self.calibredb(["add_format", str(book.book_id), path], [path])
+        if self.index:
+            for book in queue:
+                if book.book_id:
+                    self.index.record(
+                        book.book_id, book.title, book.source_url, book.content_hash
+                    )
+        return queue
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Add a book, with all its formats, to Calibre"
+    )
+    parser.add_argument("--title", help="title used if the book ID must be searched")
+    parser.add_argument("--with-library", dest="library", help="library path or URL")
+    parser.add_argument("--source-url", help="URL recorded in the import index")
+    parser.add_argument("formats", nargs="+", help="e-book files of the same book")
+    args = parser.parse_args()
+    library = CalibreLibrary(args.library, index=ImportIndex(args.library))
+    if library.get_init_errors():
+        print("\n".join(library.get_init_errors()))
+        sys.exit(1)
+    book = library.add(
+        args.title or os.path.splitext(os.path.basename(args.formats[0]))[0],
+        args.formats,
+        source_url=args.source_url,
+    )
+    library.flush()
+    if not book.book_id:
+        print("Error while adding the book to Calibre")
+        sys.exit(1)
+    print(book.book_id)
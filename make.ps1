@@ -1,3 +1,5 @@
-black cryptogram2calibre.py
-flake8 --ignore=E203,E266,E501,W503 cryptogram2calibre.py
-mypy --ignore-missing-imports cryptogram2calibre.py
\ No newline at end of file
+$PythonFiles = "benchmarks/bench.py", "convertworker.py", "covers.py", "cryptogram2calibre.py", "epub.py", "external.py", "extract.py", "fetcher.py", "httpcache.py", "images.py", "importindex.py", "library.py", "publisher.py", "stagecache.py", "tests/__init__.py", "tests/pages.py", "tests/test_epub.py", "tests/test_fetcher.py", "tests/test_httpcache.py", "tests/test_stagecache.py", "tests/test_transforms.py", "tests/test_zipwriter.py", "tracing.py", "transforms.py", "webpage2calibred.py", "wikianthology.py", "zipwriter.py"
+black $PythonFiles
+flake8 --ignore=E203,E266,E501,W503 $PythonFiles
+mypy --ignore-missing-imports $PythonFiles
+python -m unittest discover -s tests -t .
\ No newline at end of file
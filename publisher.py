@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+#
+# Incremental publisher of the Crypto-Gram issues on the bernardi.cloud Hugo
+# repository. Each EPUB and MOBI file is stored once, under its dated name,
+# and rewritten only when its content changes: the SHA-256 of every file is
+# kept in the site's data/cryptogram.json manifest. The cryptogram-last.*
+# aliases are hardlinks to the newest issue (reflinks or copies where
+# hardlinks aren't available). The posts of a whole batch of issues are
+# rendered in one pass, along with an archive page of all the issues.
+#
+#   python3 publisher.py 2024-05 cryptogram.epub cryptogram.mobi
+#   python3 publisher.py --site ../bernardi.cloud
+#
+
+import argparse
+from dataclasses import dataclass
+import datetime
+import json
+import os
+import re
+import shutil
+import sys
+from typing import Any, Dict, List, Optional
+
+from stagecache import file_digest
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None  # type: ignore
+
+# ioctl to clone a file on Btrfs and XFS
+FICLONE = 0x40049409
+SITE_DIRS = [
+    os.path.join("..", "bernardi.cloud"),
+    os.path.join("..", "..", "bernardi.cloud"),
+]
+TEMPLATE_RE = re.compile(r"_(YYYY|MM|DD|MONTH|month|ENTRIES)_")
+POST_RE = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})-crypto-gram-[a-z]+-\d{4}-in-epub-and-mobi-format\.md$"
+)
+FORMATS = ("mobi", "epub")
+
+
+class PublishError(Exception):
+    pass
+
+
+@dataclass
+class PublishedIssue:
+    date: datetime.datetime
+    # Format (epub, mobi) -> file
+    formats: Dict[str, str]
+
+
+def find_site() -> Optional[str]:
+    # I assume that Calibre-Utils is in the github directory,
+    # which is on the same level as the bernardi.cloud repo
+    for dir_site in SITE_DIRS:
+        if os.path.exists(dir_site):
+            return dir_site
+        print(f"The directory {dir_site} doesn't exist...")
+    return None
+
+
+def render(template: str, values: Dict[str, str]) -> str:
+    # All the placeholders in a single pass
+    return TEMPLATE_RE.sub(lambda m: values.get(m.group(1), m.group(0)), template)
+
+
+def clone_file(source: str, target: str):
+    # A reflink shares the blocks of the source where the file system
+    # supports it, a copy is made otherwise. The new file is renamed over
+    # the target, so the hardlinks to the old one still see the old content.
+    tmp = target + ".tmp"
+    with open(source, "rb") as src, open(tmp, "wb") as dst:
+        try:
+            if fcntl is None:
+                raise OSError("reflinks not supported")
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp, target)
+
+
+def link_file(source: str, target: str):
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    tmp = target + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        clone_file(source, target)
+        return
+    os.replace(tmp, target)
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    data = content.encode("utf-8")
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "wb") as f:
+        f.write(data)
+    return True
+
+
+def issue_key(date: datetime.datetime) -> str:
+    return date.strftime("%Y-%m")
+
+
+class HugoPublisher:
+
+    dir_site: str
+    dir_posts: str
+    dir_static: str
+    manifest_file: str
+    manifest: Dict[str, Any]
+    template: str
+    archive_template: str
+
+    def __init__(self, dir_site: str):
+        self.dir_site = dir_site
+        self.dir_posts = os.path.join(dir_site, "content", "crypto-gram-for-e-readers")
+        self.dir_static = os.path.join(dir_site, "static", "cryptogram")
+        self.manifest_file = os.path.join(dir_site, "data", "cryptogram.json")
+        dir_script = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(dir_script, "hugo-template.md"), encoding="utf-8") as f:
+            self.template = f.read()
+        with open(
+            os.path.join(dir_script, "hugo-archive-template.md"), encoding="utf-8"
+        ) as f:
+            self.archive_template = f.read()
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"issues": self.scan()}
+
+    def values(self, date: datetime.datetime) -> Dict[str, str]:
+        return {
+            "YYYY": date.strftime("%Y"),
+            "MM": date.strftime("%m"),
+            "DD": date.strftime("%d"),
+            "MONTH": date.strftime("%B"),
+            "month": date.strftime("%B").lower(),
+        }
+
+    def post_file(self, date: datetime.datetime) -> str:
+        name = render("_YYYY_-_MM_-_DD_-crypto-gram-_month_-_YYYY_", self.values(date))
+        return os.path.join(self.dir_posts, name + "-in-epub-and-mobi-format.md")
+
+    def file_name(self, date: datetime.datetime, fmt: str) -> str:
+        return f"cryptogram-{issue_key(date)}.{fmt}"
+
+    def scan(self) -> Dict[str, Any]:
+        # The issues published before the manifest existed, from the names
+        # of their posts and files
+        issues: Dict[str, Any] = {}
+        if not os.path.isdir(self.dir_posts):
+            return issues
+        for name in sorted(os.listdir(self.dir_posts)):
+            match = POST_RE.match(name)
+            if not match:
+                continue
+            year, month, day = (int(g) for g in match.groups())
+            date = datetime.datetime(year, month, day)
+            files = {}
+            for fmt in FORMATS:
+                path = os.path.join(self.dir_static, self.file_name(date, fmt))
+                if os.path.exists(path):
+                    files[fmt] = {
+                        "name": self.file_name(date, fmt),
+                        "sha256": file_digest(path),
+                    }
+            issues[issue_key(date)] = {
+                "date": date.strftime("%Y-%m-%d"),
+                "files": files,
+            }
+        return issues
+
+    def issue_date(self, issue: PublishedIssue) -> datetime.datetime:
+        # An issue published again keeps the date, and so the post, it had
+        entry = self.manifest["issues"].get(issue_key(issue.date))
+        if entry:
+            return datetime.datetime.strptime(entry["date"], "%Y-%m-%d")
+        return issue.date
+
+    def find_digest(self, digest: str) -> Optional[str]:
+        for entry in self.manifest["issues"].values():
+            for known in entry["files"].values():
+                path = os.path.join(self.dir_static, known["name"])
+                if known["sha256"] == digest and os.path.exists(path):
+                    return known["name"]
+        return None
+
+    def publish_files(self, issue: PublishedIssue) -> List[str]:
+        # Returns the files that were written
+        entry = self.manifest["issues"].setdefault(issue_key(issue.date), {})
+        entry["date"] = self.issue_date(issue).strftime("%Y-%m-%d")
+        files = entry.setdefault("files", {})
+        written = []
+        for fmt, source in sorted(issue.formats.items()):
+            name = self.file_name(issue.date, fmt)
+            target = os.path.join(self.dir_static, name)
+            digest = file_digest(source)
+            known = files.get(fmt)
+            if known and known["sha256"] == digest and os.path.exists(target):
+                continue
+            # The same content published under another name is shared
+            same = self.find_digest(digest)
+            if same and same != name:
+                link_file(os.path.join(self.dir_static, same), target)
+            else:
+                clone_file(source, target)
+            files[fmt] = {"name": name, "sha256": digest}
+            written.append(target)
+        return written
+
+    def update_aliases(self):
+        # cryptogram-last.* always point to the newest issue, also when older
+        # ones are backfilled
+        if not self.manifest["issues"]:
+            return
+        newest = self.manifest["issues"][max(self.manifest["issues"])]
+        for fmt, known in newest["files"].items():
+            link_file(
+                os.path.join(self.dir_static, known["name"]),
+                os.path.join(self.dir_static, f"cryptogram-last.{fmt}"),
+            )
+
+    def render_archive(self) -> str:
+        entries = []
+        for key in sorted(self.manifest["issues"], reverse=True):
+            issue = self.manifest["issues"][key]
+            date = datetime.datetime.strptime(issue["date"], "%Y-%m-%d")
+            values = self.values(date)
+            url = render(
+                "/_YYYY_/_MM_/_DD_/crypto-gram-_month_-_YYYY_-in-epub-and-mobi-format/",
+                values,
+            )
+            downloads = ", ".join(
+                f"[{fmt.upper()}](/cryptogram/{issue['files'][fmt]['name']})"
+                for fmt in FORMATS
+                if fmt in issue["files"]
+            )
+            entries.append(
+                render(f"  * [Crypto-Gram, _MONTH_ _YYYY_]({url}): ", values)
+                + downloads
+            )
+        return render(self.archive_template, {"ENTRIES": "\n".join(entries)})
+
+    def publish(self, issues: List[PublishedIssue]) -> List[str]:
+        # Returns the posts and files that were written
+        for directory in (self.dir_posts, self.dir_static):
+            if not os.path.isdir(directory):
+                raise PublishError(f"The directory {directory} doesn't exist")
+        written = []
+        for issue in sorted(issues, key=lambda i: i.date):
+            date = self.issue_date(issue)
+            written += self.publish_files(issue)
+            post_file = self.post_file(date)
+            if write_if_changed(post_file, render(self.template, self.values(date))):
+                written.append(post_file)
+        self.update_aliases()
+        archive_file = os.path.join(self.dir_posts, "crypto-gram-archive.md")
+        if write_if_changed(archive_file, self.render_archive()):
+            written.append(archive_file)
+        os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+        write_if_changed(
+            self.manifest_file, json.dumps(self.manifest, indent=2, sort_keys=True)
+        )
+        return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Publish Crypto-Gram issues on the bernardi.cloud Hugo repository"
+    )
+    parser.add_argument("--site", help="Hugo repository (default: ../bernardi.cloud)")
+    parser.add_argument(
+        "month", nargs="?", help="YYYY-MM of the issue (none to update the archive)"
+    )
+    parser.add_argument("files", nargs="*", help="EPUB and MOBI files of the issue")
+    args = parser.parse_args()
+    dir_site = args.site or find_site()
+    if not dir_site:
+        sys.exit(1)
+    issues = []
+    if args.month:
+        try:
+            date = datetime.datetime.strptime(args.month, "%Y-%m").replace(day=15)
+        except ValueError:
+            parser.error(f"{args.month} is not a YYYY-MM month")
+        formats = {os.path.splitext(f)[1][1:].lower(): f for f in args.files}
+        if not formats or set(formats) - set(FORMATS):
+            parser.error("an EPUB and/or a MOBI file is required")
+        issues.append(PublishedIssue(date, formats))
+    try:
+        for path in HugoPublisher(dir_site).publish(issues):
+            print(f"Written {path}")
+    except (OSError, PublishError) as e:
+        print(e)
+        sys.exit(1)
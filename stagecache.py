@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+#
+# Content-addressed cache of the pipeline artifacts (fetched pages,
+# decluttered XHTML, covers, ZIP bundles, MOBI and EPUB files). Each
+# artifact is stored under a hash of its inputs and of the version of the
+# code or tool that produced it, so a run that failed halfway (e.g. in the
+# final calibredb import) resumes without downloading and converting again.
+# The cache is kept under a size limit by removing the least recently used
+# artifacts, except those used by the current run.
+#
+# The shell scripts use it as a command wrapper:
+#
+#   python3 stagecache.py run -c covers.py -o cover.jpg -- python3 covers.py ...
+#   python3 stagecache.py run -i pippo.zip -i cover.jpg -t ebook-convert \
+#       -o pippo.mobi -- ebook-convert pippo.zip pippo.mobi --cover=cover.jpg
+#   python3 stagecache.py gc --max-bytes 500000000
+#
+
+import argparse
+import ast
+import functools
+import hashlib
+import inspect
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# Temporary files younger than this may still be written by another process
+TMP_GRACE_SECONDS = 3600
+
+
+def file_digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def bytes_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def files_digest(files: Dict[str, bytes]) -> str:
+    sha = hashlib.sha256()
+    for name in sorted(files):
+        sha.update(f"{name}:{bytes_digest(files[name])}\n".encode("utf-8"))
+    return sha.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(exe: str) -> str:
+    # Running "--version" would cost a Calibre start-up: the executable
+    # changes when the tool is upgraded, and so does this fingerprint
+    path = shutil.which(exe) or exe
+    try:
+        st = os.stat(os.path.realpath(path))
+    except OSError:
+        return f"{exe}:missing"
+    return f"{path}:{st.st_size}:{st.st_mtime_ns}"
+
+
+@functools.lru_cache(maxsize=None)
+def local_modules(source_file: str) -> Tuple[str, ...]:
+    # The source file and the modules next to it that it imports, directly
+    # or through the other local modules
+    dir_source = os.path.dirname(os.path.abspath(source_file))
+    found = [os.path.abspath(source_file)]
+    for path in found:
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = os.path.join(dir_source, name.split(".")[0] + ".py")
+                if module not in found and os.path.exists(module):
+                    found.append(module)
+    return tuple(sorted(found))
+
+
+def source_version(*source_files: str) -> str:
+    sha = hashlib.sha256()
+    modules = {path for source in source_files for path in local_modules(source)}
+    for path in sorted(modules):
+        sha.update(file_digest(path).encode("ascii"))
+    return sha.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def code_version(*objects: Any) -> str:
+    # The Python stages are versioned by the source of the modules that
+    # define the given modules, classes or functions, and of the local
+    # modules they import
+    return source_version(*(inspect.getsourcefile(obj) or "" for obj in objects))
+
+
+class StageCache:
+
+    dir_cache: str
+    max_bytes: int
+    lock: threading.Lock
+    # Artifacts read or written by this process, which gc() keeps
+    used: Set[str]
+
+    def __init__(self, dir_cache: str = "", max_bytes: int = DEFAULT_MAX_BYTES):
+        self.dir_cache = dir_cache or os.path.join(
+            os.path.expanduser("~"), ".cache", "calibre-utils", "stages"
+        )
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.used = set()
+        os.makedirs(self.dir_cache, exist_ok=True)
+
+    def key(self, stage: str, *parts: str) -> str:
+        sha = hashlib.sha256(stage.encode("utf-8"))
+        for part in parts:
+            # Length-prefixed, so that ("ab", "c") and ("a", "bc") differ
+            data = part.encode("utf-8")
+            sha.update(len(data).to_bytes(8, "big") + data)
+        return f"{stage}-{sha.hexdigest()}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.dir_cache, key.rsplit("-", 1)[-1][:2], key)
+
+    def use(self, path: str):
+        with self.lock:
+            self.used.add(path)
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        try:
+            # The modification time tells the garbage collector which
+            # artifacts have been used lately
+            os.utime(path)
+        except OSError:
+            return None
+        self.use(path)
+        return path
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        path = self.get(key)
+        if not path:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put_file(self, key: str, source: str):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, path)
+        self.use(path)
+
+    def put_bytes(self, key: str, content: bytes):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, path)
+        self.use(path)
+
+    def file_stage(self, key: str, output: str, produce: Callable[[], None]) -> bool:
+        # Copies the cached artifact to output, or produces and caches it;
+        # returns True for a cache hit. The output is a copy, since later
+        # steps may change it in place.
+        cached = self.get(key)
+        if cached:
+            shutil.copyfile(cached, output)
+            return True
+        produce()
+        self.put_file(key, output)
+        return False
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        result = []
+        for root, _, files in os.walk(self.dir_cache):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                result.append((st.st_mtime, st.st_size, path))
+        return result
+
+    def gc(self, max_bytes: Optional[int] = None) -> Tuple[int, int]:
+        # Removes the least recently used artifacts (and the temporary files
+        # left by interrupted runs) until the cache fits in max_bytes;
+        # returns the number of removed files and of freed bytes. The
+        # artifacts used by this process are kept: they may not have been
+        # imported yet.
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        removed, freed = 0, 0
+        stale = time.time() - TMP_GRACE_SECONDS
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                if path.endswith(".tmp"):
+                    if mtime > stale:
+                        continue
+                elif total <= limit or path in self.used:
+                    continue
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+                freed += size
+        return removed, freed
+
+
+def run_command(
+    cache: StageCache,
+    command: List[str],
+    outputs: List[str],
+    inputs: List[str],
+    keys: List[str],
+    tools: List[str],
+    code: List[str],
+) -> int:
+    parts = [file_digest(path) for path in inputs]
+    if code:
+        parts.append(source_version(*code))
+    parts += keys + [tool_version(tool) for tool in tools] + command
+    stage_keys = [
+        cache.key("run", *parts, os.path.basename(output)) for output in outputs
+    ]
+    cached = [cache.get(key) for key in stage_keys]
+    if all(cached):
+        for path, output in zip(cached, outputs):
+            shutil.copyfile(path or "", output)
+        return 0
+    returncode = subprocess.run(command).returncode
+    if returncode == 0:
+        for key, output in zip(stage_keys, outputs):
+            cache.put_file(key, output)
+    return returncode
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache of the pipeline artifacts")
+    parser.add_argument("--dir", default="", help="cache directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser(
+        "run", help="run a command unless its outputs are cached"
+    )
+    run_parser.add_argument(
+        "-i", "--input", action="append", default=[], help="input file"
+    )
+    run_parser.add_argument(
+        "-c",
+        "--code",
+        action="append",
+        default=[],
+        help="Python script to version, with the local modules it imports",
+    )
+    run_parser.add_argument(
+        "-k", "--key", action="append", default=[], help="additional key (e.g. URL)"
+    )
+    run_parser.add_argument(
+        "-t", "--tool", action="append", default=[], help="executable to version"
+    )
+    run_parser.add_argument(
+        "-o", "--output", action="append", required=True, help="output file"
+    )
+    run_parser.add_argument("cmd", nargs=argparse.REMAINDER, help="-- command")
+    gc_parser = subparsers.add_parser("gc", help="shrink the cache")
+    gc_parser.add_argument(
+        "--max-bytes", type=int, default=DEFAULT_MAX_BYTES, help="size limit"
+    )
+    subparsers.add_parser("stats", help="show the cache size")
+    args = parser.parse_args()
+    cache = StageCache(args.dir)
+    if args.command == "run":
+        cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+        if not cmd:
+            parser.error("no command to run")
+        sys.exit(
+            run_command(
+                cache, cmd, args.output, args.input, args.key, args.tool, args.code
+            )
+        )
+    elif args.command == "gc":
+        removed, freed = cache.gc(args.max_bytes)
+        print(f"Removed {removed} artifacts, {freed} bytes")
+    else:
+        entries = cache.entries()
+        size = sum(size for _, size, _ in entries)
+        print(f"{len(entries)} artifacts, {size} bytes in {cache.dir_cache}")
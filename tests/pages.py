@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+#
+# Sample pages shared by the tests
+#
+
+# An XHTML page as the sites serve it: the HTML parser keeps its namespace
+# declarations as plain attributes, and turns the XML declaration into a
+# comment
+XHTML_PAGE = b"""<?xml version='1.0' encoding='utf-8'?>
+<!-- generated -->
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="en" lang="en">
+<head><title>Sample</title></head>
+<body><!-- top -->
+<p epub:type="preamble" foo:bar="1" a"b="2">Intro <a href="#one">one</a><br data-x="1" bad:z="2"/>tail</p>
+<p class="MsoNormal">Word<o:p></o:p> <v:shape id="s1"><fb:like href="#">Like</fb:like> it</v:shape></p>
+<div id="toc"><a href="#one">One</a> <a href="#two">Two</a></div>
+<article class="post"><h2 id="one">One</h2><p>Text with <a href="https://example.org/">a link</a>
+and <img src="images/img1.png" alt=""/> an image.</p></article> after the article
+<div class="footer"><a href="/about">About</a></div>
+</body></html>
+"""
+
+# The same kind of page, as plain HTML
+HTML_PAGE = b"""<!DOCTYPE html>
+<html lang="en"><head><title>Sample</title></head>
+<body><nav id="toc"><a href="#one">One</a></nav>
+<p>Some <a href="/x">link</a> and<br>a break</p>
+<article><h2 id="one">One</h2><p>Text</p></article>
+</body></html>
+"""
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+
+from lxml import etree, html
+
+from epub import (
+    NS_XHTML,
+    NS_XML,
+    BookMetadata,
+    EpubBuilder,
+    XhtmlError,
+    check_xhtml,
+    serialize_xhtml,
+    to_xhtml,
+)
+from tests.pages import HTML_PAGE, XHTML_PAGE
+
+
+def xhtml(content: bytes) -> bytes:
+    return serialize_xhtml(to_xhtml(html.document_fromstring(content)))
+
+
+class ToXhtmlTest(unittest.TestCase):
+    def test_declares_the_namespace_once(self):
+        content = xhtml(XHTML_PAGE)
+        self.assertEqual(content.count(f'xmlns="{NS_XHTML}"'.encode()), 1)
+        root = etree.fromstring(content)
+        self.assertEqual(root.tag, f"{{{NS_XHTML}}}html")
+        self.assertEqual(root.get(f"{{{NS_XML}}}lang"), "en")
+
+    def test_is_idempotent(self):
+        for page in (XHTML_PAGE, HTML_PAGE):
+            content = xhtml(page)
+            self.assertEqual(xhtml(content), content)
+
+    def test_removes_the_attributes_invalid_in_xml(self):
+        root = etree.fromstring(xhtml(XHTML_PAGE))
+        p = root.find(f".//{{{NS_XHTML}}}p")
+        self.assertEqual(p.get("{http://www.idpf.org/2007/ops}type"), "preamble")
+        self.assertEqual(len(p.attrib), 1)
+        br = root.find(f".//{{{NS_XHTML}}}br")
+        self.assertEqual(dict(br.attrib), {"data-x": "1"})
+
+    def test_unwraps_the_elements_with_undeclared_prefixes(self):
+        content = xhtml(b"<html><body><p>text<o:p></o:p></p></body></html>")
+        p = etree.fromstring(content).find(f".//{{{NS_XHTML}}}p")
+        self.assertEqual((p.text, len(p)), ("text", 0))
+        root = etree.fromstring(xhtml(XHTML_PAGE))
+        p = root.find(f".//{{{NS_XHTML}}}p[@class='MsoNormal']")
+        self.assertEqual("".join(p.itertext()), "Word Like it")
+
+    def test_check_rejects_malformed_documents(self):
+        with self.assertRaises(XhtmlError):
+            check_xhtml(io.BytesIO(b"<html><p></html>"))
+        check_xhtml(io.BytesIO(xhtml(XHTML_PAGE)))
+
+
+class EpubBuilderTest(unittest.TestCase):
+    def test_writes_a_valid_archive(self):
+        epub = EpubBuilder(BookMetadata(title="Sample", authors=["Someone"]))
+        epub.add_files({"index.xhtml": XHTML_PAGE, "images/img1.png": b"PNG"})
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            epub_file = os.path.join(dir_tmp, "sample.epub")
+            epub.write(epub_file)
+            with zipfile.ZipFile(epub_file) as zipf:
+                first = zipf.infolist()[0]
+                self.assertEqual(first.filename, "mimetype")
+                self.assertEqual(first.compress_type, zipfile.ZIP_STORED)
+                self.assertIsNone(zipf.testzip())
+                for name in zipf.namelist():
+                    if name.endswith((".xhtml", ".opf", ".ncx", ".xml")):
+                        etree.fromstring(zipf.read(name))
+
+
+if __name__ == "__main__":
+    unittest.main()
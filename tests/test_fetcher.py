@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lxml import etree
+
+from epub import NS_XHTML
+from fetcher import PageFetcher, asset_extension
+from httpcache import CachedResponse
+
+
+class AssetExtensionTest(unittest.TestCase):
+    def test_content_type_first(self):
+        self.assertEqual(
+            asset_extension("https://a.org/img.php?id=3", "image/png", ".jpg"), ".png"
+        )
+        self.assertEqual(
+            asset_extension("https://a.org/s.aspx", "text/css; charset=utf-8", ".css"),
+            ".css",
+        )
+
+    def test_known_suffixes_only(self):
+        self.assertEqual(
+            asset_extension("https://a.org/a.gif", "application/octet-stream", ".jpg"),
+            ".gif",
+        )
+        self.assertEqual(asset_extension("https://a.org/img.php", "", ".jpg"), ".jpg")
+
+
+class FetchPageTest(unittest.TestCase):
+    def fetch(self, responses):
+        fetcher = PageFetcher()
+        fetcher.get = lambda url: responses[url]  # type: ignore
+        try:
+            return fetcher.fetch_page("https://a.org/x/page.html")
+        finally:
+            fetcher.executor.shutdown()
+
+    def test_charset_of_the_content_type(self):
+        page = CachedResponse(
+            "https://a.org/x/page.html",
+            200,
+            "<html><body><p>café</p></body></html>".encode("utf-8"),
+            {"Content-Type": "text/html; charset=UTF-8"},
+        )
+        doc = etree.fromstring(self.fetch({page.url: page}).files["index.xhtml"])
+        self.assertEqual(doc.findtext(f".//{{{NS_XHTML}}}p"), "café")
+
+    def test_base_href(self):
+        page = CachedResponse(
+            "https://a.org/x/page.html",
+            200,
+            b'<html><head><base href="/cdn/"></head>'
+            b'<body><img src="i.php"><img src="data:image/png;base64,AA=="></body></html>',
+            {"Content-Type": "text/html"},
+        )
+        image = CachedResponse(
+            "https://a.org/cdn/i.php", 200, b"PNG", {"Content-Type": "image/png"}
+        )
+        files = self.fetch({page.url: page, image.url: image}).files
+        self.assertEqual(files["images/img1.png"], b"PNG")
+        self.assertIn(b'src="data:image/png', files["index.xhtml"])
+
+
+if __name__ == "__main__":
+    unittest.main()
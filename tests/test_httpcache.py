@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+import requests
+
+from httpcache import HttpCache
+
+
+class FakeSession(requests.Session):
+    # 304 to the conditional requests, the page to the others
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):  # type: ignore
+        self.requests.append(dict(headers or {}))
+        response = requests.Response()
+        response.url = url
+        response.headers["ETag"] = '"v1"'
+        if headers and headers.get("If-None-Match") == '"v1"':
+            response.status_code = 304
+            response._content = b""
+        else:
+            response.status_code = 200
+            response._content = b"page"
+        return response
+
+
+class HttpCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_tmp = tempfile.TemporaryDirectory()
+        self.session = FakeSession()
+        self.cache = HttpCache(self.dir_tmp.name, session=self.session)
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir_tmp.cleanup()
+
+    def test_revalidates(self):
+        self.assertFalse(self.cache.get("https://a.org/").from_cache)
+        response = self.cache.get("https://a.org/")
+        self.assertTrue(response.from_cache)
+        self.assertEqual(response.content, b"page")
+        self.assertEqual(self.session.requests[-1], {"If-None-Match": '"v1"'})
+
+    def test_missing_body_is_a_miss(self):
+        url = "https://a.org/"
+        self.cache.get(url)
+        entry = self.cache.lookup(url)
+        lookup = self.cache.lookup
+        # Evicted by another process between the lookup and the read
+        self.cache.lookup = lambda url: entry  # type: ignore
+        os.unlink(self.cache.path(url))
+        response = self.cache.get(url)
+        self.assertEqual((response.status_code, response.content), (200, b"page"))
+        self.assertEqual(self.session.requests[-1], {})
+        self.assertFalse(response.from_cache)
+        # Stored again
+        self.assertIsNotNone(lookup(url))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import time
+import unittest
+
+from stagecache import TMP_GRACE_SECONDS, StageCache, local_modules
+
+
+class StageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_tmp = tempfile.TemporaryDirectory()
+        self.cache = StageCache(os.path.join(self.dir_tmp.name, "stages"))
+
+    def tearDown(self):
+        self.dir_tmp.cleanup()
+
+    def test_keys_are_length_prefixed(self):
+        self.assertNotEqual(
+            self.cache.key("s", "ab", "c"), self.cache.key("s", "a", "bc")
+        )
+        self.assertTrue(self.cache.key("s", "a").startswith("s-"))
+
+    def test_miss_then_hit(self):
+        key = self.cache.key("stage", "input")
+        self.assertIsNone(self.cache.get_bytes(key))
+        output = os.path.join(self.dir_tmp.name, "output")
+        calls = []
+
+        def produce():
+            calls.append(1)
+            with open(output, "wb") as f:
+                f.write(b"artifact")
+
+        self.assertFalse(self.cache.file_stage(key, output, produce))
+        os.remove(output)
+        self.assertTrue(self.cache.file_stage(key, output, produce))
+        self.assertEqual(len(calls), 1)
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), b"artifact")
+        self.assertEqual(self.cache.get_bytes(key), b"artifact")
+
+    def test_gc_removes_the_least_recently_used(self):
+        keys = [self.cache.key("stage", str(i)) for i in range(3)]
+        for i, key in enumerate(keys):
+            self.cache.put_bytes(key, b"x" * 100)
+            os.utime(self.cache.path(key), (1000 + i, 1000 + i))
+        # A new process, which hasn't used any of them
+        cache = StageCache(self.cache.dir_cache)
+        self.assertEqual(cache.gc(150), (2, 200))
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[2]))
+
+    def test_gc_keeps_the_artifacts_of_this_run(self):
+        key = self.cache.key("stage", "input")
+        self.cache.put_bytes(key, b"x" * 100)
+        self.assertEqual(self.cache.gc(0), (0, 0))
+        self.assertEqual(self.cache.get_bytes(key), b"x" * 100)
+
+    def test_gc_keeps_recent_temporary_files(self):
+        fresh = os.path.join(self.cache.dir_cache, "fresh.tmp")
+        stale = os.path.join(self.cache.dir_cache, "stale.tmp")
+        for path in (fresh, stale):
+            with open(path, "wb") as f:
+                f.write(b"partial")
+        old = time.time() - TMP_GRACE_SECONDS - 60
+        os.utime(stale, (old, old))
+        self.cache.gc()
+        self.assertTrue(os.path.exists(fresh))
+        self.assertFalse(os.path.exists(stale))
+
+    def test_local_modules(self):
+        dir_repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        names = [
+            os.path.basename(path)
+            for path in local_modules(os.path.join(dir_repo, "fetcher.py"))
+        ]
+        for name in ("fetcher.py", "epub.py", "httpcache.py", "zipwriter.py"):
+            self.assertIn(name, names)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+import zipfile
+
+from lxml import etree, html
+
+from epub import serialize_xhtml, to_xhtml
+import transforms
+from transforms import DocumentPipeline, TransformContext, transform_archive
+from tests.pages import HTML_PAGE, XHTML_PAGE
+
+
+class StreamTransformTest(unittest.TestCase):
+    def stream_and_tree(self, names, context, content, member):
+        pipeline = DocumentPipeline(names, context)
+        target = io.BytesIO()
+        changed = pipeline.apply_stream(io.BytesIO(content), target, member)
+        self.assertTrue(changed, "the document was not streamed")
+        return target.getvalue(), pipeline.apply_tree(content, member)
+
+    def assert_same_output(self, names, context):
+        fetched = serialize_xhtml(to_xhtml(html.document_fromstring(XHTML_PAGE)))
+        for content, member in (
+            (XHTML_PAGE, "index.xhtml"),
+            # The page as the fetcher writes it
+            (fetched, "index.xhtml"),
+            (HTML_PAGE, "index.html"),
+        ):
+            with self.subTest(member=member):
+                streamed, tree = self.stream_and_tree(names, context, content, member)
+                self.assertEqual(streamed, tree)
+                if member.endswith(".xhtml"):
+                    etree.fromstring(streamed)
+
+    def test_unwrap_nontoc_links(self):
+        self.assert_same_output(["unwrap-nontoc-links"], TransformContext())
+
+    def test_extract_article(self):
+        context = TransformContext(
+            title="Sample", heading="Sample", url="https://www.schneier.com/x/"
+        )
+        self.assert_same_output(["extract-article"], context)
+
+    def test_no_xml_declaration_in_the_body(self):
+        pipeline = DocumentPipeline(["unwrap-nontoc-links"], TransformContext())
+        target = io.BytesIO()
+        pipeline.apply_stream(io.BytesIO(XHTML_PAGE), target, "index.xhtml")
+        self.assertEqual(target.getvalue().count(b"?xml"), 1)
+        self.assertNotIn(b"generated", target.getvalue())
+
+    def test_big_documents_are_streamed(self):
+        pipeline = DocumentPipeline(["unwrap-nontoc-links"], TransformContext())
+        tree = pipeline.apply_tree(XHTML_PAGE)
+        with mock.patch.object(transforms, "STREAM_THRESHOLD", 0), mock.patch.object(
+            pipeline, "apply_tree", side_effect=AssertionError("not streamed")
+        ):
+            self.assertEqual(pipeline.apply(XHTML_PAGE), tree)
+
+
+class TransformArchiveTest(unittest.TestCase):
+    def test_only_the_documents_change(self):
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            archive = os.path.join(dir_tmp, "pippo.zip")
+            with zipfile.ZipFile(archive, "w") as zipf:
+                zipf.writestr("html/index.xhtml", XHTML_PAGE)
+                zipf.writestr("html/images/img1.png", b"PNG")
+            output = os.path.join(dir_tmp, "out.zip")
+            transform_archive(archive, ["unwrap-nontoc-links"], [], output=output)
+            with zipfile.ZipFile(output) as zipf:
+                self.assertIsNone(zipf.testzip())
+                self.assertEqual(zipf.read("html/images/img1.png"), b"PNG")
+                doc = etree.fromstring(zipf.read("html/index.xhtml"))
+            self.assertEqual(len(doc.findall(".//{*}a")), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+
+from zipwriter import EPUB_MIMETYPE, ZipWriter, patch_archive
+
+
+class PatchArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_tmp = tempfile.TemporaryDirectory()
+        self.epub = os.path.join(self.dir_tmp.name, "book.epub")
+        with ZipWriter(self.epub, epub=True) as writer:
+            writer.add_files(
+                {
+                    "OEBPS/index.xhtml": b"<html>old</html>" * 100,
+                    "OEBPS/images/img1.png": b"PNG" * 100,
+                    "OEBPS/toc.html": b"<html>toc</html>",
+                }
+            )
+
+    def tearDown(self):
+        self.dir_tmp.cleanup()
+
+    def assert_valid_epub(self, path: str):
+        with zipfile.ZipFile(path) as zipf:
+            first = zipf.infolist()[0]
+            self.assertEqual(first.filename, "mimetype")
+            self.assertEqual(first.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zipf.read("mimetype"), EPUB_MIMETYPE)
+            self.assertIsNone(zipf.testzip())
+
+    def test_replaces_removes_and_adds_members(self):
+        patch_archive(
+            self.epub,
+            {
+                "OEBPS/index.xhtml": b"<html>new</html>",
+                "OEBPS/toc.html": None,
+                "OEBPS/extra.css": io.BytesIO(b"body {}"),
+            },
+        )
+        self.assert_valid_epub(self.epub)
+        with zipfile.ZipFile(self.epub) as zipf:
+            self.assertEqual(
+                zipf.namelist(),
+                [
+                    "mimetype",
+                    "OEBPS/index.xhtml",
+                    "OEBPS/images/img1.png",
+                    "OEBPS/extra.css",
+                ],
+            )
+            self.assertEqual(zipf.read("OEBPS/index.xhtml"), b"<html>new</html>")
+            self.assertEqual(zipf.read("OEBPS/images/img1.png"), b"PNG" * 100)
+            self.assertEqual(zipf.read("OEBPS/extra.css"), b"body {}")
+
+    def test_copies_the_other_members_as_they_are(self):
+        output = os.path.join(self.dir_tmp.name, "patched.epub")
+        patch_archive(self.epub, {"OEBPS/toc.html": b"<html>new toc</html>"}, output)
+        self.assert_valid_epub(output)
+        with zipfile.ZipFile(self.epub) as source, zipfile.ZipFile(output) as target:
+            for name in ("OEBPS/index.xhtml", "OEBPS/images/img1.png"):
+                old, new = source.getinfo(name), target.getinfo(name)
+                self.assertEqual(
+                    (old.CRC, old.compress_size, old.compress_type),
+                    (new.CRC, new.compress_size, new.compress_type),
+                )
+
+    def test_replaces_the_mimetype(self):
+        patch_archive(self.epub, {"mimetype": EPUB_MIMETYPE})
+        self.assert_valid_epub(self.epub)
+
+    def test_mimetype_of_other_archives(self):
+        archive = os.path.join(self.dir_tmp.name, "other.zip")
+        with ZipWriter(archive) as writer:
+            writer.add("index.html", b"<html></html>")
+            writer.add("mimetype", b"text/plain")
+        with zipfile.ZipFile(archive) as zipf:
+            self.assertEqual(zipf.namelist(), ["index.html", "mimetype"])
+            self.assertEqual(zipf.read("mimetype"), b"text/plain")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+# Stage tracing for the conversion pipelines. Each Python stage (fetch,
+# declutter, cover, ...) and each external command is recorded with its
+# wall and CPU time, exit status, bytes read and written and, for external
+# commands, the peak memory of the child process. The records are written
+# as JSON lines while the run goes on and summarized in a table at the end.
+# When tracing is disabled NullTracer is used, which only runs the stages.
+#
+#   python3 tracing.py trace.jsonl   (prints the summary of a trace file)
+#
+
+import argparse
+import contextlib
+from dataclasses import asdict, dataclass, field
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, IO, Iterator, List, Optional, Sequence
+
+
+@dataclass
+class StageRecord:
+    stage: str
+    label: str = ""
+    start: float = 0.0
+    wall: float = 0.0
+    cpu: float = 0.0
+    status: str = "ok"
+    bytes_in: int = 0
+    bytes_out: int = 0
+    child_max_rss_kib: Optional[int] = None
+    command: List[str] = field(default_factory=list)
+
+
+def file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def read_pipe(pipe: IO[bytes], chunks: List[bytes]):
+    chunks.append(pipe.read())
+    pipe.close()
+
+
+def exit_code(status: int) -> int:
+    # Like subprocess: negative for a signal (os.waitstatus_to_exitcode()
+    # needs Python 3.9)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Tracer:
+
+    records: List[StageRecord]
+    lock: threading.Lock
+    trace_file: Optional[IO[str]]
+
+    def __init__(self, trace_file: Optional[str] = None):
+        self.records = []
+        self.lock = threading.Lock()
+        self.trace_file = (
+            open(trace_file, "a", encoding="utf-8") if trace_file else None
+        )
+
+    def emit(self, record: StageRecord):
+        with self.lock:
+            self.records.append(record)
+            if self.trace_file:
+                self.trace_file.write(json.dumps(asdict(record)) + "\n")
+                self.trace_file.flush()
+
+    @contextlib.contextmanager
+    def stage(
+        self,
+        name: str,
+        label: str = "",
+        inputs: Sequence[str] = (),
+        outputs: Sequence[str] = (),
+    ) -> Iterator[StageRecord]:
+        # The stage can add its own bytes_in and bytes_out to the record;
+        # the sizes of the inputs and outputs files are added here
+        record = StageRecord(name, label, time.time())
+        record.bytes_in = sum(file_size(path) for path in inputs)
+        start = time.perf_counter()
+        # Stages run in worker threads, so only this thread's CPU counts
+        cpu_start = time.thread_time()
+        try:
+            yield record
+        except BaseException as e:
+            record.status = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record.wall = time.perf_counter() - start
+            record.cpu = time.thread_time() - cpu_start
+            record.bytes_out += sum(file_size(path) for path in outputs)
+            self.emit(record)
+
+    def run(
+        self,
+        cmd: List[str],
+        stage: str,
+        label: str = "",
+        inputs: Sequence[str] = (),
+        outputs: Sequence[str] = (),
+        capture_output: bool = False,
+    ) -> subprocess.CompletedProcess:
+        record = StageRecord(stage, label, time.time(), command=list(cmd))
+        record.bytes_in = sum(file_size(path) for path in inputs)
+        start = time.perf_counter()
+        pipe = subprocess.PIPE if capture_output else None
+        proc = subprocess.Popen(cmd, stdout=pipe, stderr=pipe)
+        stdout: Optional[bytes] = None
+        stderr: Optional[bytes] = None
+        if not hasattr(os, "wait4"):
+            # Windows: no resource usage of the child
+            stdout, stderr = proc.communicate()
+            record.wall = time.perf_counter() - start
+        else:
+            # The pipes are drained by threads, so that the child can be
+            # reaped with wait4(), which returns its own resource usage
+            readers: List[threading.Thread] = []
+            output: Dict[str, List[bytes]] = {"stdout": [], "stderr": []}
+            for name in output:
+                stream = getattr(proc, name)
+                if stream:
+                    reader = threading.Thread(
+                        target=read_pipe, args=(stream, output[name])
+                    )
+                    reader.start()
+                    readers.append(reader)
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = exit_code(status)
+            for reader in readers:
+                reader.join()
+            if capture_output:
+                stdout = b"".join(output["stdout"])
+                stderr = b"".join(output["stderr"])
+            record.wall = time.perf_counter() - start
+            record.cpu = rusage.ru_utime + rusage.ru_stime
+            # Linux reports KiB, macOS bytes
+            maxrss = rusage.ru_maxrss
+            record.child_max_rss_kib = (
+                maxrss // 1024 if sys.platform == "darwin" else maxrss
+            )
+        record.status = "ok" if proc.returncode == 0 else f"exit {proc.returncode}"
+        record.bytes_out = sum(file_size(path) for path in outputs)
+        self.emit(record)
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+    def summary(self) -> str:
+        return format_summary(self.records)
+
+    def close(self):
+        if self.trace_file:
+            self.trace_file.close()
+            self.trace_file = None
+
+
+class NullTracer(Tracer):
+    def __init__(self):
+        super().__init__()
+
+    @contextlib.contextmanager
+    def stage(
+        self,
+        name: str,
+        label: str = "",
+        inputs: Sequence[str] = (),
+        outputs: Sequence[str] = (),
+    ) -> Iterator[StageRecord]:
+        yield StageRecord(name)
+
+    def run(
+        self,
+        cmd: List[str],
+        stage: str,
+        label: str = "",
+        inputs: Sequence[str] = (),
+        outputs: Sequence[str] = (),
+        capture_output: bool = False,
+    ) -> subprocess.CompletedProcess:
+        return subprocess.run(cmd, capture_output=capture_output)
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def format_summary(records: List[StageRecord]) -> str:
+    stages: Dict[str, List[StageRecord]] = {}
+    for record in records:
+        stages.setdefault(record.stage, []).append(record)
+    lines = [
+        f"{'stage':<14} {'count':>5} {'errors':>6} {'total s':>9} {'mean s':>8} "
+        f"{'max s':>8} {'cpu s':>8} {'in':>10} {'out':>10} {'child RSS':>10}"
+    ]
+    for name, stage_records in stages.items():
+        walls = [r.wall for r in stage_records]
+        rss = [r.child_max_rss_kib for r in stage_records if r.child_max_rss_kib]
+        lines.append(
+            f"{name:<14} {len(stage_records):>5} "
+            f"{sum(r.status != 'ok' for r in stage_records):>6} "
+            f"{sum(walls):>9.2f} {sum(walls) / len(walls):>8.2f} {max(walls):>8.2f} "
+            f"{sum(r.cpu for r in stage_records):>8.2f} "
+            f"{format_bytes(sum(r.bytes_in for r in stage_records)):>10} "
+            f"{format_bytes(sum(r.bytes_out for r in stage_records)):>10} "
+            f"{format_bytes(max(rss) * 1024) if rss else '-':>10}"
+        )
+    return "\n".join(lines)
+
+
+def load_trace(trace_file: str) -> List[StageRecord]:
+    records = []
+    with open(trace_file, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                data: Dict[str, Any] = json.loads(line)
+                records.append(StageRecord(**data))
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a JSON lines trace")
+    parser.add_argument("trace_file")
+    args = parser.parse_args()
+    try:
+        print(format_summary(load_trace(args.trace_file)))
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Cannot read {args.trace_file}: {e}")
+        sys.exit(1)
@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*-
+#
+# Transform engine for HTML documents and e-book archives. Each document
+# is parsed once, goes through a chain of registered transforms and is
+# serialized once; archives (ZIP bundles, EPUBs) are transformed in place,
+# rewriting only the members that actually changed. Large documents are
+# transformed as streams, when the transform supports it: the document is
+# written while it's being parsed and the parts already written are
+# discarded, so memory doesn't grow with the size of the page.
+#
+# Available transforms:
+#
+# - extract-article: keep only the main content of the page (see
+#   extract.py), under an <h1> heading
+# - unwrap-nontoc-links: turn the links outside the table of contents into
+#   <span>s, for a better TOC detection by ebook-convert
+# - remove-inline-toc: drop the hard wired TOC page that ebook-convert adds
+#   to an EPUB converted from MOBI (OPF manifest, spine and guide included)
+#
+# lxml
+#
+
+import argparse
+from contextlib import contextmanager
+from dataclasses import dataclass
+import io
+import posixpath
+import sys
+import tempfile
+from typing import Any, Callable, Dict, IO, Iterator, List, Mapping, Optional, Set
+import zipfile
+
+from lxml import etree, html
+
+from epub import (
+    NS_OPF,
+    NS_XHTML,
+    NS_XML,
+    XhtmlError,
+    check_xhtml,
+    is_xml_element_name,
+    remove_invalid_attributes,
+    root_prefixes,
+    serialize_xhtml,
+    to_xhtml,
+    unwrap_invalid_elements,
+    xhtml_root_attributes,
+    xml_attributes,
+)
+from extract import drop, extract_content, find_rule
+from zipwriter import Member, patch_archive
+
+DOCUMENT_EXTENSIONS = (".xhtml", ".html", ".htm")
+# Bigger documents are streamed, when the pipeline allows it
+STREAM_THRESHOLD = 1024 * 1024
+
+TOC_XPATH = etree.XPath("//table[@id='toc'] | //div[@id='toc'] | //nav[@id='toc']")
+TOC_TAGS = ("table", "div", "nav")
+VOID_ELEMENTS = frozenset(
+    [
+        "area",
+        "base",
+        "br",
+        "col",
+        "embed",
+        "hr",
+        "img",
+        "input",
+        "link",
+        "meta",
+        "param",
+        "source",
+        "track",
+        "wbr",
+    ]
+)
+
+
+class TransformError(Exception):
+    pass
+
+
+@dataclass
+class TransformContext:
+    title: str = ""
+    heading: str = ""
+    member: str = ""
+    # Where the document comes from, for the site rules
+    url: str = ""
+
+
+# A document transform returns the (possibly new) root element, or None if
+# the document didn't need any change
+DocumentTransform = Callable[
+    [etree._Element, TransformContext], Optional[etree._Element]
+]
+# An archive transform gets the archive and the members rewritten so far
+# (None for deleted members), which it can update
+ArchiveTransform = Callable[
+    [zipfile.ZipFile, Dict[str, Optional[Member]], TransformContext], None
+]
+# A stream transform reads the document from the first file and writes the
+# result to the second one; it returns False if the document didn't need
+# any change, or None if it cannot stream this document (the document
+# transform with the same name is used instead)
+StreamTransform = Callable[[IO[bytes], IO[bytes], TransformContext], Optional[bool]]
+
+DOCUMENT_TRANSFORMS: Dict[str, DocumentTransform] = {}
+ARCHIVE_TRANSFORMS: Dict[str, ArchiveTransform] = {}
+STREAM_TRANSFORMS: Dict[str, StreamTransform] = {}
+
+
+def document_transform(name: str) -> Callable[[DocumentTransform], DocumentTransform]:
+    def register(transform: DocumentTransform) -> DocumentTransform:
+        DOCUMENT_TRANSFORMS[name] = transform
+        return transform
+
+    return register
+
+
+def archive_transform(name: str) -> Callable[[ArchiveTransform], ArchiveTransform]:
+    def register(transform: ArchiveTransform) -> ArchiveTransform:
+        ARCHIVE_TRANSFORMS[name] = transform
+        return transform
+
+    return register
+
+
+def stream_transform(name: str) -> Callable[[StreamTransform], StreamTransform]:
+    def register(transform: StreamTransform) -> StreamTransform:
+        STREAM_TRANSFORMS[name] = transform
+        return transform
+
+    return register
+
+
+def discard(element: etree._Element):
+    # The element has been used: its subtree and the siblings before it
+    # aren't needed anymore, the tail still is
+    element.clear(keep_tail=True)
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+@contextmanager
+def stream_output(target: IO[bytes], member: str) -> Iterator[Any]:
+    # XHTML like to_xhtml(), or HTML
+    if is_xhtml(member):
+        with etree.xmlfile(target, encoding="utf-8") as xf:
+            xf.write_declaration()
+            yield xf
+    else:
+        with etree.htmlfile(target, encoding="utf-8") as xf:
+            xf.write_doctype("<!DOCTYPE html>")
+            yield xf
+
+
+def is_xhtml(member: str) -> bool:
+    return member.lower().endswith(".xhtml")
+
+
+def root_element(xf: Any, member: str, attrib: Mapping[str, str]) -> Any:
+    # Only the root needs the XHTML namespace, the children inherit it
+    if is_xhtml(member):
+        xhtml_attrib, nsmap = xhtml_root_attributes(attrib)
+        # The XML writer would map the xml namespace to a new prefix
+        xhtml_attrib = {
+            name.replace(f"{{{NS_XML}}}", "xml:"): value
+            for name, value in xhtml_attrib.items()
+        }
+        return xf.element(f"{{{NS_XHTML}}}html", xhtml_attrib, nsmap=nsmap)
+    return xf.element("html", dict(attrib))
+
+
+class StreamWriter:
+
+    xf: Any
+    member: str
+    xhtml: bool
+    # None for the unwrapped elements
+    open_elements: List[Optional[Any]]
+    # Namespace prefixes declared by the open elements, as in to_xhtml()
+    prefixes: List[Set[str]]
+
+    def __init__(self, xf: Any, member: str):
+        # Writes the document as iterparse() reads it: start tags as soon as
+        # they're parsed, texts and tails as soon as they're complete
+        self.xf = xf
+        self.member = member
+        self.xhtml = is_xhtml(member)
+        self.open_elements = []
+        self.prefixes = []
+
+    def text_before(self, node: etree._Element):
+        parent = node.getparent()
+        if parent is None:
+            return
+        previous = node.getprevious()
+        text = parent.text if previous is None else previous.tail
+        if text:
+            self.xf.write(text)
+
+    def attributes(self, element: etree._Element) -> Dict[str, str]:
+        # The XML writer doesn't check the attribute names
+        attrib = dict(element.attrib)
+        if self.xhtml:
+            prefixes = set(self.prefixes[-1])
+            for name in xml_attributes(attrib, prefixes):
+                del attrib[name]
+            self.prefixes.append(prefixes)
+        return attrib
+
+    def start(self, element: etree._Element):
+        self.text_before(element)
+        if element.tag in VOID_ELEMENTS:
+            return
+        if element.getparent() is None:
+            writer = root_element(self.xf, self.member, element.attrib)
+            if self.xhtml:
+                nsmap = xhtml_root_attributes(element.attrib)[1]
+                self.prefixes.append(root_prefixes(nsmap))
+        elif self.xhtml and not is_xml_element_name(element.tag):
+            # Only the content, as in to_xhtml()
+            self.prefixes.append(self.prefixes[-1])
+            self.open_elements.append(None)
+            return
+        else:
+            writer = self.xf.element(element.tag, self.attributes(element))
+        writer.__enter__()
+        self.open_elements.append(writer)
+
+    def comment(self, comment: etree._Element):
+        # Outside of the root, as the XML declaration read by the HTML
+        # parser, the comments are dropped like in the tree path
+        if comment.getparent() is None:
+            return
+        self.text_before(comment)
+        self.xf.write(comment, with_tail=False)
+
+    def end(self, element: etree._Element):
+        if element.tag in VOID_ELEMENTS:
+            if self.xhtml:
+                remove_invalid_attributes(element, self.prefixes[-1])
+            self.xf.write(element, with_tail=False)
+        else:
+            text = element[-1].tail if len(element) else element.text
+            if text:
+                self.xf.write(text)
+            writer = self.open_elements.pop()
+            if writer is not None:
+                writer.__exit__(None, None, None)
+            if self.xhtml:
+                self.prefixes.pop()
+        discard(element)
+
+
+@document_transform("extract-article")
+def extract_article(
+    doc: etree._Element, context: TransformContext
+) -> Optional[etree._Element]:
+    content = extract_content(doc, context.url)
+    if content is None:
+        raise TransformError("could not find the content of the page")
+    root = html.Element("html")
+    head = etree.SubElement(root, "head")
+    etree.SubElement(head, "title").text = context.title
+    body = etree.SubElement(root, "body")
+    if context.heading:
+        etree.SubElement(body, "h1").text = context.heading
+    # Whatever follows the content isn't part of it (and isn't even parsed
+    # when streaming)
+    content.tail = None
+    body.append(content)
+    return root
+
+
+@stream_transform("extract-article")
+def stream_extract_article(
+    source: IO[bytes], target: IO[bytes], context: TransformContext
+) -> Optional[bool]:
+    # Only for the site rules that keep an element by its tag: the rest
+    # of the page is discarded while it's parsed, and nothing after the
+    # content is parsed at all
+    rule = find_rule(context.url)
+    if rule is None or not rule.tag:
+        return None
+    content = None
+    for event, element in etree.iterparse(source, events=("start", "end"), html=True):
+        if content is None:
+            if event == "start" and element.tag == rule.tag:
+                content = element
+            elif event == "end":
+                discard(element)
+        elif element is content and event == "end":
+            break
+    else:
+        # Not found, the page may need the scoring
+        return None
+    if rule.remove is not None:
+        for element in rule.remove(content):
+            drop(element)
+    if is_xhtml(context.member):
+        unwrap_invalid_elements(content)
+        remove_invalid_attributes(content, root_prefixes({None: NS_XHTML}))
+    with stream_output(target, context.member) as xf:
+        with root_element(xf, context.member, {}):
+            with xf.element("head"):
+                with xf.element("title"):
+                    xf.write(context.title)
+            with xf.element("body"):
+                if context.heading:
+                    with xf.element("h1"):
+                        xf.write(context.heading)
+                xf.write(content, with_tail=False)
+    return True
+
+
+@document_transform("unwrap-nontoc-links")
+def unwrap_nontoc_links(
+    doc: etree._Element, context: TransformContext
+) -> Optional[etree._Element]:
+    toc_list = TOC_XPATH(doc)
+    if not toc_list:
+        print(f"Could not detect TOC in {context.member or 'the document'}")
+        return None
+    toc = toc_list[0]
+    changed = False
+    for a in doc.iter("a"):
+        if toc in a.iterancestors():
+            continue
+        # Same as replacing <a ...> with <span ...>: the attributes stay
+        a.tag = "span"
+        changed = True
+    return doc if changed else None
+
+
+def is_toc(element: etree._Element) -> bool:
+    return element.tag in TOC_TAGS and element.get("id") == "toc"
+
+
+@stream_transform("unwrap-nontoc-links")
+def stream_unwrap_nontoc_links(
+    source: IO[bytes], target: IO[bytes], context: TransformContext
+) -> Optional[bool]:
+    # A first pass looks for the TOC, since the links before it are
+    # unwrapped too
+    for _, element in etree.iterparse(source, events=("end",), html=True):
+        if is_toc(element):
+            break
+        discard(element)
+    else:
+        print(f"Could not detect TOC in {context.member or 'the document'}")
+        return False
+    source.seek(0)
+    toc = None
+    in_toc = False
+    changed = False
+    with stream_output(target, context.member) as xf:
+        writer = StreamWriter(xf, context.member)
+        for event, node in etree.iterparse(
+            source, events=("start", "end", "comment"), html=True
+        ):
+            if event == "comment":
+                writer.comment(node)
+            elif event == "start":
+                if toc is None and is_toc(node):
+                    toc = node
+                    in_toc = True
+                elif node.tag == "a" and not in_toc:
+                    node.tag = "span"
+                    changed = True
+                writer.start(node)
+            else:
+                if node is toc:
+                    in_toc = False
+                writer.end(node)
+    return changed
+
+
+def find_opf(epub: zipfile.ZipFile) -> Optional[str]:
+    try:
+        container = etree.fromstring(epub.read("META-INF/container.xml"))
+    except (KeyError, etree.XMLSyntaxError):
+        return None
+    for rootfile in container.iter("{*}rootfile"):
+        return rootfile.get("full-path")
+    return None
+
+
+@archive_transform("remove-inline-toc")
+def remove_inline_toc(
+    epub: zipfile.ZipFile,
+    replacements: Dict[str, Optional[Member]],
+    context: TransformContext,
+):
+    opf_name = find_opf(epub)
+    if not opf_name:
+        raise TransformError("not an EPUB: META-INF/container.xml not found")
+    opf_content = replacements.get(opf_name) or epub.read(opf_name)
+    opf = etree.fromstring(opf_content)
+    dir_opf = posixpath.dirname(opf_name)
+    # The inline TOC is the last HTML file next to the OPF, as in
+    # "ls *.html | tail -n 1"
+    items = [
+        item
+        for item in opf.iter(f"{{{NS_OPF}}}item")
+        if (item.get("href") or "").endswith(".html") and "/" not in item.get("href")
+    ]
+    if not items:
+        return
+    last = max(items, key=lambda item: item.get("href"))
+    href = last.get("href")
+    last.getparent().remove(last)
+    for itemref in opf.iter(f"{{{NS_OPF}}}itemref"):
+        if itemref.get("idref") == last.get("id"):
+            itemref.getparent().remove(itemref)
+    for reference in opf.iter(f"{{{NS_OPF}}}reference"):
+        if (reference.get("href") or "").split("#")[0] == href:
+            reference.getparent().remove(reference)
+    replacements[opf_name] = etree.tostring(opf, encoding="utf-8", xml_declaration=True)
+    replacements[posixpath.join(dir_opf, href)] = None
+
+
+class DocumentPipeline:
+
+    transforms: List[DocumentTransform]
+    stream: Optional[StreamTransform]
+    context: TransformContext
+
+    def __init__(self, names: List[str], context: Optional[TransformContext] = None):
+        unknown = [name for name in names if name not in DOCUMENT_TRANSFORMS]
+        if unknown:
+            raise TransformError("unknown transforms: " + ", ".join(unknown))
+        self.transforms = [DOCUMENT_TRANSFORMS[name] for name in names]
+        # Only single transforms are streamed
+        self.stream = STREAM_TRANSFORMS.get(names[0]) if len(names) == 1 else None
+        self.context = context or TransformContext()
+
+    def apply_stream(
+        self, source: IO[bytes], target: IO[bytes], member: str = "index.xhtml"
+    ) -> Optional[bool]:
+        # Returns whether the document changed, or None if it cannot be
+        # streamed: then the source is rewound and the target emptied
+        self.context.member = member
+        result = None
+        if self.stream:
+            try:
+                result = self.stream(source, target, self.context)
+            except ValueError:
+                # e.g. names that are fine in HTML but not in XML
+                result = None
+        if result and is_xhtml(member):
+            # Same check as in the tree path
+            target.seek(0)
+            try:
+                check_xhtml(target)
+            except XhtmlError:
+                result = None
+            target.seek(0, io.SEEK_END)
+        if result is None:
+            source.seek(0)
+            target.seek(0)
+            target.truncate()
+        return result
+
+    def apply(self, content: bytes, member: str = "index.xhtml") -> Optional[bytes]:
+        # Returns the new content, or None if no transform changed anything
+        if self.stream and len(content) > STREAM_THRESHOLD:
+            target = io.BytesIO()
+            changed = self.apply_stream(io.BytesIO(content), target, member)
+            if changed is not None:
+                return target.getvalue() if changed else None
+        return self.apply_tree(content, member)
+
+    def apply_tree(
+        self, content: bytes, member: str = "index.xhtml"
+    ) -> Optional[bytes]:
+        self.context.member = member
+        doc = html.document_fromstring(content)
+        changed = False
+        for transform in self.transforms:
+            result = transform(doc, self.context)
+            if result is not None:
+                doc = result
+                changed = True
+        if not changed:
+            return None
+        if is_xhtml(member):
+            # The documents go into EPUBs: they must be well-formed XML
+            try:
+                return serialize_xhtml(to_xhtml(doc))
+            except XhtmlError as e:
+                raise TransformError(f"{member}: {e}")
+        return html.tostring(doc, encoding="utf-8", doctype="<!DOCTYPE html>")
+
+
+def transform_archive(
+    archive: str,
+    document_transforms: List[str],
+    archive_transforms: List[str],
+    context: Optional[TransformContext] = None,
+    output: Optional[str] = None,
+):
+    context = context or TransformContext()
+    unknown = [name for name in archive_transforms if name not in ARCHIVE_TRANSFORMS]
+    if unknown:
+        raise TransformError("unknown transforms: " + ", ".join(unknown))
+    pipeline = DocumentPipeline(document_transforms, context)
+    replacements: Dict[str, Optional[Member]] = {}
+    spools = []
+    try:
+        with zipfile.ZipFile(archive) as source:
+            if document_transforms:
+                for info in source.infolist():
+                    name = info.filename
+                    if not name.lower().endswith(DOCUMENT_EXTENSIONS):
+                        continue
+                    if pipeline.stream and info.file_size > STREAM_THRESHOLD:
+                        # Straight from the member to a temporary file
+                        spool = tempfile.SpooledTemporaryFile(STREAM_THRESHOLD)
+                        spools.append(spool)
+                        with source.open(info) as member:
+                            changed = pipeline.apply_stream(member, spool, name)
+                        if changed is not None:
+                            if changed:
+                                spool.seek(0)
+                                replacements[name] = spool
+                            continue
+                    content = pipeline.apply_tree(source.read(name), name)
+                    if content is not None:
+                        replacements[name] = content
+            for transform_name in archive_transforms:
+                ARCHIVE_TRANSFORMS[transform_name](source, replacements, context)
+        if replacements or (output and output != archive):
+            patch_archive(archive, replacements, output)
+    finally:
+        for spool in spools:
+            spool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Transform HTML documents, ZIP bundles and EPUBs"
+    )
+    parser.add_argument("file", help="HTML document or archive, changed in place")
+    parser.add_argument("-o", "--output", help="output file")
+    parser.add_argument(
+        "-t",
+        "--transform",
+        action="append",
+        default=[],
+        choices=sorted(list(DOCUMENT_TRANSFORMS) + list(ARCHIVE_TRANSFORMS)),
+        help="transform to apply, in the given order",
+    )
+    parser.add_argument("--title", default="", help="title of the documents")
+    parser.add_argument("--heading", default="", help="heading of the documents")
+    parser.add_argument("--url", default="", help="source URL, for the site rules")
+    args = parser.parse_args()
+    context = TransformContext(title=args.title, heading=args.heading, url=args.url)
+    try:
+        if zipfile.is_zipfile(args.file):
+            transform_archive(
+                args.file,
+                [t for t in args.transform if t in DOCUMENT_TRANSFORMS],
+                [t for t in args.transform if t in ARCHIVE_TRANSFORMS],
+                context,
+                args.output,
+            )
+        else:
+            with open(args.file, "rb") as source:
+                content = DocumentPipeline(args.transform, context).apply(
+                    source.read(), args.file
+                )
+            if content is not None:
+                with open(args.output or args.file, "wb") as target:
+                    target.write(content)
+    except TransformError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+#
+# Local web page ingest service for Calibre. URLs (with an optional title
+# and tags) are submitted over HTTP on localhost, kept in a persistent
+# queue that ignores already submitted URLs (and the import index the pages
+# already in the library), and imported by a pool of workers, each with
+# its own work directory: download, extraction of the main content, cover,
+# EPUB and Calibre import. The books converted at the same time are
+# imported with a single calibredb call.
+#
+#   python3 webpage2calibred.py serve --workers 4
+#   python3 webpage2calibred.py submit --title "Some title" https://...
+#   python3 webpage2calibred.py submit --file read-it-later-export.txt
+#   python3 webpage2calibred.py status
+#
+# submit starts the service when it isn't already running. The service only
+# accepts JSON requests without an Origin header (so web pages can't submit
+# anything) and with the token in ~/.webpage2calibre/token, readable only by
+# its owner.
+#
+# lxml, Pillow, requests, Calibre
+#
+
+import argparse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import io
+import json
+import os
+import shutil
+import sqlite3
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+from lxml import html
+
+from covers import CoverRenderer
+from epub import BookMetadata, EpubBuilder, check_xhtml
+from extract import drop_unreferenced
+from fetcher import FetchedPage, PageFetcher
+from httpcache import HttpCache
+from images import ImageOptimizer
+from importindex import ImportIndex
+from library import CalibreLibrary, LibraryError
+from stagecache import StageCache, bytes_digest
+from transforms import DocumentPipeline, TransformContext, TransformError
+
+DEFAULT_PORT = 8717
+DEFAULT_TAGS = ["Temp"]
+DIR_BASE = os.path.join(os.path.expanduser("~"), ".webpage2calibre")
+TOKEN_FILE = "token"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+
+    db: sqlite3.Connection
+    lock: threading.Lock
+    available: threading.Condition
+
+    def __init__(self, db_file: str):
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL UNIQUE,
+                    title TEXT,
+                    tags TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    book_id TEXT,
+                    submitted REAL NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)"
+            )
+            # Jobs interrupted by a shutdown start again from scratch
+            self.db.execute(
+                "UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING)
+            )
+
+    def submit(self, url: str, title: Optional[str], tags: List[str]) -> Dict[str, Any]:
+        now = time.time()
+        with self.available, self.db:
+            row = self.db.execute("SELECT * FROM jobs WHERE url = ?", (url,)).fetchone()
+            if row and row["status"] != FAILED:
+                return dict(row, duplicate=True)
+            if row:
+                # A failed job is tried again
+                self.db.execute(
+                    "UPDATE jobs SET title = ?, tags = ?, status = ?, error = NULL, "
+                    "updated = ? WHERE id = ?",
+                    (title, json.dumps(tags), QUEUED, now, row["id"]),
+                )
+            else:
+                self.db.execute(
+                    "INSERT INTO jobs (url, title, tags, status, submitted, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, title, json.dumps(tags), QUEUED, now, now),
+                )
+            self.available.notify()
+            row = self.db.execute("SELECT * FROM jobs WHERE url = ?", (url,)).fetchone()
+        return dict(row, duplicate=False)
+
+    def take(self) -> sqlite3.Row:
+        # Blocks until there's a queued job, which becomes running
+        with self.available:
+            while True:
+                row = self.db.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                    (QUEUED,),
+                ).fetchone()
+                if row:
+                    with self.db:
+                        self.db.execute(
+                            "UPDATE jobs SET status = ?, updated = ? WHERE id = ?",
+                            (RUNNING, time.time(), row["id"]),
+                        )
+                    return row
+                self.available.wait()
+
+    def finish(
+        self, job_id: int, book_id: Optional[str] = None, error: Optional[str] = None
+    ):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, book_id = ?, error = ?, updated = ? "
+                "WHERE id = ?",
+                (FAILED if error else DONE, book_id, error, time.time(), job_id),
+            )
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def failures(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, url, error FROM jobs WHERE status = ? ORDER BY id",
+                (FAILED,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+class Webpage2Calibre:
+
+    covers: CoverRenderer
+    fetcher: PageFetcher
+    index: ImportIndex
+    library: CalibreLibrary
+    import_lock: threading.Lock
+    queue: JobQueue
+    dir_jobs: str
+
+    def __init__(self, queue: JobQueue, dir_base: str, library: Optional[str] = None):
+        self.covers = CoverRenderer()
+        self.fetcher = PageFetcher(
+            HttpCache(), image_optimizer=ImageOptimizer(cache=StageCache())
+        )
+        self.index = ImportIndex(library)
+        self.library = CalibreLibrary(library, index=self.index)
+        if self.library.get_init_errors():
+            print("\n".join(self.library.get_init_errors()))
+            sys.exit(1)
+        self.import_lock = threading.Lock()
+        self.queue = queue
+        self.dir_jobs = os.path.join(dir_base, "jobs")
+
+    def convert(self, job: sqlite3.Row, page: FetchedPage, dir_job: str) -> str:
+        title = job["title"]
+        if not title:
+            doc = html.document_fromstring(page.files["index.xhtml"])
+            title = " ".join((doc.findtext(".//title") or "").split())
+            title = title or urlsplit(job["url"]).netloc
+        # Only the main content of the page goes in the book, with the
+        # images it uses; the whole page when it can't be found
+        context = TransformContext(title=title, url=job["url"])
+        try:
+            content = DocumentPipeline(["extract-article"], context).apply(
+                page.files["index.xhtml"]
+            )
+        except TransformError:
+            content = None
+        if content:
+            page.files["index.xhtml"] = content
+            drop_unreferenced(page.files)
+        # A malformed page fails the job instead of the EPUB
+        check_xhtml(io.BytesIO(page.files["index.xhtml"]))
+        cover_file = os.path.join(dir_job, "cover.jpg")
+        self.covers.render("webpage", title, cover_file, pointsize=24)
+        metadata = BookMetadata(
+            title=title,
+            authors=["Unknown"],
+            tags=json.loads(job["tags"]),
+            comments=f"From {job['url']}",
+            source_url=job["url"],
+        )
+        epub = EpubBuilder(metadata)
+        epub.add_files(page.files)
+        epub.set_cover(cover_file)
+        epub.write(os.path.join(dir_job, "pippo.epub"))
+        return title
+
+    def import_book(
+        self, title: str, epub_file: str, url: str, content_hash: str
+    ) -> Optional[str]:
+        book = self.library.add(
+            title, [epub_file], source_url=url, content_hash=content_hash
+        )
+        # The books queued while another worker was importing are all
+        # imported by the next flush
+        with self.import_lock:
+            if book in self.library.queue:
+                self.library.flush()
+        return book.book_id
+
+    def process(self, job: sqlite3.Row):
+        # Pages already imported, by this service or by the other scripts,
+        # aren't even downloaded
+        book = self.index.find(source_url=job["url"])
+        if book:
+            print(f"{job['url']}: already in the library as book {book.book_id}")
+            self.queue.finish(job["id"], book_id=book.book_id)
+            return
+        dir_job = os.path.join(self.dir_jobs, str(job["id"]))
+        shutil.rmtree(dir_job, ignore_errors=True)
+        os.makedirs(dir_job)
+        try:
+            page = self.fetcher.fetch_page(job["url"])
+            # The same page under another URL (redirects, tracking parameters)
+            content_hash = bytes_digest(page.files["index.xhtml"])
+            book = self.index.find(content_hash=content_hash)
+            if book:
+                book_id: Optional[str] = book.book_id
+            else:
+                title = self.convert(job, page, dir_job)
+                book_id = self.import_book(
+                    title, os.path.join(dir_job, "pippo.epub"), job["url"], content_hash
+                )
+            if not book_id:
+                raise LibraryError("the book hasn't been added to Calibre")
+        except Exception as e:
+            print(f"{job['url']}: {e}")
+            self.queue.finish(job["id"], error=str(e) or type(e).__name__)
+        else:
+            print(f"{job['url']}: imported as book {book_id}")
+            self.queue.finish(job["id"], book_id=book_id)
+        finally:
+            shutil.rmtree(dir_job, ignore_errors=True)
+
+    def work(self):
+        while True:
+            self.process(self.queue.take())
+
+    def start(self, workers: int):
+        for i in range(workers):
+            threading.Thread(target=self.work, name=f"worker-{i}", daemon=True).start()
+
+
+def load_token(dir_base: str) -> str:
+    # Created on first use, by the service or by a client, with a link so
+    # that a concurrent reader never sees a partial token
+    token_file = os.path.join(dir_base, TOKEN_FILE)
+    if not os.path.exists(token_file):
+        os.makedirs(dir_base, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dir_base)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_urlsafe(32))
+            os.link(tmp, token_file)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(token_file) as f:
+        return f.read().strip()
+
+
+def make_handler(queue: JobQueue, token: str):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status: HTTPStatus, body: Any):
+            content = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def authorized(self) -> bool:
+            # Browsers send an Origin header with cross-site requests, and
+            # without CORS they can't add the Authorization header
+            if self.headers.get("Origin") is not None:
+                self.reply(HTTPStatus.FORBIDDEN, {"error": "cross-origin request"})
+                return False
+            given = self.headers.get("Authorization", "")
+            if not hmac.compare_digest(given.encode(), f"Bearer {token}".encode()):
+                self.reply(HTTPStatus.UNAUTHORIZED, {"error": "wrong or missing token"})
+                return False
+            return True
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+            if self.path == "/jobs":
+                self.reply(
+                    HTTPStatus.OK,
+                    {"counts": queue.counts(), "failed": queue.failures()},
+                )
+                return
+            if self.path.startswith("/jobs/") and self.path[6:].isdigit():
+                job = queue.get(int(self.path[6:]))
+                if job:
+                    self.reply(HTTPStatus.OK, job)
+                    return
+            self.reply(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+        def do_POST(self):
+            if not self.authorized():
+                return
+            if self.path != "/jobs":
+                self.reply(HTTPStatus.NOT_FOUND, {"error": "not found"})
+                return
+            content_type = self.headers.get("Content-Type", "")
+            if content_type.split(";")[0].strip().lower() != "application/json":
+                self.reply(
+                    HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                    {"error": "the request must be application/json"},
+                )
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                url = request["url"]
+                if urlsplit(url).scheme not in ("http", "https"):
+                    raise ValueError(f"not a web page URL: {url}")
+            except (KeyError, TypeError, ValueError) as e:
+                self.reply(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+                return
+            tags = request.get("tags") or DEFAULT_TAGS
+            job = queue.submit(url, request.get("title") or None, tags)
+            self.reply(HTTPStatus.ACCEPTED, job)
+
+        def log_message(self, format: str, *args: Any):
+            pass
+
+    return Handler
+
+
+def serve(port: int, workers: int, dir_base: str, library: Optional[str]):
+    os.makedirs(dir_base, exist_ok=True)
+    queue = JobQueue(os.path.join(dir_base, "queue.sqlite"))
+    Webpage2Calibre(queue, dir_base, library).start(workers)
+    handler = make_handler(queue, load_token(dir_base))
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    print(f"Listening on http://127.0.0.1:{port}/jobs with {workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def call(port: int, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = Request(
+        f"http://127.0.0.1:{port}{path}",
+        data=data,
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {load_token(DIR_BASE)}",
+        },
+    )
+    try:
+        with urlopen(request, timeout=30) as response:
+            return json.load(response)
+    except HTTPError as e:
+        return json.load(e)
+
+
+def is_running(port: int) -> bool:
+    try:
+        call(port, "/jobs")
+    except (URLError, OSError):
+        return False
+    return True
+
+
+def ensure_running(port: int, workers: int, library: Optional[str]):
+    if is_running(port):
+        return
+    os.makedirs(DIR_BASE, exist_ok=True)
+    cmd = [sys.executable, os.path.abspath(__file__)]
+    cmd += ["--port", str(port), "--workers", str(workers)]
+    if library:
+        cmd += ["--with-library", library]
+    cmd.append("serve")
+    with open(os.path.join(DIR_BASE, "webpage2calibred.log"), "ab") as log:
+        subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    for _ in range(50):
+        if is_running(port):
+            return
+        time.sleep(0.2)
+    print("Cannot start the Webpage to Calibre service")
+    sys.exit(1)
+
+
+def read_urls(file_name: str) -> List[str]:
+    # One URL per line, as in most read-it-later exports
+    with open(file_name, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Web page ingest service for Calibre")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--with-library", dest="library", help="library path or URL")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=2, help="number of import workers"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("serve", help="run the service")
+    submit = subparsers.add_parser("submit", help="queue some web pages")
+    submit.add_argument("urls", nargs="*", metavar="url")
+    submit.add_argument("-f", "--file", help="file with one URL per line")
+    submit.add_argument("--title", help="book title (default: the page title)")
+    submit.add_argument("--tags", help="comma separated tags (default: Temp)")
+    subparsers.add_parser("status", help="show the queue status")
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args.port, max(1, args.workers), DIR_BASE, args.library)
+    elif args.command == "submit":
+        urls = args.urls + (read_urls(args.file) if args.file else [])
+        if not urls:
+            parser.error("no URL to submit")
+        ensure_running(args.port, max(1, args.workers), args.library)
+        tags = [tag.strip() for tag in (args.tags or "").split(",") if tag.strip()]
+        for url in urls:
+            job = call(
+                args.port, "/jobs", {"url": url, "title": args.title, "tags": tags}
+            )
+            if "id" not in job:
+                print(f"{url}: {job['error']}")
+            elif job["duplicate"]:
+                print(f"{url}: already submitted (job {job['id']}, {job['status']})")
+            else:
+                print(f"{url}: queued (job {job['id']})")
+    else:
+        if not is_running(args.port):
+            print("The Webpage to Calibre service isn't running")
+            sys.exit(1)
+        status = call(args.port, "/jobs")
+        for name in (QUEUED, RUNNING, DONE, FAILED):
+            print(f"{name}: {status['counts'].get(name, 0)}")
+        for job in status["failed"]:
+            print(f"job {job['id']} {job['url']}: {job['error']}")
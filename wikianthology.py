@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+#
+# Wikipedia anthologies: many articles in a single EPUB, with a table of
+# contents, one cover and one Calibre import. The articles are given as
+# titles (on the command line or in a file), as a category, or as seed
+# articles plus a link depth. Their parsed HTML comes from the MediaWiki
+# API, fetched concurrently by a bounded pool through the HTTP cache; the
+# images shared by several articles are downloaded and stored once, and
+# the links between the articles of the anthology point inside the book.
+#
+#   python3 wikianthology.py --lang it --title Umbria Perugia Assisi Spoleto
+#   python3 wikianthology.py --category "Comuni della provincia di Perugia"
+#   python3 wikianthology.py --depth 1 --limit 50 Perugia
+#   python3 wikianthology.py --file reading-list.txt -o reading-list.epub
+#
+# lxml, Pillow, requests, Calibre
+#
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import json
+import os
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote, urlencode, urljoin, urlsplit
+
+from lxml import etree, html
+
+from covers import CoverRenderer
+from epub import BookMetadata, EpubBuilder
+from fetcher import FetchError, PageFetcher, asset_extension
+from httpcache import HttpCache
+from images import ImageOptimizer
+from importindex import ImportIndex
+from library import CalibreLibrary, LibraryError
+from stagecache import StageCache
+
+API_PATH = "/w/api.php"
+ARTICLE_PATH = "/wiki/"
+# Wikimedia asks API clients to identify themselves
+USER_AGENT = "Calibre-Utils (https://github.com/pbswengineering/Calibre-Utils)"
+DEFAULT_LIMIT = 500
+
+# Edit links, navigation boxes and the other parts meant for the web only
+CLUTTER_CLASSES = [
+    "mw-editsection",
+    "mw-empty-elt",
+    "navbox",
+    "navbox-styles",
+    "noprint",
+    "metadata",
+    "sistersitebox",
+    "mw-jump-link",
+]
+CLUTTER_XPATH = etree.XPath(
+    " | ".join(
+        ["//style", "//link", "//script"]
+        + [
+            f"//*[contains(concat(' ', normalize-space(@class), ' '), ' {name} ')]"
+            for name in CLUTTER_CLASSES
+        ]
+    )
+)
+IMAGES_XPATH = etree.XPath("//img[@src]")
+LINKS_XPATH = etree.XPath("//a[@href]")
+
+
+@dataclass
+class Article:
+    title: str
+    html: str
+    links: List[str] = field(default_factory=list)
+
+
+class WikipediaApi:
+
+    fetcher: PageFetcher
+    base_url: str
+
+    def __init__(self, fetcher: PageFetcher, lang: str = "en", site: str = ""):
+        self.fetcher = fetcher
+        self.base_url = site.rstrip("/") if site else f"https://{lang}.wikipedia.org"
+        self.fetcher.http_cache.session.headers["User-Agent"] = USER_AGENT
+
+    def query(self, **params: str) -> Dict[str, Any]:
+        params.update(format="json", formatversion="2")
+        url = f"{self.base_url}{API_PATH}?{urlencode(params)}"
+        response = self.fetcher.get(url)
+        if not response.ok:
+            raise FetchError(f"{url} returned HTTP {response.status_code}")
+        data = json.loads(response.content)
+        if "error" in data:
+            raise FetchError(data["error"].get("info", "MediaWiki API error"))
+        return data
+
+    def parse(self, title: str) -> Article:
+        data = self.query(
+            action="parse",
+            page=title,
+            prop="text|links",
+            redirects="1",
+            disableeditsection="1",
+            disabletoc="1",
+        )["parse"]
+        # Only the links to existing articles, for the link depth
+        links = [
+            link["title"]
+            for link in data.get("links", [])
+            if link.get("ns") == 0 and link.get("exists")
+        ]
+        return Article(data["title"], data["text"], links)
+
+    def category_members(self, category: str, limit: int) -> List[str]:
+        # "Category:" works for every language
+        if ":" not in category:
+            category = "Category:" + category
+        titles: List[str] = []
+        more: Dict[str, str] = {}
+        while len(titles) < limit:
+            data = self.query(
+                action="query",
+                list="categorymembers",
+                cmtitle=category,
+                cmtype="page",
+                cmlimit=str(min(500, limit - len(titles))),
+                **more,
+            )
+            titles += [m["title"] for m in data["query"]["categorymembers"]]
+            if "continue" not in data:
+                break
+            more = data["continue"]
+        return titles[:limit]
+
+    def article_url(self, title: str) -> str:
+        return self.base_url + ARTICLE_PATH + quote(title.replace(" ", "_"))
+
+    def article_title(self, url: str) -> Optional[str]:
+        # The title of the article a URL points to, if it's on this wiki
+        parts = urlsplit(url)
+        if parts.netloc != urlsplit(self.base_url).netloc:
+            return None
+        if not parts.path.startswith(ARTICLE_PATH):
+            return None
+        return unquote(parts.path[len(ARTICLE_PATH) :]).replace("_", " ")
+
+
+class WikiAnthology:
+
+    api: WikipediaApi
+    fetcher: PageFetcher
+    image_optimizer: Optional[ImageOptimizer]
+    executor: ThreadPoolExecutor
+    aliases: Dict[str, str]
+
+    def __init__(
+        self,
+        api: WikipediaApi,
+        jobs: int = 8,
+        image_optimizer: Optional[ImageOptimizer] = None,
+    ):
+        self.api = api
+        self.fetcher = api.fetcher
+        self.image_optimizer = image_optimizer
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        # Requested title (e.g. a redirect) -> title of the article
+        self.aliases = {}
+
+    def parse_or_none(self, title: str) -> Optional[Article]:
+        try:
+            return self.api.parse(title)
+        except Exception as e:
+            print(f"{title}: {e}")
+            return None
+
+    def collect(self, titles: List[str], depth: int, limit: int) -> List[Article]:
+        # Breadth first: the given articles, then the ones they link to, and
+        # so on down to depth, each level fetched concurrently
+        articles: Dict[str, Article] = {}
+        seen: Set[str] = set()
+        level = list(dict.fromkeys(titles))
+        for _ in range(depth + 1):
+            level = [t for t in dict.fromkeys(level) if t not in seen]
+            level = level[: limit - len(articles)]
+            if not level:
+                break
+            seen.update(level)
+            next_level: List[str] = []
+            for title, article in zip(
+                level, self.executor.map(self.parse_or_none, level)
+            ):
+                if article is None:
+                    continue
+                self.aliases[title] = article.title
+                if article.title in articles:
+                    continue
+                print(f"{article.title}: downloaded")
+                articles[article.title] = article
+                next_level += article.links
+            level = next_level
+        return list(articles.values())
+
+    def build(
+        self,
+        articles: List[Article],
+        metadata: BookMetadata,
+        cover_file: str,
+        epub_file: str,
+    ):
+        names = {a.title: f"article{i:04d}.xhtml" for i, a in enumerate(articles, 1)}
+        for alias, title in self.aliases.items():
+            if title in names:
+                names.setdefault(alias, names[title])
+        base_url = self.api.base_url + ARTICLE_PATH
+        docs: List[Tuple[str, html.HtmlElement]] = []
+        images: List[Tuple[html.HtmlElement, str]] = []
+        for article in articles:
+            content = html.fragment_fromstring(article.html, create_parent="div")
+            for element in CLUTTER_XPATH(content):
+                if element.getparent() is not None:
+                    element.drop_tree()
+            for img in IMAGES_XPATH(content):
+                img.attrib.pop("srcset", None)
+                images.append((img, urljoin(base_url, img.get("src"))))
+            for a in LINKS_XPATH(content):
+                href = a.get("href")
+                if href.startswith("#"):
+                    continue
+                url = urljoin(base_url, href)
+                target = names.get(self.api.article_title(url) or "")
+                if target:
+                    # Another article of the anthology
+                    fragment = urlsplit(url).fragment
+                    a.set("href", f"{target}#{fragment}" if fragment else target)
+                else:
+                    a.set("href", url)
+            docs.append((names[article.title], content))
+        # Each image is downloaded and stored once, however many articles
+        # use it
+        files: Dict[str, bytes] = {}
+        local: Dict[str, str] = {}
+        image_urls = list(dict.fromkeys(url for _, url in images))
+        for url, response in self.fetcher.get_assets(image_urls).items():
+            if response:
+                content_type = response.headers.get("Content-Type", "")
+                ext = asset_extension(url, content_type, ".jpg")
+                local[url] = f"images/img{len(local) + 1}{ext}"
+                files[local[url]] = response.content
+        if self.image_optimizer:
+            renamed = self.image_optimizer.optimize_files(files)
+            local = {url: renamed.get(name, name) for url, name in local.items()}
+        for img, url in images:
+            if url in local:
+                img.set("src", local[url])
+            else:
+                img.drop_tree()
+        epub = EpubBuilder(metadata)
+        epub.add_document("index.xhtml", contents_page(metadata.title, articles, names))
+        for (name, content), article in zip(docs, articles):
+            epub.add_document(name, article_page(article.title, content))
+        for name, content in files.items():
+            epub.add_resource(name, content)
+        epub.set_cover(cover_file)
+        epub.write(epub_file)
+
+    def close(self):
+        self.executor.shutdown()
+        if self.image_optimizer:
+            self.image_optimizer.close()
+
+
+def page(title: str, *elements: etree._Element) -> bytes:
+    root = html.Element("html")
+    head = etree.SubElement(root, "head")
+    etree.SubElement(head, "title").text = title
+    body = etree.SubElement(root, "body")
+    etree.SubElement(body, "h1").text = title
+    body.extend(elements)
+    return html.tostring(root, encoding="utf-8")
+
+
+def contents_page(title: str, articles: List[Article], names: Dict[str, str]) -> bytes:
+    ul = html.Element("ul")
+    for article in articles:
+        li = etree.SubElement(ul, "li")
+        etree.SubElement(li, "a", href=names[article.title]).text = article.title
+    return page(title, ul)
+
+
+def article_page(title: str, content: html.HtmlElement) -> bytes:
+    return page(title, *content)
+
+
+def read_titles(file: str) -> List[str]:
+    # One title or article URL per line, # for comments
+    with open(file, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import many Wikipedia articles into Calibre as a single book"
+    )
+    parser.add_argument("articles", nargs="*", help="article titles or URLs")
+    parser.add_argument("-f", "--file", help="file with a title or URL per line")
+    parser.add_argument("-c", "--category", help="all the articles of a category")
+    parser.add_argument(
+        "-d",
+        "--depth",
+        type=int,
+        default=0,
+        help="follow the links of the articles down to this depth",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=DEFAULT_LIMIT,
+        help=f"maximum number of articles (default: {DEFAULT_LIMIT})",
+    )
+    parser.add_argument("--lang", default="en", help="Wikipedia language")
+    parser.add_argument("--site", default="", help="wiki base URL (default: Wikipedia)")
+    parser.add_argument("-t", "--title", help="book title")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=8, help="concurrent downloads"
+    )
+    parser.add_argument("-o", "--output", help="write the EPUB here, don't import it")
+    parser.add_argument("--with-library", dest="library", help="library path or URL")
+    args = parser.parse_args()
+    library = CalibreLibrary(args.library, index=ImportIndex(args.library))
+    if not args.output and library.get_init_errors():
+        print("\n".join(library.get_init_errors()))
+        sys.exit(1)
+    jobs = max(1, args.jobs)
+    fetcher = PageFetcher(HttpCache(), max_workers=jobs)
+    api = WikipediaApi(fetcher, args.lang, args.site)
+    anthology = WikiAnthology(api, jobs, ImageOptimizer(cache=StageCache()))
+    try:
+        titles = [api.article_title(t) or t for t in args.articles]
+        if args.file:
+            titles += [api.article_title(t) or t for t in read_titles(args.file)]
+        source_url = ""
+        if args.category:
+            titles += api.category_members(args.category, args.limit)
+            source_url = api.article_url(
+                args.category if ":" in args.category else "Category:" + args.category
+            )
+        if not titles:
+            parser.error("no articles: give some titles, a --file or a --category")
+        articles = anthology.collect(titles, max(0, args.depth), args.limit)
+        if not articles:
+            print("No article could be downloaded")
+            sys.exit(1)
+        book_title = args.title or args.category or articles[0].title
+        book_title = f"{book_title} (Wikipedia {args.lang})"
+        metadata = BookMetadata(
+            title=book_title,
+            authors=["Wikipedia"],
+            author_sort="Wikipedia",
+            tags=["Wikipedia"],
+            language=args.lang,
+            publisher="Wikipedia",
+            comments=f"From {source_url}" if source_url else "",
+            source_url=source_url,
+        )
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            cover_file = os.path.join(dir_tmp, "cover.jpg")
+            CoverRenderer().render("wikipedia", book_title, cover_file, pointsize=24)
+            epub_file = args.output or os.path.join(dir_tmp, "anthology.epub")
+            anthology.build(articles, metadata, cover_file, epub_file)
+            print(f"{len(articles)} articles in {book_title}")
+            if not args.output:
+                book = library.add(
+                    book_title, [epub_file], source_url=source_url or None
+                )
+                library.flush()
+                if not book.book_id:
+                    raise LibraryError("the book hasn't been added to Calibre")
+                print(f"Imported as book {book.book_id}")
+    except (FetchError, LibraryError) as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        anthology.close()
+        fetcher.executor.shutdown()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+# ZIP/EPUB writer that takes its entries straight from memory buffers.
+# Already compressed media (JPEG, PNG, fonts, ...) is stored instead of
+# being deflated again, the EPUB "mimetype" entry is always written first
+# and uncompressed, and single members can be patched by copying every
+# other member's compressed bytes as they are.
+#
+
+import argparse
+import copy
+import os
+import shutil
+import struct
+import tempfile
+import time
+from types import TracebackType
+from typing import BinaryIO, Dict, IO, Optional, Type, Union
+import zipfile
+
+STORED_EXTENSIONS = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".webp",
+    ".zip",
+    ".epub",
+    ".gz",
+    ".mp3",
+    ".mp4",
+    ".woff",
+    ".woff2",
+}
+
+EPUB_MIMETYPE = b"application/epub+zip"
+
+# Content of an archive member: bytes or a file object
+Member = Union[bytes, IO[bytes]]
+
+# Layout of a local file header (same as zipfile.structFileHeader) and
+# offsets of its name and extra field lengths
+STRUCT_FILE_HEADER = "<4s2B4HL2L2H"
+SIZE_FILE_HEADER = struct.calcsize(STRUCT_FILE_HEADER)
+FH_FILENAME_LENGTH = 10
+FH_EXTRA_FIELD_LENGTH = 11
+ZIP64_EXTRA = 0x0001
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def compress_type(name: str) -> int:
+    # An EPUB's mimetype must be stored
+    if name == "mimetype":
+        return zipfile.ZIP_STORED
+    ext = os.path.splitext(name)[1].lower()
+    return zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def strip_zip64_extra(extra: bytes) -> bytes:
+    # FileHeader() adds its own ZIP64 record when it's needed
+    result = b""
+    i = 0
+    while i + 4 <= len(extra):
+        tag, size = struct.unpack("<HH", extra[i : i + 4])
+        if tag != ZIP64_EXTRA:
+            result += extra[i : i + 4 + size]
+        i += 4 + size
+    return result
+
+
+class ZipWriter:
+
+    zipf: zipfile.ZipFile
+    epub: bool
+
+    def __init__(self, file: Union[str, BinaryIO], epub: bool = False):
+        self.zipf = zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED)
+        self.epub = epub
+        if epub:
+            # The mimetype must be the first entry and it must be stored
+            self.zipf.writestr("mimetype", EPUB_MIMETYPE, zipfile.ZIP_STORED)
+
+    def __enter__(self) -> "ZipWriter":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ):
+        self.close()
+
+    def add(self, name: str, content: Union[bytes, str]):
+        if self.epub and name == "mimetype":
+            # Already written
+            return
+        self.zipf.writestr(name, content, compress_type(name))
+
+    def add_stream(self, name: str, content: IO[bytes]):
+        # Same as add(), from a file object read in chunks
+        if self.epub and name == "mimetype":
+            # Already written
+            return
+        info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        info.compress_type = compress_type(name)
+        info.external_attr = 0o600 << 16
+        with self.zipf.open(info, "w") as dst:
+            shutil.copyfileobj(content, dst, COPY_CHUNK_SIZE)
+
+    def add_files(self, files: Dict[str, bytes], prefix: str = ""):
+        for name, content in files.items():
+            self.add(prefix + name, content)
+
+    def add_tree(self, dir_path: str, prefix: str = ""):
+        for root, _, files in os.walk(dir_path):
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, dir_path).replace(os.sep, "/")
+                if self.epub and prefix + name == "mimetype":
+                    continue
+                self.zipf.write(path, prefix + name, compress_type(name))
+
+    def add_member(self, name: str, content: Member):
+        if isinstance(content, bytes):
+            self.add(name, content)
+        else:
+            self.add_stream(name, content)
+
+    def copy_raw(self, source: zipfile.ZipFile, info: zipfile.ZipInfo):
+        # Copy the compressed bytes of a member from another archive,
+        # without inflating and deflating them again
+        if info.flag_bits & FLAG_ENCRYPTED:
+            raise ValueError(f"{info.filename} is encrypted")
+        fp = source.fp
+        assert fp is not None
+        fp.seek(info.header_offset)
+        header = struct.unpack(STRUCT_FILE_HEADER, fp.read(SIZE_FILE_HEADER))
+        fp.seek(header[FH_FILENAME_LENGTH] + header[FH_EXTRA_FIELD_LENGTH], 1)
+        target = copy.copy(info)
+        # Sizes and CRC are known, so they go in the local header
+        target.flag_bits &= ~FLAG_DATA_DESCRIPTOR
+        target.extra = strip_zip64_extra(info.extra)
+        zip64 = (
+            target.file_size > zipfile.ZIP64_LIMIT
+            or target.compress_size > zipfile.ZIP64_LIMIT
+        )
+        # There's no public API to append raw compressed data, so the
+        # entry is registered the same way ZipFile.write() does it
+        dst = self.zipf
+        assert dst.fp is not None
+        target.header_offset = dst.fp.tell()
+        dst.fp.write(target.FileHeader(zip64))
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = fp.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"{info.filename} is truncated")
+            dst.fp.write(chunk)
+            remaining -= len(chunk)
+        dst.filelist.append(target)
+        dst.NameToInfo[target.filename] = target
+        dst.start_dir = dst.fp.tell()
+        dst._didModify = True  # type: ignore[attr-defined]
+
+    def close(self):
+        self.zipf.close()
+
+
+def patch_archive(
+    archive: str,
+    replacements: Dict[str, Optional[Member]],
+    output: Optional[str] = None,
+):
+    # The members in replacements are rewritten (or removed, when their
+    # content is None) keeping their position, every other member is copied
+    # as it is; new members are appended at the end. The new content can be
+    # bytes or a file object, positioned at its start.
+    output = output or archive
+    fd, tmp = tempfile.mkstemp(
+        suffix=".zip", dir=os.path.dirname(os.path.abspath(output))
+    )
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(archive) as source, ZipWriter(tmp) as writer:
+            for info in source.infolist():
+                if info.filename not in replacements:
+                    writer.copy_raw(source, info)
+                    continue
+                content = replacements[info.filename]
+                if content is not None:
+                    writer.add_member(info.filename, content)
+            for name, content in replacements.items():
+                if content is not None and name not in source.NameToInfo:
+                    writer.add_member(name, content)
+        os.replace(tmp, output)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and patch ZIP/EPUB files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack = subparsers.add_parser(
+        "pack", help="archive a directory, like zip -r ARCHIVE DIR"
+    )
+    pack.add_argument("archive")
+    pack.add_argument("dir")
+    pack.add_argument("--epub", action="store_true", help="write an EPUB")
+    patch = subparsers.add_parser("patch", help="replace some archive members")
+    patch.add_argument("archive")
+    patch.add_argument(
+        "members", nargs="+", metavar="MEMBER=FILE", help="new content of MEMBER"
+    )
+    patch.add_argument("-o", "--output", help="output archive (default: in place)")
+    args = parser.parse_args()
+    if args.command == "pack":
+        with ZipWriter(args.archive, epub=args.epub) as writer:
+            dir_path = os.path.normpath(args.dir)
+            # Like zip -r, the directory name is kept in the member paths,
+            # but an EPUB's content must be at the root of the archive
+            prefix = "" if args.epub else os.path.basename(dir_path) + "/"
+            writer.add_tree(dir_path, prefix)
+    else:
+        replacements: Dict[str, Optional[Member]] = {}
+        for member in args.members:
+            name, path = member.split("=", 1)
+            with open(path, "rb") as f:
+                replacements[name] = f.read()
+        patch_archive(args.archive, replacements, args.output)